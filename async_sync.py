@@ -0,0 +1,414 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from customer_analytics import get_customer_analytics
+from dead_letter import get_dead_letter_store
+from invoice_supabase_sync import (
+    BASE_URL, SUPABASE_URL, DAFTRA_API_KEY, SUPABASE_KEY,
+    HEADERS_DAFTRA, HEADERS_SUPABASE, EXPECTED_TYPE, PAGE_LIMIT, BRANCH_IDS,
+    BATCH_SIZE, MAX_RETRIES, SKIP_EXISTING_INVOICES,
+    DaftraClient, DataValidator, SupabaseClient,
+)
+from json_codec import compress_body, loads, reject_gzip
+from metrics import get_metrics
+from rate_limiter import (
+    THROTTLE_STATUSES, RETRY_STATUSES, AdaptiveLimiter, backoff_delay, get_limiter, parse_retry_after,
+)
+from records import encode_rows
+from staff_cache import StaffCache, get_staff_cache
+from sync_utils import Watermark, get_fingerprint_store
+
+logger = logging.getLogger(__name__)
+
+# أقصى عدد طلبات متزامنة لكل مضيف (دفترة / Supabase)
+ASYNC_HOST_CONCURRENCY = int(os.getenv("ASYNC_HOST_CONCURRENCY", "8"))
+ASYNC_REQUEST_TIMEOUT = int(os.getenv("REQUEST_TIMEOUT", "30"))
+
+
+def _import_aiohttp():
+    try:
+        import aiohttp
+    except ImportError as e:
+        raise RuntimeError("المحرك غير المتزامن يحتاج مكتبة aiohttp: pip install aiohttp") from e
+    return aiohttp
+
+
+class AsyncHttp:
+    """جلسة aiohttp واحدة مع semaphore لكل مضيف وإعادة محاولة مثل العملاء المتزامنين"""
+
+    def __init__(self, host_concurrency: int = ASYNC_HOST_CONCURRENCY):
+        self.aiohttp = _import_aiohttp()
+        self.host_concurrency = host_concurrency
+        self.semaphores: Dict[str, asyncio.Semaphore] = {}
+        self.session = None
+
+    async def __aenter__(self):
+        timeout = self.aiohttp.ClientTimeout(total=ASYNC_REQUEST_TIMEOUT)
+        connector = self.aiohttp.TCPConnector(limit_per_host=self.host_concurrency)
+        self.session = self.aiohttp.ClientSession(timeout=timeout, connector=connector)
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.session.close()
+
+    def _semaphore(self, url: str) -> asyncio.Semaphore:
+        host = urlsplit(url).netloc
+        if host not in self.semaphores:
+            self.semaphores[host] = asyncio.Semaphore(self.host_concurrency)
+        return self.semaphores[host]
+
+    async def request(self, method: str, url: str, limiter: Optional[AdaptiveLimiter] = None,
+                      **kwargs) -> Tuple[int, Any]:
+        """
+        إرجاع (status, json) أو (0, None) بعد فشل كل المحاولات.
+        limiter: حد المعدل المشترك للمضيف (نفس دلو المحرك المتزامن)، مع احترام 429/Retry-After.
+        """
+        status = 0
+        for attempt in range(MAX_RETRIES):
+            if limiter:
+                wait = limiter.reserve()
+                if wait:
+                    await asyncio.sleep(wait)
+            started = time.monotonic()
+            try:
+                async with self._semaphore(url):
+                    async with self.session.request(method, url, **kwargs) as response:
+                        status = response.status
+                        if status == 200:
+                            try:
+                                body = loads(await response.read())
+                            except ValueError as e:
+                                logger.error(f"استجابة JSON غير صالحة {method} {url}: {e}")
+                                body = None
+                        else:
+                            body = None
+                            await response.read()
+                        retry_after = response.headers.get("Retry-After")
+                get_metrics().observe_request(method, url, status, time.monotonic() - started)
+            except (self.aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.error(f"خطأ اتصال {method} {url} (محاولة {attempt + 1}): {e}")
+                if limiter:
+                    limiter.on_error()
+                status = 0
+                if attempt < MAX_RETRIES - 1:
+                    await asyncio.sleep(backoff_delay(attempt))
+                continue
+
+            if limiter and status in THROTTLE_STATUSES:
+                limiter.on_throttle(parse_retry_after(retry_after))
+                continue
+            if status in RETRY_STATUSES:
+                if limiter:
+                    limiter.on_error()
+                if attempt < MAX_RETRIES - 1:
+                    await asyncio.sleep(backoff_delay(attempt))
+                continue
+            if limiter:
+                limiter.on_success(time.monotonic() - started)
+            return status, body
+        return status, None
+
+
+class AsyncDaftraClient:
+    """نسخة غير متزامنة من DaftraClient"""
+
+    def __init__(self, http: AsyncHttp):
+        self.http = http
+        self.base_url = BASE_URL
+        self.headers = {k: v for k, v in HEADERS_DAFTRA.items() if v is not None}
+        self.limiter = get_limiter(self.base_url)
+        # فرع واحد فقط يحدّث الموظفين والباقي ينتظره
+        self.staff_lock = asyncio.Lock()
+
+    async def refresh_staff(self, staff: StaffCache, staff_ids: List[str]) -> None:
+        """تحميل/تحديث ذاكرة الموظفين بـ await داخل حلقة الأحداث (بدون جسر run_coroutine_threadsafe)"""
+        async with self.staff_lock:
+            if staff.needs_refresh(staff_ids):
+                staff_map = await self.fetch_staff_map()
+                await asyncio.to_thread(staff.update, staff_map)
+
+    async def fetch_staff_map(self) -> Dict[str, str]:
+        staff_map = {}
+        page = 1
+        while True:
+            url = os.getenv("DAFTRA_URL", "https://shadowpeace.daftra.com") + f"/api2/staff?limit=100&page={page}"
+            status, body = await self.http.request("GET", url, limiter=self.limiter, headers=self.headers)
+            data = (body or {}).get("data", []) if status == 200 else []
+            if not data:
+                break
+            for row in data:
+                s = row.get("Staff", {})
+                sid = str(s.get("id", ""))
+                name = str(s.get("name", "")).strip()
+                if sid and name:
+                    staff_map[sid] = name
+            page += 1
+        logger.info(f"تم تحميل {len(staff_map)} موظف من دفترة")
+        return staff_map
+
+    async def fetch_invoices(self, branch_id: int, page: int = 1,
+                             since: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        params = {
+            'filter[type]': EXPECTED_TYPE,
+            'filter[branch_id]': branch_id,
+            'page': page,
+            'limit': PAGE_LIMIT,
+            **(since or {})
+        }
+        url = f"{self.base_url}/entity/invoice/list/1"
+        status, body = await self.http.request("GET", url, limiter=self.limiter, headers=self.headers, params=params)
+        if status != 200:
+            logger.error(f"خطأ في جلب الفواتير: {status}")
+            return {}
+        return body or {}
+
+    async def fetch_invoice_details(self, invoice_id: str) -> Dict[str, Any]:
+        url = f"{self.base_url}/entity/invoice/{invoice_id}?include=InvoiceItem"
+        status, body = await self.http.request("GET", url, limiter=self.limiter, headers=self.headers)
+        if status != 200:
+            logger.error(f"خطأ في جلب تفاصيل الفاتورة {invoice_id}: {status}")
+            return {}
+        return body or {}
+
+
+class AsyncSupabaseClient:
+    """نسخة غير متزامنة من SupabaseClient للقراءة والـ upsert"""
+
+    def __init__(self, http: AsyncHttp):
+        self.http = http
+        self.base_url = SUPABASE_URL
+        self.headers = {k: v for k, v in HEADERS_SUPABASE.items() if v is not None}
+
+    async def fetch_existing_invoices(self, invoice_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        if not invoice_ids:
+            return {}
+        url = (f"{self.base_url}/invoices?id=in.({','.join(invoice_ids)})"
+               f"&select=id,invoice_no,customer_id,summary_total,summary_paid,summary_unpaid")
+        status, body = await self.http.request("GET", url, headers=self.headers)
+        if status != 200:
+            logger.error(f"فشل في التحقق من الفواتير الموجودة: {status}")
+            return {}
+        return {str(row['id']): row for row in body or []}
+
+    async def upsert_batch(self, table: str, data: List[Dict[str, Any]],
+                           saved_rows: Optional[List[Dict[str, Any]]] = None) -> Tuple[int, int]:
+        """مثل SupabaseClient.upsert_batch؛ saved_rows تُضاف له الصفوف الموجودة فعلاً في Supabase"""
+        if not data:
+            return 0, 0
+        fingerprints = get_fingerprint_store()
+        total = len(data)
+        pending = []
+        if fingerprints:
+            # sqlite خارج حلقة الأحداث
+            changed, pending = await asyncio.to_thread(fingerprints.filter_changed, table, data)
+            if saved_rows is not None and len(changed) < total:
+                changed_ids = {id(row) for row in changed}
+                saved_rows.extend(row for row in data if id(row) not in changed_ids)
+            data = changed
+            if not data:
+                get_metrics().add_rows(table, skipped=total)
+                return total, 0
+        url = f"{self.base_url}/{table}?on_conflict=id"
+        headers = {**self.headers, "Prefer": "resolution=merge-duplicates,return=minimal"}
+        body = encode_rows(data)
+        for attempt in range(MAX_RETRIES):
+            payload, extra = compress_body(body, url)
+            status, _ = await self.http.request("POST", url, headers={**headers, **extra}, data=payload)
+            if extra and status == 415:
+                reject_gzip(url)
+                continue
+            if status in [200, 201]:
+                logger.info(f"تم حفظ/تحديث {len(data)} سجل في جدول {table}")
+                if fingerprints:
+                    await asyncio.to_thread(fingerprints.commit, pending)
+                if saved_rows is not None:
+                    saved_rows.extend(data)
+                get_metrics().add_rows(table, written=len(data), skipped=total - len(data))
+                return total, 0
+            logger.error(f"خطأ في حفظ {table}: {status} (محاولة {attempt + 1})")
+            if status < 500:
+                break
+        dead_letters = get_dead_letter_store()
+        if dead_letters:
+            await asyncio.to_thread(dead_letters.add, table, data, f"{status or 'connection'}: async upsert failed")
+        get_metrics().add_rows(table, skipped=total - len(data), failed=len(data))
+        return total - len(data), len(data)
+
+
+async def process_branch_invoices_async(daftra: AsyncDaftraClient, supabase: AsyncSupabaseClient,
+                                        codes: SupabaseClient, staff: StaffCache,
+                                        branch_id: int) -> Dict[str, int]:
+    """نفس منطق process_branch_invoices لكن التفاصيل والكتابة غير متزامنة"""
+    logger.info(f"بدء معالجة الفرع {branch_id} (async)")
+    stats = {
+        'invoices_processed': 0,
+        'items_processed': 0,
+        'invoices_saved': 0,
+        'items_saved': 0,
+        'invoices_failed': 0,
+        'items_failed': 0,
+        'invoices_skipped': 0
+    }
+
+    # قراءة العلامة من sqlite / Supabase خارج حلقة الأحداث
+    watermark = await asyncio.to_thread(Watermark, 'invoices', branch_id)
+    complete = True
+    page = 1
+    invoices_batch = []
+    items_batch = []
+    analytics = get_customer_analytics()
+
+    async def flush():
+        nonlocal invoices_batch, items_batch
+        # الفواتير أولاً ثم البنود المرتبطة بها
+        saved_invoices = []
+        saved, failed = await supabase.upsert_batch('invoices', invoices_batch, saved_rows=saved_invoices)
+        if analytics:
+            await asyncio.to_thread(analytics.record, saved_invoices)
+        stats['invoices_saved'] += saved
+        stats['invoices_failed'] += failed
+        saved, failed = await supabase.upsert_batch('invoice_items', items_batch)
+        stats['items_saved'] += saved
+        stats['items_failed'] += failed
+        invoices_batch, items_batch = [], []
+
+    while True:
+        response_data = await daftra.fetch_invoices(branch_id, page, since=watermark.list_params())
+        if not response_data or 'data' not in response_data:
+            complete = False
+            break
+        invoices = response_data['data']
+        if not invoices:
+            break
+
+        page_records = [invoice.get("Invoice", invoice) for invoice in invoices]
+        if watermark.page_already_synced(page_records):
+            break
+
+        existing_invoices = {}
+        if SKIP_EXISTING_INVOICES:
+            existing_invoices = await supabase.fetch_existing_invoices([str(inv["id"]) for inv in page_records])
+
+        to_fetch = []
+        for inv in page_records:
+            watermark.observe(inv)
+            stored = existing_invoices.get(str(inv["id"]))
+            if stored and DataValidator.is_invoice_unchanged(inv, stored, watermark.synced_at):
+                stats['invoices_skipped'] += 1
+                continue
+            to_fetch.append(inv)
+
+        async with asyncio.TaskGroup() as group:
+            tasks = [group.create_task(daftra.fetch_invoice_details(str(inv['id']))) for inv in to_fetch]
+
+        # كل ما قد يحتاج شبكة أثناء التنظيف يُجهز قبله: الموظفون بـ await، وأكواد المنتجات
+        # غير الموجودة في الفهرس بطلبات مجمعة في thread، فالتنظيف نفسه لا يحجب الحلقة
+        staff_ids = [str(task.result().get("Invoice", {}).get("staff_id", inv.get("staff_id", 0)))
+                     for inv, task in zip(to_fetch, tasks)]
+        await daftra.refresh_staff(staff, staff_ids)
+        product_ids = [item.get('product_id') for task in tasks for item in task.result().get('invoice_item', [])]
+        await asyncio.to_thread(codes.product_index.prefetch, product_ids)
+
+        for inv, task in zip(to_fetch, tasks):
+            invoice_details = task.result()
+            if not invoice_details:
+                complete = False
+                continue
+
+            full_invoice = {**inv, **invoice_details.get("Invoice", {})}
+            full_invoice["staff_name"] = staff.name(full_invoice.get("staff_id", 0))
+            try:
+                invoices_batch.append(DataValidator.clean_invoice_data(full_invoice))
+                stats['invoices_processed'] += 1
+                client_name = full_invoice.get('client_business_name', '')
+                for item in invoice_details.get('invoice_item', []):
+                    if DataValidator.validate_item(item):
+                        items_batch.append(DataValidator.clean_item_data(item, inv['id'], client_name, codes))
+                        stats['items_processed'] += 1
+            except Exception as e:
+                logger.error(f"خطأ في معالجة الفاتورة {inv.get('id', 'غير معروف')}: {e}")
+                complete = False
+
+        if len(invoices_batch) >= BATCH_SIZE:
+            await flush()
+        page += 1
+
+    if invoices_batch or items_batch:
+        await flush()
+
+    if complete and stats['invoices_failed'] == 0 and stats['items_failed'] == 0:
+        await asyncio.to_thread(watermark.commit)
+
+    logger.info(f"إحصائيات الفرع {branch_id}: {stats['invoices_processed']} فاتورة، {stats['items_processed']} بند")
+    return stats
+
+
+async def _safe_process_branch(*args) -> Dict[str, int]:
+    """خطأ في فرع لا يلغي باقي الفروع داخل TaskGroup"""
+    branch_id = args[-1]
+    try:
+        return await process_branch_invoices_async(*args)
+    except Exception as e:
+        logger.error(f"خطأ في معالجة الفرع {branch_id}: {e}")
+        return {}
+
+
+async def sync_invoices_async(branch_ids: Optional[List[int]] = None) -> Dict[str, int]:
+    """مزامنة الفواتير بالمحرك غير المتزامن: كل الفروع معًا داخل TaskGroup"""
+    branch_ids = branch_ids or BRANCH_IDS
+    total_stats = {
+        'invoices_processed': 0,
+        'items_processed': 0,
+        'invoices_saved': 0,
+        'items_saved': 0,
+        'invoices_failed': 0,
+        'items_failed': 0,
+        'invoices_skipped': 0
+    }
+    if not all([DAFTRA_API_KEY, SUPABASE_URL, SUPABASE_KEY]):
+        logger.error("متغيرات البيئة مفقودة!")
+        return total_stats
+
+    # فهرس أكواد المنتجات نفسه المستخدم في المسار المتزامن، يُحمّل في thread
+    codes = SupabaseClient()
+    fallback_daftra = DaftraClient()
+    await asyncio.to_thread(codes.product_index.load)
+
+    start = time.time()
+    async with AsyncHttp() as http:
+        daftra = AsyncDaftraClient(http)
+        supabase = AsyncSupabaseClient(http)
+        # نفس ذاكرة الموظفين المشتركة؛ الجلب من دفترة بـ await عبر daftra.refresh_staff.
+        # fetch المتزامن احتياطي فقط: name() لا يجلب بعد refresh_staff لنفس الصفحة
+        staff = get_staff_cache(fallback_daftra.fetch_staff_map)
+        if not await asyncio.to_thread(staff.load_cached):
+            await daftra.refresh_staff(staff, [])
+
+        async with asyncio.TaskGroup() as group:
+            tasks = {
+                branch_id: group.create_task(
+                    _safe_process_branch(daftra, supabase, codes, staff, branch_id)
+                )
+                for branch_id in branch_ids
+            }
+
+    for branch_id, task in tasks.items():
+        for key in total_stats:
+            total_stats[key] += task.result().get(key, 0)
+
+    logger.info(f"انتهاء المحرك غير المتزامن خلال {time.time() - start:.2f} ث: "
+                f"{total_stats['invoices_saved']} فاتورة، {total_stats['items_saved']} بند")
+    logger.info(f"ذاكرة الموظفين: {staff.summary()}")
+    return total_stats
+
+
+def main() -> Dict[str, int]:
+    return asyncio.run(sync_invoices_async())
+
+
+if __name__ == "__main__":
+    main()
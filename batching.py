@@ -0,0 +1,122 @@
+import os
+import time
+import logging
+import threading
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+
+from records import encode_row, join_rows
+
+logger = logging.getLogger(__name__)
+
+# حجم الدفعة يبدأ من هنا ويتكيف حسب زمن الكتابة الفعلي لكل جدول
+UPSERT_BATCH_INITIAL = int(os.getenv("UPSERT_BATCH_INITIAL", "50"))
+UPSERT_BATCH_MIN = int(os.getenv("UPSERT_BATCH_MIN", "10"))
+UPSERT_BATCH_MAX = int(os.getenv("UPSERT_BATCH_MAX", "1000"))
+# حد حجم جسم الطلب الواحد بالبايت مهما كان عدد الصفوف
+UPSERT_BATCH_MAX_BYTES = int(os.getenv("UPSERT_BATCH_MAX_BYTES", str(1024 * 1024)))
+# الزمن المستهدف لطلب upsert واحد: أسرع من نصفه نكبّر الدفعة، وأبطأ منه نصغّرها
+UPSERT_TARGET_SECONDS = float(os.getenv("UPSERT_TARGET_SECONDS", "2"))
+UPSERT_GROWTH = 1.5
+
+# حالات تعني أن المشكلة في بيانات الدفعة نفسها، فنقسمها لعزل الصفوف السيئة
+BISECT_STATUSES = {400, 413, 422}
+# باقي 4xx (مفتاح منتهي 401/403، جدول غير موجود 404...) ستفشل لكل دفعة بنفس الطريقة:
+# لا نقسم ولا نرسل باقي الدفعات. 408 و 429 مؤقتة، و 409 تعالج داخل العميل
+TRANSIENT_STATUSES = {408, 409, 429}
+
+
+def fails_fast(status: int) -> bool:
+    return 400 <= status < 500 and status not in BISECT_STATUSES and status not in TRANSIENT_STATUSES
+
+
+class BatchSizer:
+    """حجم دفعة متكيف لجدول واحد (زيادة تدريجية عند السرعة، تنصيف عند البطء أو 413)"""
+
+    def __init__(self, table: str, initial: int = UPSERT_BATCH_INITIAL, min_rows: int = UPSERT_BATCH_MIN,
+                 max_rows: int = UPSERT_BATCH_MAX, max_bytes: int = UPSERT_BATCH_MAX_BYTES,
+                 target_seconds: float = UPSERT_TARGET_SECONDS):
+        self.table = table
+        self.min_rows = max(1, min_rows)
+        self.max_rows = max(self.min_rows, max_rows)
+        self.max_bytes = max_bytes
+        self.target_seconds = target_seconds
+        self.size = float(min(max(initial, self.min_rows), self.max_rows))
+        self.lock = threading.Lock()
+
+    @property
+    def rows(self) -> int:
+        return int(self.size)
+
+    def chunks(self, sizes: List[int]) -> Iterator[Tuple[int, int]]:
+        """(بداية، نهاية) لكل دفعة من أحجام الصفوف المرمزة: لا تتجاوز عدد الصفوف الحالي ولا حد البايتات"""
+        start = 0
+        while start < len(sizes):
+            limit = self.rows
+            end, size = start, 0
+            while end < len(sizes) and end - start < limit:
+                size += sizes[end] + 1
+                # صف واحد أكبر من الحد يُرسل وحده
+                if size > self.max_bytes and end > start:
+                    break
+                end += 1
+            yield start, end
+            start = end
+
+    def observe(self, rows: int, seconds: float, status: int) -> None:
+        with self.lock:
+            previous = self.rows
+            if status == 413 or (200 <= status < 300 and seconds > self.target_seconds):
+                self.size = max(self.min_rows, self.size / 2)
+            elif 200 <= status < 300 and seconds < self.target_seconds / 2 and rows >= self.rows:
+                # نكبّر فقط إذا كانت الدفعة ممتلئة فعلاً، وإلا فالزمن لا يعبر عن الحجم الحالي
+                self.size = min(self.max_rows, self.size * UPSERT_GROWTH)
+            if self.rows != previous:
+                logger.info(f"حجم دفعة {self.table}: {previous} -> {self.rows} صف ({seconds:.2f} ث لـ {rows} صف)")
+
+
+_sizers: Dict[str, BatchSizer] = {}
+_sizers_lock = threading.Lock()
+
+
+def get_batch_sizer(table: str) -> BatchSizer:
+    """حجم دفعة واحد لكل جدول مشترك بين كل الفروع والعملاء"""
+    with _sizers_lock:
+        if table not in _sizers:
+            _sizers[table] = BatchSizer(table)
+        return _sizers[table]
+
+
+def write_batches(table: str, rows: List[Any], post: Callable[[List[Any], bytes], int]) -> List[int]:
+    """
+    كتابة الصفوف على دفعات متكيفة. post(chunk, body) ترجع كود الحالة النهائي (0 لخطأ اتصال)؛
+    body هو جسم JSON الجاهز للدفعة: كل صف يُرمز مرة واحدة، ومنه تُحسب الأحجام وتُبنى أجسام التقسيم.
+    الدفعة المرفوضة بسبب بياناتها (BISECT_STATUSES) تُقسم نصفين حتى نعزل الصف السيئ،
+    فصف واحد خاطئ لا يُفشل باقي الدفعة. خطأ صلاحيات أو مسار يوقف الكتابة فورًا.
+    ترجع آخر كود حالة لكل صف بنفس ترتيب rows.
+    """
+    sizer = get_batch_sizer(table)
+    encoded = [encode_row(row) for row in rows]
+    statuses = [0] * len(rows)
+
+    def write(start: int, end: int) -> int:
+        started = time.perf_counter()
+        status = post(rows[start:end], join_rows(encoded[start:end]))
+        sizer.observe(end - start, time.perf_counter() - started, status)
+        statuses[start:end] = [status] * (end - start)
+        if 200 <= status < 300:
+            return status
+        if end - start > 1 and status in BISECT_STATUSES:
+            middle = (start + end) // 2
+            write(start, middle)
+            write(middle, end)
+        elif end - start == 1 and status in BISECT_STATUSES:
+            logger.error(f"صف مرفوض في {table}: {rows[start].get('id', '?')}")
+        return status
+
+    for start, end in sizer.chunks([len(part) for part in encoded]):
+        status = write(start, end)
+        if fails_fast(status):
+            logger.error(f"توقف الكتابة في {table} بعد {status}: {len(rows) - end} صف لم يُرسل")
+            statuses[end:] = [status] * (len(rows) - end)
+            break
+    return statuses
@@ -0,0 +1,73 @@
+"""
+مقارنة مزامنة الفواتير بالمحرك المتزامن (requests) والمحرك غير المتزامن (asyncio) على خوادم محلية.
+
+    python benchmarks/bench_async_engine.py --invoices 400 --latency 0.02
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_servers import MockDaftra, MockPostgrest
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--invoices", type=int, default=400)
+    parser.add_argument("--latency", type=float, default=0.02, help="زمن استجابة دفترة بالثواني")
+    parser.add_argument("--db-latency", type=float, default=0.01, help="زمن استجابة PostgREST بالثواني")
+    args = parser.parse_args()
+
+    daftra = MockDaftra(latency=args.latency).seed(invoices=args.invoices).start()
+    postgrest = MockPostgrest(latency=args.db_latency).start()
+
+    # المتغيرات تُقرأ عند الاستيراد، فلازم تتحدد قبل استيراد وحدات المزامنة
+    workdir = tempfile.mkdtemp(prefix="daftra-bench-")
+    os.chdir(workdir)
+    os.environ.update({
+        "DAFTRA_URL": daftra.url,
+        "DAFTRA_APIKEY": "bench",
+        "SUPABASE_URL": postgrest.url,
+        "SUPABASE_KEY": "bench",
+        "INCREMENTAL_SYNC": "false",
+        "CHANGE_DETECTION": "false",
+    })
+
+    import invoice_supabase_sync
+    import async_sync
+
+    logging.disable(logging.INFO)
+
+    results = []
+    for name, run in [("sync", invoice_supabase_sync.main), ("async", async_sync.main)]:
+        postgrest.tables.clear()
+        postgrest.tables["products"] = {
+            p["id"]: {"product_id": p["id"], "product_code": p["code"], "name": p["name"]}
+            for p in daftra.products
+        }
+        daftra.reset_counts()
+        postgrest.reset_counts()
+
+        start = time.perf_counter()
+        stats = run()
+        elapsed = time.perf_counter() - start
+
+        results.append((name, elapsed, stats['invoices_saved'], stats['items_saved'],
+                        daftra.total_requests, postgrest.total_requests))
+
+    print(f"{'engine':<8}{'seconds':>10}{'invoices':>10}{'items':>8}{'inv/s':>10}{'daftra req':>12}{'db req':>8}")
+    for name, elapsed, invoices, items, daftra_requests, db_requests in results:
+        print(f"{name:<8}{elapsed:>10.2f}{invoices:>10}{items:>8}{invoices / elapsed:>10.1f}"
+              f"{daftra_requests:>12}{db_requests:>8}")
+
+    daftra.stop()
+    postgrest.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+تكلفة CPU والبايتات على الشبكة لكل 1000 صف حسب مرمز JSON (json / orjson) وضغط gzip،
+على خوادم محلية: كتابة بنود فواتير في PostgREST وقراءة قوائم فواتير دفترة.
+
+    python benchmarks/bench_json.py --rows 20000
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_servers import MockDaftra, MockPostgrest
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=20000, help="عدد البنود المكتوبة")
+    parser.add_argument("--invoices", type=int, default=5000, help="عدد الفواتير المقروءة من القوائم")
+    args = parser.parse_args()
+
+    daftra = MockDaftra().seed(invoices=args.invoices, items_per_invoice=1, products=2000, clients=500).start()
+    postgrest = MockPostgrest().start()
+
+    # المتغيرات تُقرأ عند الاستيراد، فلازم تتحدد قبل استيراد وحدات المزامنة
+    workdir = tempfile.mkdtemp(prefix="daftra-bench-")
+    os.chdir(workdir)
+    os.environ.update({
+        "DAFTRA_URL": daftra.url,
+        "DAFTRA_APIKEY": "bench",
+        "SUPABASE_URL": postgrest.url,
+        "SUPABASE_KEY": "bench",
+        "CHANGE_DETECTION": "false",
+        "SAVE_FAILED_RECORDS": "false",
+        "UPSERT_BATCH_INITIAL": "500",
+    })
+
+    import json_codec
+    from invoice_supabase_sync import DaftraClient, DataValidator, SupabaseClient
+
+    logging.disable(logging.WARNING)
+
+    names = [f"Client {n % 500}" for n in range(args.rows)]
+    items = [
+        DataValidator.clean_item_data(
+            {"id": n, "product_id": n % 2000 + 1, "item": f"C{n % 2000 + 1}", "quantity": n % 5 + 1,
+             "unit_price": 12.5 + n % 90}, str(n // 3 + 1), names[n])
+        for n in range(args.rows)
+    ]
+    supabase = SupabaseClient()
+    daftra_client = DaftraClient()
+
+    codecs = ["json"] + (["orjson"] if json_codec.orjson is not None else [])
+    results = []
+    for codec in codecs:
+        for compress in (False, True):
+            json_codec._fast = codec == "orjson"
+            json_codec.HTTP_GZIP_REQUESTS = compress
+            postgrest.compress = compress
+            daftra.compress = compress
+
+            postgrest.tables.clear()
+            postgrest.reset_counts()
+            cpu = time.thread_time()
+            saved, failed = supabase.upsert_batch("invoice_items", items, force=True)
+            write_cpu = time.thread_time() - cpu
+            assert saved == len(items) and failed == 0, (saved, failed)
+
+            daftra.reset_counts()
+            read = 0
+            cpu = time.thread_time()
+            page = 1
+            while True:
+                response = daftra_client.fetch_invoices(2, page, limit=500)
+                read += len(response.get("data") or [])
+                if page >= response["pagination"]["page_count"]:
+                    break
+                page += 1
+            read_cpu = time.thread_time() - cpu
+
+            results.append((codec, compress, write_cpu, postgrest.bytes_in, read_cpu, daftra.bytes_out, read))
+
+    print(f"per 1000 rows ({args.rows} written, {results[0][6]} read)")
+    print(f"{'codec':<8}{'gzip':>6}{'write cpu ms':>14}{'write KB':>10}{'read cpu ms':>13}{'read KB':>10}")
+    for codec, compress, write_cpu, bytes_in, read_cpu, bytes_out, read in results:
+        print(f"{codec:<8}{'on' if compress else 'off':>6}{write_cpu * 1e6 / args.rows:>14.1f}"
+              f"{bytes_in / 1.024 / args.rows:>10.1f}{read_cpu * 1e6 / read:>13.1f}"
+              f"{bytes_out / 1.024 / read:>10.1f}")
+
+    daftra.stop()
+    postgrest.stop()
+
+
+if __name__ == "__main__":
+    main()
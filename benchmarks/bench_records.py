@@ -0,0 +1,165 @@
+"""
+مقارنة الذاكرة وسرعة التنظيف بين الصفوف كـ dict (الطريقة القديمة) والسجلات ذات __slots__.
+كل وضع يعمل في عملية منفصلة حتى تكون ذروة RSS خاصة به.
+
+    python benchmarks/bench_records.py --invoices 100000 --items-per-invoice 3
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def raw_data(invoices: int, items_per_invoice: int, clients: int):
+    """استجابات دفترة اصطناعية؛ تمر عبر json.loads حتى تكون كل النصوص كائنات مستقلة مثل الواقع"""
+    rng = random.Random(7)
+    cities = ["Riyadh", "Jeddah", "Dammam", "Mecca", "Medina"]
+    payload = []
+    for n in range(1, invoices + 1):
+        client = rng.randint(1, clients)
+        payload.append({
+            'id': n, 'no': f"INV-{n}", 'date': "2025-01-%02d" % rng.randint(1, 28),
+            'client_id': client, 'summary_total': round(rng.uniform(10, 900), 2), 'store_id': 1,
+            'client_business_name': f"Client {client}", 'client_city': cities[client % len(cities)],
+            'summary_paid': 0, 'summary_unpaid': 0, 'staff_id': client % 20, 'staff_name': f"Staff {client % 20}",
+            'InvoiceItem': [
+                {'id': n * 100 + i, 'product_id': rng.randint(1, 2000), 'item': "CODE",
+                 'quantity': rng.randint(1, 5), 'unit_price': round(rng.uniform(1, 200), 2)}
+                for i in range(items_per_invoice)
+            ],
+        })
+    return json.loads(json.dumps(payload))
+
+
+def clean_dict_invoice(invoice):
+    """نسخة من التنظيف القديم بـ dict لكل صف، للمقارنة فقط"""
+    from invoice_supabase_sync import DataValidator
+    return {
+        'id': str(invoice.get('id', '')),
+        "invoice_id": str(invoice.get("id", "")),
+        'invoice_no': str(invoice.get('no', '')),
+        'invoice_date': DataValidator.format_date(invoice.get('date')),
+        'customer_id': str(invoice.get('client_id', '')),
+        'summary_total': float(invoice.get('summary_total', 0)),
+        'branch': int(invoice.get('store_id', 0)),
+        'client_business_name': str(invoice.get('client_business_name', ''))[:255],
+        'client_city': str(invoice.get('client_city', ''))[:100],
+        'summary_paid': float(invoice.get('summary_paid', 0)),
+        'summary_unpaid': float(invoice.get('summary_unpaid', 0)),
+        'staff_id': int(invoice.get('staff_id', 0)),
+        'staff_name': str(invoice.get('staff_name', ''))[:255],
+        'created_at': datetime.now().isoformat(),
+        'updated_at': datetime.now().isoformat(),
+    }
+
+
+def clean_dict_item(item, invoice_id, client_name):
+    return {
+        'id': str(item.get('id', '')),
+        'invoice_id': str(invoice_id),
+        'quantity': float(item.get('quantity', 0)),
+        'unit_price': float(item.get('unit_price', 0)),
+        'subtotal': float(item.get('unit_price', 0)) * float(item.get('quantity', 0)),
+        'product_id': str(item.get('product_id', '')),
+        'product_code': str(item.get('item', ''))[:50],
+        'client_business_name': str(client_name)[:255],
+        'created_at': datetime.now().isoformat(),
+        'updated_at': datetime.now().isoformat(),
+    }
+
+
+def clean_all(mode: str, raw):
+    from invoice_supabase_sync import DataValidator
+    invoices, items = [], []
+    for invoice in raw:
+        if mode == "dict":
+            invoices.append(clean_dict_invoice(invoice))
+            for item in invoice['InvoiceItem']:
+                items.append(clean_dict_item(item, invoice['id'], invoice['client_business_name']))
+        else:
+            invoices.append(DataValidator.clean_invoice_data(invoice))
+            for item in invoice['InvoiceItem']:
+                items.append(DataValidator.clean_item_data(item, str(invoice['id']), invoice['client_business_name']))
+    return invoices, items
+
+
+def encode(mode: str, rows, batch: int) -> int:
+    from records import encode_rows
+    size = 0
+    for start in range(0, len(rows), batch):
+        chunk = rows[start:start + batch]
+        size += len(json.dumps(chunk).encode() if mode == "dict" else encode_rows(chunk))
+    return size
+
+
+def run_mode(args) -> None:
+    logging.disable(logging.INFO)
+    raw = raw_data(args.invoices, args.items_per_invoice, args.clients)
+    # تحميل الوحدات قبل القياس
+    clean_all(args.mode, raw[:1])
+
+    start = time.perf_counter()
+    invoices, items = clean_all(args.mode, raw)
+    clean_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    encoded = encode(args.mode, invoices, args.batch) + encode(args.mode, items, args.batch)
+    encode_seconds = time.perf_counter() - start
+
+    del invoices, items
+    tracemalloc.start()
+    invoices, items = clean_all(args.mode, raw)
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(json.dumps({
+        'rows': len(invoices) + len(items),
+        'clean_seconds': clean_seconds,
+        'encode_seconds': encode_seconds,
+        'encoded_bytes': encoded,
+        'retained_bytes': retained,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--invoices", type=int, default=100000)
+    parser.add_argument("--items-per-invoice", type=int, default=3)
+    parser.add_argument("--clients", type=int, default=2000)
+    parser.add_argument("--batch", type=int, default=500, help="حجم دفعة الترميز")
+    parser.add_argument("--mode", choices=["dict", "records"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        run_mode(args)
+        return
+
+    results = {}
+    for mode in ("dict", "records"):
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--mode", mode, "--invoices", str(args.invoices),
+             "--items-per-invoice", str(args.items_per_invoice), "--clients", str(args.clients),
+             "--batch", str(args.batch)],
+            capture_output=True, text=True, check=True,
+        ).stdout
+        results[mode] = json.loads(output.strip().splitlines()[-1])
+
+    print(f"{'rows':<8}{'clean s':>10}{'rows/s':>12}{'encode s':>10}{'body MB':>10}{'rows MB':>10}{'peak RSS MB':>13}")
+    for mode, r in results.items():
+        print(f"{mode:<8}{r['clean_seconds']:>10.2f}{r['rows'] / r['clean_seconds']:>12.0f}"
+              f"{r['encode_seconds']:>10.2f}{r['encoded_bytes'] / 2**20:>10.1f}"
+              f"{r['retained_bytes'] / 2**20:>10.1f}{r['peak_rss_kb'] / 1024:>13.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""
+قياس أداء مراحل المزامنة من البداية للنهاية على خوادم محلية بديلة لدفترة و PostgREST.
+
+المراحل: sync_products -> main الفواتير -> fetch_missing_items -> مزامنة العملاء.
+لكل مرحلة: الزمن، السجلات في الثانية، عدد الطلبات لكل endpoint، وأعلى استهلاك ذاكرة (RSS).
+
+    python benchmarks/bench_sync.py --invoices 1000 --latency 0.03 --rate-limit 40 --output bench.json
+    python benchmarks/bench_sync.py --invoices 1000 --baseline bench.json   # مقارنة مع قياس سابق
+"""
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_servers import MockDaftra, MockPostgrest
+
+
+def peak_rss_mb() -> float:
+    """أعلى RSS للعملية حتى الآن (ru_maxrss بالكيلوبايت على لينكس وبالبايت على macOS)"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--invoices", type=int, default=1000)
+    parser.add_argument("--items-per-invoice", type=int, default=3)
+    parser.add_argument("--products", type=int, default=2000)
+    parser.add_argument("--clients", type=int, default=500)
+    parser.add_argument("--staff", type=int, default=20)
+    parser.add_argument("--branches", default="2,1", help="أرقام الفروع مفصولة بفواصل")
+    parser.add_argument("--missing", type=float, default=0.1, help="نسبة الفواتير التي تُحذف بنودها قبل مرحلة البنود المفقودة")
+    parser.add_argument("--latency", type=float, default=0.02, help="زمن استجابة دفترة بالثواني")
+    parser.add_argument("--db-latency", type=float, default=0.01, help="زمن استجابة PostgREST بالثواني")
+    parser.add_argument("--rate-limit", type=float, default=0, help="حد طلبات دفترة في الثانية قبل 429 (0 = بدون حد)")
+    parser.add_argument("--db-rate-limit", type=float, default=0)
+    parser.add_argument("--max-limit", type=int, default=0, help="أقصى limit تقبله قوائم دفترة (0 = بدون حد)")
+    parser.add_argument("--incremental", action="store_true", help="إبقاء التزامن التزايدي وكشف التغيير مفعّلين")
+    parser.add_argument("--output", help="حفظ النتائج JSON")
+    parser.add_argument("--baseline", help="ملف JSON سابق للمقارنة")
+    parser.add_argument("--verbose", action="store_true", help="إظهار سجلات ومخرجات المزامنة")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    # المسارات نسبة لمكان التشغيل قبل الانتقال لمجلد العمل المؤقت
+    args.output = os.path.abspath(args.output) if args.output else None
+    args.baseline = os.path.abspath(args.baseline) if args.baseline else None
+    branches = tuple(int(b) for b in args.branches.split(",") if b.strip())
+
+    daftra = MockDaftra(latency=args.latency, rate_limit=args.rate_limit, max_limit=args.max_limit).seed(
+        invoices=args.invoices, items_per_invoice=args.items_per_invoice, products=args.products,
+        clients=args.clients, staff=args.staff, branches=branches).start()
+    postgrest = MockPostgrest(latency=args.db_latency, rate_limit=args.db_rate_limit).start()
+
+    # المتغيرات تُقرأ عند الاستيراد، فلازم تتحدد قبل استيراد وحدات المزامنة
+    workdir = tempfile.mkdtemp(prefix="daftra-bench-")
+    os.chdir(workdir)
+    os.environ.update({
+        "DAFTRA_URL": daftra.url,
+        "DAFTRA_APIKEY": "bench",
+        "SUPABASE_URL": postgrest.url,
+        "SUPABASE_KEY": "bench",
+        "BRANCH_IDS": args.branches,
+    })
+    if not args.incremental:
+        os.environ.update({"INCREMENTAL_SYNC": "false", "CHANGE_DETECTION": "false"})
+
+    import products_service
+    import invoice_supabase_sync
+    import customers_sync
+
+    if not args.verbose:
+        logging.disable(logging.WARNING)
+
+    def drop_items():
+        """حذف بنود جزء من الفواتير لتشغيل مرحلة البنود المفقودة على حالة حقيقية"""
+        step = max(1, round(1 / args.missing)) if args.missing > 0 else 0
+        if not step:
+            return
+        dropped = {str(inv["id"]) for inv in daftra.invoices[::step]}
+        items = postgrest.tables.get("invoice_items", {})
+        for key in [k for k, row in items.items() if str(row.get("invoice_id")) in dropped]:
+            del items[key]
+
+    def run_missing_items():
+        drop_items()
+        return invoice_supabase_sync.fetch_missing_items(invoice_supabase_sync.DaftraClient(),
+                                                         invoice_supabase_sync.SupabaseClient())
+
+    stages = [
+        ("products", products_service.sync_products, lambda r: r["synced"]),
+        ("invoices", invoice_supabase_sync.main, lambda r: r["invoices_saved"] + r["items_saved"]),
+        ("missing_items", run_missing_items, lambda r: r["items_saved"]),
+        ("customers", customers_sync.main, lambda r: r["customers_saved"]),
+    ]
+
+    results = []
+    for name, run, count in stages:
+        daftra.reset_counts()
+        postgrest.reset_counts()
+        output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+
+        start = time.perf_counter()
+        with output:
+            stats = run()
+        elapsed = time.perf_counter() - start
+
+        records = count(stats)
+        results.append({
+            "stage": name,
+            "seconds": round(elapsed, 3),
+            "records": records,
+            "records_per_second": round(records / elapsed, 1) if elapsed else 0.0,
+            "daftra_requests": daftra.total_requests,
+            "db_requests": postgrest.total_requests,
+            "throttled": daftra.throttled + postgrest.throttled,
+            "peak_rss_mb": peak_rss_mb(),
+            "requests": {**daftra.requests, **postgrest.requests},
+        })
+
+    daftra.stop()
+    postgrest.stop()
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = {row["stage"]: row for row in json.load(f)["results"]}
+
+    print(f"{'stage':<15}{'seconds':>9}{'records':>9}{'rec/s':>9}{'daftra':>8}{'db':>6}{'429':>6}{'rss MB':>8}{'vs base':>9}")
+    for row in results:
+        base = baseline.get(row["stage"])
+        delta = ""
+        if base and base["records_per_second"]:
+            delta = f"{(row['records_per_second'] / base['records_per_second'] - 1):+.0%}"
+        print(f"{row['stage']:<15}{row['seconds']:>9.2f}{row['records']:>9}{row['records_per_second']:>9.1f}"
+              f"{row['daftra_requests']:>8}{row['db_requests']:>6}{row['throttled']:>6}{row['peak_rss_mb']:>8.1f}{delta:>9}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"created_at": datetime.now().isoformat(), "config": vars(args), "results": results},
+                      f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,332 @@
+"""
+خوادم محلية بديلة لدفترة و PostgREST لقياس أداء المزامنة بدون لمس البيانات الحقيقية.
+
+    daftra = MockDaftra(latency=0.02, rate_limit=30).seed(invoices=500).start()
+    postgrest = MockPostgrest(latency=0.01).start()
+    os.environ["DAFTRA_URL"] = daftra.url
+    os.environ["SUPABASE_URL"] = postgrest.url
+"""
+import gzip
+import json
+import re
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Set, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _dispatch(self, method: str):
+        server = self.server.owner
+        parts = urlsplit(self.path)
+        query = parse_qsl(parts.query, keep_blank_values=True)
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        gzipped = self.headers.get("Content-Encoding") == "gzip"
+
+        server.count(method, parts.path, len(raw))
+        if server.latency:
+            time.sleep(server.latency)
+
+        if gzipped and not server.gzip_requests:
+            status, payload, headers = 415, {"message": "Unsupported Content-Encoding"}, {}
+        elif server.over_limit():
+            status, payload, headers = 429, {"message": "Too Many Requests"}, {"Retry-After": "1"}
+        else:
+            body = json.loads(gzip.decompress(raw) if gzipped else raw) if raw else None
+            status, payload, headers = server.handle(method, parts.path, query, body, self.headers)
+        data = b"" if payload is None else json.dumps(payload).encode()
+        headers = dict(headers or {})
+        if server.compress and len(data) >= 1024 and "gzip" in (self.headers.get("Accept-Encoding") or ""):
+            data = gzip.compress(data, compresslevel=6)
+            headers["Content-Encoding"] = "gzip"
+        with server.lock:
+            server.bytes_out += len(data)
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def do_PATCH(self):
+        self._dispatch("PATCH")
+
+
+class _MockServer:
+    def __init__(self, latency: float = 0.0, rate_limit: float = 0.0):
+        self.latency = latency
+        # أقصى عدد طلبات في أي ثانية قبل الرد بـ 429 (0 = بدون حد)
+        self.rate_limit = rate_limit
+        self.recent: deque = deque()
+        self.throttled = 0
+        self.requests: Dict[str, int] = {}
+        # ضغط الاستجابات إذا طلبها العميل، وقبول أجسام الطلبات المضغوطة (وإلا 415 مثل PostgREST المباشر)
+        self.compress = True
+        self.gzip_requests = True
+        # البايتات الفعلية على الشبكة (بعد الضغط)
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.lock = threading.Lock()
+        self.httpd: Optional[ThreadingHTTPServer] = None
+
+    def over_limit(self) -> bool:
+        if not self.rate_limit:
+            return False
+        now = time.monotonic()
+        with self.lock:
+            while self.recent and now - self.recent[0] > 1:
+                self.recent.popleft()
+            if len(self.recent) >= self.rate_limit:
+                self.throttled += 1
+                return True
+            self.recent.append(now)
+            return False
+
+    def count(self, method: str, path: str, size: int = 0) -> None:
+        key = method + " " + re.sub(r"/\d+$", "/{id}", path)
+        with self.lock:
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self.bytes_in += size
+
+    @property
+    def total_requests(self) -> int:
+        return sum(self.requests.values())
+
+    def reset_counts(self) -> None:
+        with self.lock:
+            self.requests.clear()
+            self.throttled = 0
+            self.bytes_in = 0
+            self.bytes_out = 0
+
+    def start(self):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.owner = self
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address
+        return f"http://{host}:{port}"
+
+    def handle(self, method, path, query, body, headers):
+        raise NotImplementedError
+
+
+class MockDaftra(_MockServer):
+    """يحاكي entity/invoice/list/1 و entity/invoice/{id} و entity/product/list/1 و entity/client/list و api2/staff"""
+
+    def __init__(self, latency: float = 0.0, rate_limit: float = 0.0, max_limit: int = 0):
+        super().__init__(latency, rate_limit)
+        # أقصى limit يقبله الخادم؛ الأكبر منه يُقص ويظهر الحد الفعلي في pagination.limit (0 = بدون حد)
+        self.max_limit = max_limit
+        self.invoices: List[Dict[str, Any]] = []
+        self.products: List[Dict[str, Any]] = []
+        self.clients: List[Dict[str, Any]] = []
+        self.staff: List[Dict[str, Any]] = []
+        self._invoices_by_id: Dict[str, Dict[str, Any]] = {}
+
+    def seed(self, invoices: int = 200, items_per_invoice: int = 3, products: int = 500,
+             clients: int = 100, staff: int = 10, branches=(2, 1)):
+        modified = "2025-01-01 00:00:00"
+        self.products = [
+            {"id": i, "code": f"C{i}", "name": f"Product {i}", "stock_balance": 10,
+             "buy_price": 5, "average_price": 6, "minimum_price": 4, "supplier_code": "", "modified": modified}
+            for i in range(1, products + 1)
+        ]
+        self.clients = [
+            {"id": i, "code": str(i), "name": f"Client {i}", "phone": "", "city": "Riyadh", "modified": modified}
+            for i in range(1, clients + 1)
+        ]
+        self.staff = [{"id": i, "name": f"Staff {i}"} for i in range(1, staff + 1)]
+        self.invoices = []
+        for i in range(1, invoices + 1):
+            client_id = i % clients + 1
+            self.invoices.append({
+                "id": i, "no": str(i), "date": "2025-01-02", "client_id": client_id,
+                "client_business_name": f"Client {client_id}", "client_city": "Riyadh",
+                "store_id": branches[i % len(branches)], "staff_id": i % staff + 1,
+                "summary_total": 30.0, "summary_paid": 30.0, "summary_unpaid": 0.0, "modified": modified,
+                "items": [
+                    {"id": i * 100 + k, "product_id": (i * 7 + k) % products + 1, "item": "WRONG",
+                     "quantity": 2, "unit_price": 5}
+                    for k in range(items_per_invoice)
+                ],
+            })
+        return self.reindex()
+
+    def reindex(self):
+        """يُستدعى بعد تعديل self.invoices يدويًا"""
+        self._invoices_by_id = {str(inv["id"]): inv for inv in self.invoices}
+        return self
+
+    def _page(self, rows, query):
+        page = int(query.get("page", 1))
+        limit = int(query.get("limit", 20))
+        if self.max_limit:
+            limit = min(limit, self.max_limit)
+        since = query.get("filter[modified][gte]")
+        if since:
+            rows = [row for row in rows if row[1].get("modified", "") >= since]
+        if query.get("sort[id]") == "desc":
+            rows = sorted(rows, key=lambda row: -int(row[1]["id"]))
+        page_count = -(-len(rows) // limit) if limit else 0
+        return {
+            "data": [row[0] for row in rows[(page - 1) * limit: page * limit]],
+            "pagination": {"page": page, "page_count": page_count, "total_results": len(rows), "limit": limit},
+        }
+
+    def handle(self, method, path, query, body, headers):
+        query = dict(query)
+        if path.endswith("/entity/invoice/list/1"):
+            branch = query.get("filter[branch_id]")
+            rows = [({"Invoice": self._summary(inv)}, inv) for inv in self.invoices
+                    if branch is None or str(inv["store_id"]) == str(branch)]
+            return 200, self._page(rows, query), None
+        match = re.search(r"/entity/invoice/(\d+)$", path)
+        if match:
+            invoice = self._invoices_by_id.get(match.group(1))
+            if invoice is None:
+                return 404, {"message": "not found"}, None
+            return 200, {"Invoice": self._summary(invoice), "invoice_item": invoice["items"]}, None
+        if path.endswith("/entity/product/list/1"):
+            return 200, self._page([({"Product": p}, p) for p in self.products], query), None
+        if path.endswith("/entity/client/list"):
+            return 200, self._page([(c, c) for c in self.clients], query), None
+        if path.endswith("/api2/staff"):
+            return 200, self._page([({"Staff": s}, s) for s in self.staff], query), None
+        return 404, {"message": "not found"}, None
+
+    @staticmethod
+    def _summary(invoice):
+        return {key: value for key, value in invoice.items() if key != "items"}
+
+
+def _cast(value: str, sample: Any) -> Any:
+    if isinstance(sample, (int, float)) and not isinstance(sample, bool):
+        try:
+            return type(sample)(value)
+        except ValueError:
+            return value
+    return value
+
+
+def _matches(row: Dict[str, Any], column: str, expression: str) -> bool:
+    negate = expression.startswith("not.")
+    if negate:
+        expression = expression[4:]
+    op, _, value = expression.partition(".")
+    current = row.get(column)
+    if op == "in":
+        result = str(current) in [v.strip('"') for v in value.strip("()").split(",")]
+    elif op == "is":
+        result = current is None if value == "null" else str(current).lower() == value
+    elif current is None:
+        result = False
+    elif op == "eq":
+        result = str(current) == value
+    elif op == "gt":
+        result = current > _cast(value, current)
+    elif op == "gte":
+        result = current >= _cast(value, current)
+    elif op == "lt":
+        result = current < _cast(value, current)
+    else:
+        result = True
+    return not result if negate else result
+
+
+class MockPostgrest(_MockServer):
+    """يحاكي select و upsert (on_conflict) و patch لجداول PostgREST في الذاكرة، مع Content-Range و db-max-rows"""
+
+    PRIMARY_KEYS = {"products": "product_id"}
+
+    def __init__(self, latency: float = 0.0, rate_limit: float = 0.0, max_rows: int = 0):
+        super().__init__(latency, rate_limit)
+        # مثل db-max-rows: قص أي select بصمت لهذا العدد (0 = بدون حد)
+        self.max_rows = max_rows
+        self.tables: Dict[str, Dict[Any, Dict[str, Any]]] = {}
+        # (جدول، مفتاح) لصفوف "سيئة": أي دفعة تحتويها تُرفض كلها بـ 400 مثل قيد في قاعدة البيانات
+        self.reject: Set[Tuple[str, str]] = set()
+
+    def rows(self, table: str) -> List[Dict[str, Any]]:
+        return list(self.tables.get(table, {}).values())
+
+    def handle(self, method, path, query, body, headers):
+        if not path.startswith("/rest/v1/"):
+            return 404, {"message": "not found"}, None
+        table_name = path[len("/rest/v1/"):]
+        with self.lock:
+            table = self.tables.setdefault(table_name, {})
+            params = dict(query)
+            key = params.get("on_conflict", self.PRIMARY_KEYS.get(table_name, "id")).split(",")[0]
+
+            if method == "POST":
+                batch = body if isinstance(body, list) else [body]
+                bad = [row.get(key) for row in batch if (table_name, str(row.get(key))) in self.reject]
+                if bad:
+                    return 400, {"code": "23514", "message": f"rejected rows {bad}"}, None
+                for row in batch:
+                    existing = table.get(row.get(key))
+                    if existing is None:
+                        table[row.get(key)] = dict(row)
+                    elif "ignore-duplicates" not in headers.get("Prefer", ""):
+                        existing.update(row)
+                return 201, None, None
+
+            rows = list(table.values())
+            select, order, limit, offset = None, None, None, 0
+            for column, expression in query:
+                if column == "select":
+                    select = expression.split(",")
+                elif column == "order":
+                    order = expression
+                elif column == "limit":
+                    limit = int(expression)
+                elif column == "offset":
+                    offset = int(expression)
+                elif column != "on_conflict":
+                    rows = [row for row in rows if _matches(row, column, expression)]
+
+            if method == "PATCH":
+                for row in rows:
+                    row.update(body)
+                return 204, None, None
+
+            if order:
+                column, _, direction = order.partition(".")
+                rows.sort(key=lambda row: (row.get(column) is None, row.get(column)),
+                          reverse=direction.startswith("desc"))
+            total = len(rows)
+            rows = rows[offset:]
+            if limit is not None:
+                rows = rows[:limit]
+            if self.max_rows:
+                rows = rows[:self.max_rows]
+            if select and select != ["*"]:
+                rows = [{column: row.get(column) for column in select} for row in rows]
+            counted = "count=exact" in headers.get("Prefer", "")
+            span = f"{offset}-{offset + len(rows) - 1}" if rows else "*"
+            return 200, rows, {"Content-Range": f"{span}/{total if counted else '*'}"}
@@ -0,0 +1,168 @@
+import os
+import sqlite3
+import logging
+import threading
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional
+
+from sync_utils import SYNC_STATE_DB
+
+logger = logging.getLogger(__name__)
+
+# حساب إجماليات العملاء من الفواتير أثناء مزامنتها بدل حقول قائمة العملاء (غالبًا أصفار)
+CUSTOMER_ANALYTICS = os.getenv("CUSTOMER_ANALYTICS", "true").lower() == "true"
+
+ANALYTICS_FIELDS = ('total_spent', 'total_invoices', 'max_order_value', 'average_order_value',
+                    'last_order_date', 'order_frequency_days')
+
+
+class CustomerAnalytics:
+    """
+    مساهمة كل فاتورة (client_id، الإجمالي، التاريخ) في sqlite محلي بمفتاح invoice_id.
+    إعادة معالجة نفس الفاتورة تستبدل مساهمتها بدل جمعها مرتين، فالإجماليات صحيحة
+    مع التزامن التزايدي وإعادة التشغيل. الإجماليات تُحسب بـ GROUP BY عند رفع العملاء.
+    """
+
+    CHUNK = 500
+
+    def __init__(self, path: str = SYNC_STATE_DB):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS customer_invoices ("
+            " invoice_id TEXT PRIMARY KEY, client_id TEXT NOT NULL, total REAL NOT NULL,"
+            " invoice_date TEXT) WITHOUT ROWID"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS customer_invoices_client ON customer_invoices (client_id)")
+        # العملاء الذين تغيرت مساهمات فواتيرهم ولم تُرفع إجمالياتهم بعد
+        self.conn.execute("CREATE TABLE IF NOT EXISTS customer_pending (client_id TEXT PRIMARY KEY) WITHOUT ROWID")
+        # علامة اكتمال التهيئة من فواتير Supabase؛ في نفس ملف المساهمات حتى تختفي معها لو حُذف
+        self.conn.execute("CREATE TABLE IF NOT EXISTS customer_analytics_state (key TEXT PRIMARY KEY, value TEXT)")
+        self.conn.commit()
+
+    def record(self, invoices: Iterable[Dict[str, Any]]) -> int:
+        """تسجيل فواتير نظيفة (من clean_invoice_data أو صفوف جدول invoices)؛ يرجع عدد المساهمات المتغيرة"""
+        rows = {}
+        for invoice in invoices:
+            client_id = str(invoice.get('customer_id') or '')
+            if not invoice.get('id') or client_id in ('', '0'):
+                continue
+            try:
+                total = float(invoice.get('summary_total') or 0)
+            except (TypeError, ValueError):
+                continue
+            rows[str(invoice['id'])] = (client_id, total, invoice.get('invoice_date'))
+        if not rows:
+            return 0
+
+        with self.lock:
+            ids = list(rows)
+            stored = {}
+            for start in range(0, len(ids), self.CHUNK):
+                chunk = ids[start:start + self.CHUNK]
+                placeholders = ",".join("?" * len(chunk))
+                for invoice_id, client_id, total, invoice_date in self.conn.execute(
+                    "SELECT invoice_id, client_id, total, invoice_date FROM customer_invoices"
+                    f" WHERE invoice_id IN ({placeholders})", chunk
+                ):
+                    stored[invoice_id] = (client_id, total, invoice_date)
+
+            # الفاتورة التي لم تتغير لا تغير شيئًا؛ المنقولة لعميل آخر تغير العميلين
+            changed = [(invoice_id, *values) for invoice_id, values in rows.items() if stored.get(invoice_id) != values]
+            pending = {client_id for _, client_id, _, _ in changed}
+            pending.update(stored[invoice_id][0] for invoice_id, _, _, _ in changed if invoice_id in stored)
+            if changed:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO customer_invoices (invoice_id, client_id, total, invoice_date)"
+                    " VALUES (?, ?, ?, ?)", changed
+                )
+                self.conn.executemany("INSERT OR IGNORE INTO customer_pending (client_id) VALUES (?)",
+                                      [(client_id,) for client_id in pending])
+                self.conn.commit()
+            return len(changed)
+
+    def is_seeded(self) -> bool:
+        """
+        هل قُرئت كل الفواتير المحفوظة مرة واحدة؟ لا يكفي أن المخزن غير فارغ: مرحلة الفواتير
+        تسجل ما تزامنه فقط (تزايدي أو بعد حذف sync_state.db) فيبقى المخزن جزئيًا.
+        """
+        with self.lock:
+            return self.conn.execute(
+                "SELECT 1 FROM customer_analytics_state WHERE key = 'seeded_at'"
+            ).fetchone() is not None
+
+    def seed(self, invoices: Iterable[Dict[str, Any]]) -> int:
+        """تسجيل كل الفواتير المحفوظة ثم وضع العلامة؛ القراءة الناقصة ترفع استثناء بدون علامة"""
+        recorded = self.record(invoices)
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO customer_analytics_state (key, value) VALUES ('seeded_at', ?)",
+                              (datetime.now().isoformat(),))
+            self.conn.commit()
+        return recorded
+
+    def aggregates(self, client_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """الحقول المحسوبة لكل عميل له فواتير، باستعلام واحد لكل CHUNK عميل"""
+        result = {}
+        with self.lock:
+            for start in range(0, len(client_ids), self.CHUNK):
+                chunk = client_ids[start:start + self.CHUNK]
+                placeholders = ",".join("?" * len(chunk))
+                for client_id, total, count, largest, first, last in self.conn.execute(
+                    "SELECT client_id, SUM(total), COUNT(*), MAX(total), MIN(invoice_date), MAX(invoice_date)"
+                    f" FROM customer_invoices WHERE client_id IN ({placeholders}) GROUP BY client_id",
+                    chunk
+                ):
+                    result[client_id] = {
+                        'total_spent': round(total, 2),
+                        'total_invoices': count,
+                        'max_order_value': largest,
+                        'average_order_value': round(total / count, 2) if count else 0.0,
+                        'last_order_date': last,
+                        'order_frequency_days': _frequency_days(first, last, count),
+                    }
+        return result
+
+    def merge(self, customers: List[Dict[str, Any]]) -> None:
+        """استبدال الحقول المحسوبة في صفوف العملاء النظيفة"""
+        totals = self.aggregates([str(c['id']) for c in customers])
+        for customer in customers:
+            values = totals.get(str(customer['id']))
+            if values:
+                customer.update(values)
+
+    def pending_clients(self) -> List[str]:
+        """العملاء الذين تغيرت فواتيرهم منذ آخر رفع لإجمالياتهم"""
+        with self.lock:
+            return [row[0] for row in self.conn.execute("SELECT client_id FROM customer_pending")]
+
+    def mark_synced(self, client_ids: List[str]) -> None:
+        with self.lock:
+            self.conn.executemany("DELETE FROM customer_pending WHERE client_id = ?",
+                                  [(client_id,) for client_id in client_ids])
+            self.conn.commit()
+
+
+def _frequency_days(first: Optional[str], last: Optional[str], count: int) -> int:
+    """متوسط الأيام بين الطلبات"""
+    if count < 2 or not first or not last:
+        return 0
+    try:
+        span = datetime.fromisoformat(last) - datetime.fromisoformat(first)
+    except ValueError:
+        return 0
+    return int(span.days / (count - 1))
+
+
+_analytics: Optional[CustomerAnalytics] = None
+_analytics_lock = threading.Lock()
+
+
+def get_customer_analytics() -> Optional[CustomerAnalytics]:
+    """المخزن المشترك، أو None إذا كانت الميزة معطلة"""
+    global _analytics
+    if not CUSTOMER_ANALYTICS:
+        return None
+    with _analytics_lock:
+        if _analytics is None:
+            _analytics = CustomerAnalytics()
+        return _analytics
@@ -1,10 +1,20 @@
 import time
 import requests
 import logging
-import json
 import os
 from datetime import datetime
-from typing import Dict, List, Any, Optional
+from typing import Dict, Iterator, List, Any, Optional
+
+from batching import get_batch_sizer
+from customer_analytics import ANALYTICS_FIELDS, CustomerAnalytics, get_customer_analytics
+from daftra_paginator import DaftraPaginator, list_error
+from http_transport import create_session
+from json_codec import decode_response, dumps, send_body
+from rate_limiter import get_limiter, send
+from records import CustomerRecord, intern, timestamp
+from supabase_reader import iter_keyset
+from supabase_writer import SupabaseWriter
+from sync_utils import Checkpoint, Watermark, get_fingerprint_store
 
 # إعداد التسجيل
 logging.basicConfig(
@@ -50,30 +60,31 @@ class DataValidator:
         return all(field in customer and customer[field] is not None for field in required_fields)
     
     @staticmethod
-    def clean_customer_data(customer: Dict[str, Any]) -> Dict[str, Any]:
+    def clean_customer_data(customer: Dict[str, Any]) -> CustomerRecord:
         """تنظيف وتحويل بيانات العميل - نفس طريقة الفواتير"""
-        cleaned = {
-            'id': str(customer.get('id', '')),
-            'customer_code': str(customer.get('code', '')),
-            'name': str(customer.get('name', ''))[:255],
-            'phone': str(customer.get('phone', ''))[:50],
-            'email': str(customer.get('email', ''))[:255],
-            'gender': str(customer.get('gender', ''))[:10],
-            'birth_date': DataValidator.format_date(customer.get('birth_date')),
-            'city': str(customer.get('city', ''))[:100],
-            'region': str(customer.get('region', ''))[:100],
-            'address': str(customer.get('address', ''))[:500],
-            'total_spent': float(customer.get('total_spent', 0)),
-            'total_invoices': int(customer.get('total_invoices', 0)),
-            'max_order_value': float(customer.get('max_order_value', 0)),
-            'average_order_value': float(customer.get('average_order_value', 0)),
-            'payment_total': float(customer.get('payment_total', 0)),
-            'last_order_date': DataValidator.format_date(customer.get('last_order_date')),
-            'order_frequency_days': int(customer.get('order_frequency_days', 0)),
-            'is_active': bool(customer.get('is_active', True)),
-            'created_at': datetime.now().isoformat(),
-            'updated_at': datetime.now().isoformat()
-        }
+        now = timestamp()
+        cleaned = CustomerRecord(
+            id=str(customer.get('id', '')),
+            customer_code=str(customer.get('code', '')),
+            name=str(customer.get('name', ''))[:255],
+            phone=str(customer.get('phone', ''))[:50],
+            email=str(customer.get('email', ''))[:255],
+            gender=intern(str(customer.get('gender', ''))[:10]),
+            birth_date=DataValidator.format_date(customer.get('birth_date')),
+            city=intern(str(customer.get('city', ''))[:100]),
+            region=intern(str(customer.get('region', ''))[:100]),
+            address=str(customer.get('address', ''))[:500],
+            total_spent=float(customer.get('total_spent', 0)),
+            total_invoices=int(customer.get('total_invoices', 0)),
+            max_order_value=float(customer.get('max_order_value', 0)),
+            average_order_value=float(customer.get('average_order_value', 0)),
+            payment_total=float(customer.get('payment_total', 0)),
+            last_order_date=DataValidator.format_date(customer.get('last_order_date')),
+            order_frequency_days=int(customer.get('order_frequency_days', 0)),
+            is_active=bool(customer.get('is_active', True)),
+            created_at=now,
+            updated_at=now,
+        )
         return cleaned
     
     @staticmethod
@@ -94,53 +105,54 @@ class DataValidator:
         except Exception:
             return None
 
-class SupabaseClient:
-    """عميل محسن للتعامل مع Supabase - نفس طريقة الفواتير"""
+class SupabaseClient(SupabaseWriter):
+    """عميل محسن للتعامل مع Supabase - نفس طريقة الفواتير (الكتابة في SupabaseWriter)"""
     
+    max_retries = MAX_RETRIES
+    retry_delay = RETRY_DELAY
+
     def __init__(self):
         self.base_url = SUPABASE_URL
         self.headers = HEADERS_SUPABASE
-        self.session = requests.Session()
-        self.session.headers.update(self.headers)
+        self.session = create_session(self.headers)
     
-    def upsert_batch(self, table: str, data: List[Dict[str, Any]]) -> tuple[int, int]:
-        """إدراج أو تحديث دفعة من البيانات مع حل مشكلة التكرار"""
-        if not data:
-            return 0, 0
-        
-        url = f"{self.base_url}/{table}?on_conflict=id"
-        
-        upsert_headers = {
-            **self.headers,
-            "Prefer": "resolution=merge-duplicates,return=minimal"
-        }
-        
+    def _get(self, url: str, headers: Optional[Dict[str, str]] = None):
+        return self.session.get(url, headers=headers, timeout=30)
+    
+    def iter_invoice_totals(self) -> Iterator[Dict[str, Any]]:
+        """الفواتير المحفوظة (العميل، الإجمالي، التاريخ) على صفحات، لتهيئة إجماليات العملاء مرة واحدة"""
+        return iter_keyset(self._get, self.base_url, 'invoices', 'id,customer_id,summary_total,invoice_date',
+                           key='id', count='exact')
+    
+    def existing_ids(self, table: str, ids: List[str], chunk_size: int = 200) -> List[str]:
+        """الأرقام الموجودة فعلاً في الجدول من قائمة، بطلب id=in.(...) لكل chunk_size"""
+        found = []
+        for start in range(0, len(ids), chunk_size):
+            id_list = ",".join(ids[start:start + chunk_size])
+            response = self._get(f"{self.base_url}/{table}?id=in.({id_list})&select=id")
+            if response.status_code != 200:
+                raise RuntimeError(f"فشل في قراءة {table}: {response.status_code}")
+            found.extend(str(row['id']) for row in decode_response(response))
+        return found
+
+    def patch_rows(self, table: str, ids: List[str], values: Dict[str, Any]) -> bool:
+        """تحديث أعمدة محددة لصفوف موجودة بطلب PATCH واحد؛ بدون إدراج وبدون بصمات"""
+        url = f"{self.base_url}/{table}?id=in.({','.join(ids)})"
+        body = dumps(values)
         for attempt in range(MAX_RETRIES):
             try:
-                response = self.session.post(url, json=data, headers=upsert_headers, timeout=30)
-                
-                if response.status_code in [200, 201]:
-                    logger.info(f"✅ تم حفظ/تحديث {len(data)} سجل في جدول {table}")
-                    return len(data), 0
-                elif response.status_code == 409:
-                    logger.warning(f"⚠️ بيانات مكررة في {table}، محاولة التحديث...")
-                    update_headers = {
-                        **self.headers,
-                        "Prefer": "resolution=ignore-duplicates,return=minimal"
-                    }
-                    response = self.session.post(url, json=data, headers=update_headers, timeout=30)
-                    if response.status_code in [200, 201]:
-                        logger.info(f"✅ تم تحديث {len(data)} سجل في جدول {table}")
-                        return len(data), 0
-                else:
-                    logger.error(f"❌ خطأ في حفظ {table}: {response.status_code} - {response.text}")
-                    
+                response = send_body(self.session, "PATCH", url, body, self.headers, timeout=30)
+                if response.status_code in (200, 204):
+                    return True
+                logger.error(f"❌ خطأ في تحديث {table} ({len(ids)} صف): {response.status_code} - {response.text[:500]}")
+                if 400 <= response.status_code < 500 and response.status_code not in (408, 429):
+                    return False
             except requests.exceptions.RequestException as e:
                 logger.error(f"❌ خطأ في الاتصال مع Supabase (محاولة {attempt + 1}): {e}")
-                if attempt < MAX_RETRIES - 1:
-                    time.sleep(RETRY_DELAY)
-                    
-        return 0, len(data)
+            if attempt < MAX_RETRIES - 1:
+                time.sleep(RETRY_DELAY)
+        return False
+
 
 class DaftraClient:
     """عميل محسن للتعامل مع API دفترة - نفس طريقة الفواتير"""
@@ -148,33 +160,67 @@ class DaftraClient:
     def __init__(self):
         self.base_url = BASE_URL
         self.headers = HEADERS_DAFTRA
-        self.session = requests.Session()
-        self.session.headers.update(self.headers)
+        self.session = create_session(self.headers)
+        self.limiter = get_limiter(self.base_url)
     
-    def fetch_customers(self, page: int = 1) -> Dict[str, Any]:
+    def fetch_customers(self, page: int = 1, since: Optional[Dict[str, Any]] = None,
+                        limit: int = PAGE_LIMIT) -> Dict[str, Any]:
         """جلب قائمة العملاء - نفس طريقة الفواتير"""
         url = f"{self.base_url}/entity/client/list"  # تغيير هنا فقط
         params = {
             'page': page,
-            'limit': PAGE_LIMIT
+            'limit': limit,
+            **(since or {})
         }
         
-        for attempt in range(MAX_RETRIES):
-            try:
-                response = self.session.get(url, params=params, timeout=30)
-                
-                if response.status_code == 200:
-                    return response.json()
-                else:
-                    logger.error(f"❌ خطأ في جلب العملاء: {response.status_code}")
-                    
-            except requests.exceptions.RequestException as e:
-                logger.error(f"❌ خطأ في الاتصال مع دفترة (محاولة {attempt + 1}): {e}")
-                if attempt < MAX_RETRIES - 1:
-                    time.sleep(RETRY_DELAY)
-                    
+        # نفس ميزانية طلبات دفترة المشتركة مع المنتجات والفواتير
+        response = send(self.session, "GET", url, limiter=self.limiter, params=params, timeout=30)
+        if response is not None and response.status_code == 200:
+            return decode_response(response)
+        if response is not None:
+            logger.error(f"❌ خطأ في جلب العملاء: {response.status_code}")
+            return list_error(response.status_code)
         return {}
 
+def update_pending_analytics(supabase_client: SupabaseClient, analytics: CustomerAnalytics,
+                             stats: Dict[str, int]) -> None:
+    """
+    تحديث الحقول المحسوبة فقط (PATCH) للعملاء الذين تغيرت فواتيرهم ولم يُرفعوا في هذا التشغيل.
+    العميل غير الموجود في customers يبقى معلقًا حتى يصل صفه الكامل من دفترة،
+    لأن upsert جزئي يدرج صفًا ناقصًا ويستبدل بصمة الصف الكامل.
+    """
+    pending = analytics.pending_clients()
+    if not pending:
+        return
+    
+    try:
+        existing = supabase_client.existing_ids('customers', pending)
+    except (RuntimeError, requests.exceptions.RequestException) as e:
+        logger.error(f"❌ خطأ في قراءة العملاء الموجودين: {e}")
+        return
+    
+    totals = analytics.aggregates(existing)
+    now = datetime.now().isoformat()
+    empty = {'total_spent': 0.0, 'total_invoices': 0, 'max_order_value': 0.0, 'average_order_value': 0.0,
+             'last_order_date': None, 'order_frequency_days': 0}
+    # PATCH واحد لكل مجموعة عملاء بنفس القيم (id=in.(...))
+    groups: Dict[tuple, List[str]] = {}
+    for client_id in existing:
+        values = totals.get(client_id, empty)
+        groups.setdefault(tuple(values[field] for field in ANALYTICS_FIELDS), []).append(client_id)
+    
+    updated = 0
+    for values, client_ids in groups.items():
+        for start in range(0, len(client_ids), 200):
+            chunk = client_ids[start:start + 200]
+            if supabase_client.patch_rows('customers', chunk, {**dict(zip(ANALYTICS_FIELDS, values)),
+                                                               'updated_at': now}):
+                analytics.mark_synced(chunk)
+                updated += len(chunk)
+    stats['customers_analytics_updated'] = updated
+    logger.info(f"📈 تحديث إجماليات {updated} عميل من الفواتير الجديدة "
+                f"({len(pending) - len(existing)} غير موجود في customers بعد)")
+
 def process_customers(daftra_client: DaftraClient, supabase_client: SupabaseClient) -> Dict[str, int]:
     """معالجة العملاء - نفس طريقة الفواتير"""
     logger.info("👥 بدء معالجة العملاء")
@@ -185,56 +231,103 @@ def process_customers(daftra_client: DaftraClient, supabase_client: SupabaseClie
         'customers_failed': 0
     }
     
-    page = 1
+    # علامة آخر تزامن ناجح للعملاء
+    watermark = Watermark('customers')
+    if watermark.is_incremental:
+        logger.info(f"🔁 تزامن تزايدي للعملاء منذ {watermark.synced_at}")
+    complete = True
+    
+    # استئناف تشغيل منقطع من آخر صفحة حُفظت
+    checkpoint = Checkpoint('customers', watermark=watermark)
+    since = watermark.list_params()
+    paginator = DaftraPaginator(
+        'client/list',
+        lambda page, limit: daftra_client.fetch_customers(page, since=since, limit=limit),
+        start_page=checkpoint.resume_page, limit=checkpoint.limit,
+    )
     customers_batch = []
     
-    while True:
-        logger.info(f"📄 جلب الصفحة {page} للعملاء...")
-        
-        response_data = daftra_client.fetch_customers(page)
+    analytics = get_customer_analytics()
+    if analytics and not analytics.is_seeded():
+        # أول تشغيل (أو sync_state.db جديد): كل الفواتير المحفوظة في قراءة واحدة، وبعدها تتحدث مع مزامنة الفواتير.
+        # التسجيل يستبدل مساهمة كل فاتورة، فما سجلته مرحلة الفواتير قبلنا لا يُحسب مرتين
+        try:
+            recorded = analytics.seed(supabase_client.iter_invoice_totals())
+            logger.info(f"📈 تهيئة إجماليات العملاء من {recorded} فاتورة محفوظة")
+        except (RuntimeError, requests.exceptions.RequestException) as e:
+            # إجماليات من مجموعة فواتير ناقصة أسوأ من قيم قائمة العملاء: نعطل الحساب لهذا التشغيل
+            logger.error(f"❌ فشل تهيئة إجماليات العملاء، تعطيلها لهذا التشغيل: {e}")
+            analytics = None
+    
+    def save_batch(batch):
+        saved, failed = supabase_client.upsert_batch('customers', batch)
+        stats['customers_saved'] += saved
+        stats['customers_failed'] += failed
+        if analytics and not failed:
+            analytics.mark_synced([row['id'] for row in batch])
+    
+    for page, customers in paginator:
+        logger.info(f"📄 صفحة العملاء {page}/{paginator.page_count or '?'}")
         
-        if not response_data or 'data' not in response_data:
+        if customers is None:
             logger.warning(f"⚠️ لا توجد بيانات في الصفحة {page}")
+            complete = False
             break
-            
-        customers = response_data['data']
         
-        if not customers:
-            logger.info(f"✅ انتهاء العملاء في الصفحة {page}")
+        if watermark.page_already_synced(customers):
+            logger.info(f"✅ صفحة {page}: وصلنا لعملاء متزامنين مسبقًا، إيقاف مبكر")
             break
         
         valid_customers = 0
+        page_customers = []
         
         for customer in customers:
             if not DataValidator.validate_customer(customer):
                 continue
             
+            watermark.observe(customer)
+            
             try:
                 cleaned_customer = DataValidator.clean_customer_data(customer)
-                customers_batch.append(cleaned_customer)
+                page_customers.append(cleaned_customer)
                 valid_customers += 1
                         
             except Exception as e:
                 logger.error(f"❌ خطأ في معالجة العميل {customer.get('id', 'غير معروف')}: {e}")
+                complete = False
                 continue
         
+        # إجماليات المبيعات من الفواتير المتزامنة بدل قيم قائمة العملاء
+        if analytics:
+            analytics.merge(page_customers)
+        customers_batch.extend(page_customers)
+        
         logger.info(f"📋 صفحة {page}: {valid_customers} عميل صالح من أصل {len(customers)}")
         stats['customers_processed'] += valid_customers
         
         # حفظ العملاء عند الوصول للحد الأقصى
-        if len(customers_batch) >= BATCH_SIZE:
-            saved, failed = supabase_client.upsert_batch('customers', customers_batch)
-            stats['customers_saved'] += saved
-            stats['customers_failed'] += failed
+        if len(customers_batch) >= get_batch_sizer('customers').rows:
+            save_batch(customers_batch)
             customers_batch = []
-        
-        page += 1
+            
+            # كل الصفحات حتى هذه حُفظت؛ لا نحرك النقطة بعد أي فشل
+            if not complete or stats['customers_failed']:
+                checkpoint.freeze()
+            checkpoint.save(page, paginator.limit)
+    
+    logger.info(f"✅ انتهاء العملاء ({paginator.requests} طلب قائمة، limit={paginator.limit})")
     
     # حفظ العملاء المتبقين
     if customers_batch:
-        saved, failed = supabase_client.upsert_batch('customers', customers_batch)
-        stats['customers_saved'] += saved
-        stats['customers_failed'] += failed
+        save_batch(customers_batch)
+    
+    # عملاء لم يتغيروا في دفترة لكن لهم فواتير جديدة: نرفع الحقول المحسوبة فقط
+    if analytics:
+        update_pending_analytics(supabase_client, analytics, stats)
+    
+    if complete and stats['customers_failed'] == 0:
+        watermark.commit()
+        checkpoint.clear()
     
     logger.info(f"📊 إحصائيات العملاء: {stats['customers_processed']} عميل")
     return stats
@@ -261,6 +354,11 @@ def main():
         logger.info(f"   - العملاء المعالجين: {stats['customers_processed']}")
         logger.info(f"   - العملاء المحفوظين: {stats['customers_saved']}")
         logger.info(f"   - أخطاء العملاء: {stats['customers_failed']}")
+        fingerprints = get_fingerprint_store()
+        if fingerprints and 'customers' in fingerprints.summary():
+            skipped = fingerprints.summary()['customers']
+            logger.info(f"   - العملاء بدون تغيير: {skipped['skipped']} ({skipped['skip_ratio']:.0%})، "
+                        f"تم توفير {skipped['bytes_saved']} بايت")
         
         if stats['customers_processed'] == 0:
             logger.warning("⚠️ لا توجد عملاء للمعالجة")
@@ -0,0 +1,145 @@
+import os
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# أكبر limit نجربه لقوائم دفترة؛ إذا رفضه الخادم أو قصه نعتمد الحد الفعلي
+DAFTRA_PAGE_LIMIT_MAX = int(os.getenv("DAFTRA_PAGE_LIMIT_MAX", "500"))
+# لا ننزل تحت الحد القديم عند التنصيف بعد رفض الطلب
+DAFTRA_PAGE_LIMIT_MIN = int(os.getenv("DAFTRA_PAGE_LIMIT_MIN", "50"))
+# جلب الصفحة التالية في الخلفية أثناء معالجة الحالية
+DAFTRA_PREFETCH = os.getenv("DAFTRA_PREFETCH", "true").lower() == "true"
+
+# مفتاح كود الحالة فيما ترجعه fetch عند رد خطأ من الخادم (انظر list_error)
+ERROR_STATUS = "error_status"
+
+# الحد الفعلي المكتشف لكل endpoint، يُعاد استخدامه في باقي التشغيل (الفروع الأخرى مثلاً)
+_limits: Dict[str, int] = {}
+_limits_lock = threading.Lock()
+
+
+def tuned_limit(endpoint: str) -> int:
+    with _limits_lock:
+        return _limits.get(endpoint, DAFTRA_PAGE_LIMIT_MAX)
+
+
+def _remember_limit(endpoint: str, limit: int) -> None:
+    with _limits_lock:
+        if _limits.get(endpoint) != limit:
+            logger.info(f"limit الفعلي لـ {endpoint}: {limit}")
+        _limits[endpoint] = limit
+
+
+def list_error(status: int) -> Dict[str, int]:
+    """ما ترجعه fetch عند رد خطأ من دفترة، حتى يفرق الترقيم بين رفض limit وفشل مؤقت"""
+    return {ERROR_STATUS: status}
+
+
+def _rejects_limit(response: Optional[Dict[str, Any]]) -> bool:
+    """رفض صريح من الخادم (4xx غير المؤقتة)؛ {} / None بعد نفاد المحاولات ليس رفضًا للحد"""
+    status = (response or {}).get(ERROR_STATUS)
+    return status is not None and 400 <= status < 500 and status not in (408, 429)
+
+
+class DaftraPaginator:
+    """
+    ترقيم موحد لقوائم دفترة (منتجات، عملاء، فواتير):
+    - ينتهي عند page_count من بيانات pagination بدل طلب صفحة فارغة إضافية
+    - يجلب الصفحة N+1 في الخلفية أثناء معالجة الصفحة N
+    - يبدأ بأكبر limit ويعتمد الحد الذي يقبله الخادم فعلاً
+
+    fetch(page, limit) ترجع JSON القائمة، أو list_error(status) عند رد خطأ، أو {} / None عند فشل الاتصال.
+    التكرار يعطي (page, records)؛ records = None تعني فشل الصفحة، ويتوقف الترقيم بعدها.
+    """
+
+    def __init__(self, endpoint: str, fetch: Callable[[int, int], Optional[Dict[str, Any]]],
+                 start_page: int = 1, limit: Optional[int] = None, prefetch: bool = DAFTRA_PREFETCH):
+        self.endpoint = endpoint
+        self.fetch = fetch
+        self.start_page = max(start_page, 1)
+        # limit محدد (مثلاً من نقطة استئناف) يبقى ثابتًا حتى تبقى أرقام الصفحات بنفس المعنى
+        self.fixed_limit = limit is not None
+        self.limit = limit or tuned_limit(endpoint)
+        self.prefetch = prefetch
+        self.page_count: Optional[int] = None
+        self.total_results: Optional[int] = None
+        self.requests = 0
+
+    def _fetch(self, page: int, limit: int) -> Optional[Dict[str, Any]]:
+        self.requests += 1
+        return self.fetch(page, limit)
+
+    def _first(self, page: int) -> Optional[Dict[str, Any]]:
+        """الصفحة الأولى، مع تنصيف limit إذا رفض الخادم الحد الكبير صراحة"""
+        while True:
+            response = self._fetch(page, self.limit)
+            if (response and 'data' in response) or self.fixed_limit or self.limit <= DAFTRA_PAGE_LIMIT_MIN:
+                return response
+            # 5xx أو انقطاع بعد نفاد المحاولات لا يعني أن الحد كبير، فلا نصغّره ولا نحفظه لباقي التشغيل؛
+            # ولا نغير أرقام الصفحات إلا في بداية الترقيم
+            if page != 1 or not _rejects_limit(response):
+                return response
+            self.limit = max(DAFTRA_PAGE_LIMIT_MIN, self.limit // 2)
+            logger.warning(f"فشل {self.endpoint} بـ limit أكبر، إعادة المحاولة بـ {self.limit}")
+
+    def _adopt_limit(self, page: int, records: List[Any], pagination: Dict[str, Any]) -> None:
+        """اعتماد الحد الفعلي إذا قص الخادم الصفحة بصمت"""
+        effective = None
+        try:
+            echoed = int(pagination.get('limit') or 0)
+        except (TypeError, ValueError):
+            echoed = 0
+        if 0 < echoed < self.limit:
+            effective = echoed
+        elif self.page_count is not None and page < self.page_count and 0 < len(records) < self.limit:
+            effective = len(records)
+        if effective and not self.fixed_limit:
+            self.limit = effective
+        if not self.fixed_limit:
+            _remember_limit(self.endpoint, self.limit)
+
+    def __iter__(self) -> Iterator[Tuple[int, Optional[List[Any]]]]:
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"prefetch-{self.endpoint}") \
+            if self.prefetch else None
+        pending: Optional[Future] = None
+        page = self.start_page
+        try:
+            response = self._first(page)
+            first = True
+            while True:
+                if not response or 'data' not in response:
+                    yield page, None
+                    return
+
+                records = response['data'] or []
+                pagination = response.get('pagination') or {}
+                if pagination.get('page_count') is not None:
+                    self.page_count = int(pagination['page_count'])
+                    self.total_results = pagination.get('total_results')
+                if first:
+                    self._adopt_limit(page, records, pagination)
+                    first = False
+
+                if self.page_count is not None:
+                    has_next = page < self.page_count
+                else:
+                    # بدون بيانات ترقيم نرجع للطريقة القديمة: حتى صفحة فارغة
+                    has_next = bool(records)
+
+                if has_next and executor:
+                    pending = executor.submit(self._fetch, page + 1, self.limit)
+                if records:
+                    yield page, records
+                if not has_next:
+                    return
+
+                response = pending.result() if pending else self._fetch(page + 1, self.limit)
+                pending = None
+                page += 1
+        finally:
+            if executor:
+                # عند الإيقاف المبكر لا ننتظر الصفحة المجلوبة مسبقًا
+                executor.shutdown(wait=False)
@@ -0,0 +1,184 @@
+"""
+مخزن الصفوف التي فشل حفظها في Supabase (dead letter) وإعادة إرسالها.
+
+كل صف فاشل يُضاف لملف JSONL مضغوط لكل جدول مع سبب الفشل، فاستعادة دفعة فاشلة
+لا تحتاج إعادة جلب كل التاريخ من دفترة:
+
+    python dead_letter.py                      # ملخص الصفوف المخزنة
+    python dead_letter.py replay               # إعادة إرسال كل الجداول
+    python dead_letter.py replay invoice_items
+"""
+import os
+import sys
+import gzip
+import json
+import logging
+import threading
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from config import SAVE_FAILED_RECORDS
+from records import to_jsonable
+
+logger = logging.getLogger(__name__)
+
+DEAD_LETTER_DIR = os.getenv("DEAD_LETTER_DIR", "failed_records")
+DEAD_LETTER_SUFFIX = ".jsonl.gz"
+REPLAY_SUFFIX = ".replaying"
+# الفواتير قبل بنودها عند إعادة الإرسال
+REPLAY_ORDER = ["products", "customers", "invoices", "invoice_items"]
+
+
+class DeadLetterStore:
+    """ملف gzip واحد لكل جدول يُضاف له (كل إضافة عضو gzip مستقل، فالملف يبقى مقروءًا لو انقطع التشغيل)"""
+
+    def __init__(self, directory: str = DEAD_LETTER_DIR):
+        self.directory = directory
+        self.lock = threading.Lock()
+
+    def path(self, table: str) -> str:
+        return os.path.join(self.directory, f"{table}{DEAD_LETTER_SUFFIX}")
+
+    def add(self, table: str, rows: List[Dict[str, Any]], error: str) -> None:
+        if not rows:
+            return
+        failed_at = datetime.now().isoformat()
+        lines = "".join(
+            json.dumps({'table': table, 'failed_at': failed_at, 'error': error, 'row': row},
+                       ensure_ascii=False, default=to_jsonable) + "\n"
+            for row in rows
+        )
+        try:
+            with self.lock:
+                os.makedirs(self.directory, exist_ok=True)
+                with gzip.open(self.path(table), 'at', encoding='utf-8') as f:
+                    f.write(lines)
+            logger.warning(f"تم حفظ {len(rows)} صف فاشل من {table} في {self.path(table)}")
+        except OSError as e:
+            logger.error(f"خطأ في حفظ الصفوف الفاشلة لـ {table}: {e}")
+
+    def tables(self) -> List[str]:
+        """الجداول التي لها صفوف مخزنة (بما فيها إعادة إرسال انقطعت)، بترتيب الإرسال"""
+        if not os.path.isdir(self.directory):
+            return []
+        found = set()
+        for name in os.listdir(self.directory):
+            for suffix in (DEAD_LETTER_SUFFIX, DEAD_LETTER_SUFFIX + REPLAY_SUFFIX):
+                if name.endswith(suffix):
+                    found.add(name[:-len(suffix)])
+        return sorted(found, key=lambda t: (REPLAY_ORDER.index(t) if t in REPLAY_ORDER else len(REPLAY_ORDER), t))
+
+    @staticmethod
+    def _read(path: str) -> Iterator[Dict[str, Any]]:
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+        except (EOFError, gzip.BadGzipFile) as e:
+            # آخر إضافة انقطعت في منتصفها: ما قبلها سليم
+            logger.warning(f"نهاية غير مكتملة في {path}: {e}")
+
+    def records(self, table: str) -> Iterator[Dict[str, Any]]:
+        for path in (self.path(table) + REPLAY_SUFFIX, self.path(table)):
+            if os.path.exists(path):
+                yield from self._read(path)
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        result = {}
+        for table in self.tables():
+            errors: Dict[str, int] = {}
+            count = 0
+            for record in self.records(table):
+                count += 1
+                errors[record.get('error', '')] = errors.get(record.get('error', ''), 0) + 1
+            result[table] = {'rows': count, 'errors': errors}
+        return result
+
+    def replay(self, table: str, upsert: Callable[[str, List[Dict[str, Any]]], tuple]) -> Dict[str, int]:
+        """
+        إعادة إرسال صفوف جدول دفعة واحدة (آخر نسخة لكل id).
+        الملف يُنقل جانبًا أولاً، ولا يُحذف إلا إذا نجح إرسال كل صفوفه.
+        """
+        path = self.path(table)
+        replaying = path + REPLAY_SUFFIX
+        with self.lock:
+            if os.path.exists(path):
+                if os.path.exists(replaying):
+                    # إعادة إرسال سابقة انقطعت: ندمج الملفين
+                    with open(replaying, 'ab') as target, open(path, 'rb') as source:
+                        target.write(source.read())
+                    os.remove(path)
+                else:
+                    os.replace(path, replaying)
+        if not os.path.exists(replaying):
+            return {'rows': 0, 'saved': 0, 'failed': 0}
+
+        latest: Dict[str, Dict[str, Any]] = {}
+        for record in self._read(replaying):
+            row = record['row']
+            latest[str(row.get('id', row.get('product_id', len(latest))))] = row
+        rows = list(latest.values())
+
+        saved, failed = upsert(table, rows)
+        if failed:
+            # الملف يبقى: upsert_batch لا يحفظ ما فشل مرة أخرى إذا كان SAVE_FAILED_RECORDS معطلاً،
+            # والإرسال القادم يدمجه مع أي ملف جديد ويأخذ آخر نسخة لكل id
+            logger.warning(f"إعادة إرسال {table}: {failed} صف فشل مرة أخرى، الإبقاء على {replaying}")
+        else:
+            os.remove(replaying)
+        logger.info(f"إعادة إرسال {table}: {saved} صف محفوظ، {failed} فشل مرة أخرى")
+        return {'rows': len(rows), 'saved': saved, 'failed': failed}
+
+
+_store: Optional[DeadLetterStore] = None
+_store_lock = threading.Lock()
+
+
+def get_dead_letter_store() -> Optional[DeadLetterStore]:
+    """المخزن المشترك، أو None إذا كان SAVE_FAILED_RECORDS معطلاً"""
+    global _store
+    if not SAVE_FAILED_RECORDS:
+        return None
+    with _store_lock:
+        if _store is None:
+            _store = DeadLetterStore()
+        return _store
+
+
+def replay_failed(tables: Optional[List[str]] = None) -> Dict[str, Dict[str, int]]:
+    """إعادة إرسال الصفوف المخزنة فقط، بدون أي طلب لدفترة"""
+    from invoice_supabase_sync import SupabaseClient
+    from products_service import upsert_products
+
+    store = DeadLetterStore()
+    client = SupabaseClient()
+
+    def upsert(table: str, rows: List[Dict[str, Any]]) -> tuple:
+        if table == "products":
+            # المنتجات مفتاحها product_id ولها مسار رفع خاص
+            if upsert_products(rows):
+                return len(rows), 0
+            store.add(table, rows, "replay failed")
+            return 0, len(rows)
+        # force: البصمات قد تكون محفوظة لصفوف لم تصل فعلاً
+        return client.upsert_batch(table, rows, force=True)
+
+    results = {}
+    for table in store.tables():
+        if tables and table not in tables:
+            continue
+        results[table] = store.replay(table, upsert)
+    return results
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    if len(sys.argv) > 1 and sys.argv[1] == "replay":
+        for table, result in replay_failed(sys.argv[2:] or None).items():
+            print(f"{table}: {result['saved']}/{result['rows']} محفوظ، {result['failed']} فشل")
+    else:
+        for table, info in DeadLetterStore().summary().items():
+            print(f"{table}: {info['rows']} صف")
+            for error, count in info['errors'].items():
+                print(f"    {count} × {error}")
@@ -0,0 +1,83 @@
+import os
+import threading
+from typing import Any, Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import get_metrics
+
+# مجمع اتصالات واحد لكل العملية: كل Session تشترك في نفس الاتصالات المفتوحة (keep-alive)
+# عدد المضيفين المحتفظ بمجمعاتهم، وأقصى اتصالات مفتوحة لكل مضيف
+HTTP_POOL_HOSTS = int(os.getenv("HTTP_POOL_HOSTS", "10"))
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "40"))
+# الانتظار على اتصال متاح بدل فتح اتصالات مؤقتة فوق الحد
+HTTP_POOL_BLOCK = os.getenv("HTTP_POOL_BLOCK", "false").lower() == "true"
+HTTP_ACCEPT_ENCODING = os.getenv("HTTP_ACCEPT_ENCODING", "gzip, deflate")
+
+_adapter: Optional[HTTPAdapter] = None
+_shared: Optional[requests.Session] = None
+_lock = threading.Lock()
+
+
+def get_adapter() -> HTTPAdapter:
+    global _adapter
+    with _lock:
+        if _adapter is None:
+            # إعادة المحاولة في rate_limiter.send وعند المستدعي، فلا نضيف طبقة ثانية هنا
+            _adapter = HTTPAdapter(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_MAXSIZE,
+                                   pool_block=HTTP_POOL_BLOCK, max_retries=0)
+        return _adapter
+
+
+def _record_response(response: requests.Response, *args, **kwargs) -> None:
+    """تسجيل كل طلب في المقاييس (العدد والزمن لكل endpoint)"""
+    get_metrics().observe_request(response.request.method, response.url, response.status_code,
+                                  response.elapsed.total_seconds())
+
+
+def create_session(headers: Optional[Dict[str, Any]] = None) -> requests.Session:
+    """
+    Session بترويسات العميل الخاصة لكن فوق مجمع الاتصالات المشترك،
+    فالعملاء المختلفون لنفس المضيف (دفترة / Supabase) يعيدون استخدام نفس الاتصالات.
+    """
+    session = requests.Session()
+    adapter = get_adapter()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers["Accept-Encoding"] = HTTP_ACCEPT_ENCODING
+    session.hooks["response"].append(_record_response)
+    if headers:
+        session.headers.update({k: v for k, v in headers.items() if v is not None})
+    return session
+
+
+def shared_session() -> requests.Session:
+    """Session بدون ترويسات للدوال التي تمرر headers مع كل طلب (بدل requests.get المباشر)"""
+    global _shared
+    if _shared is None:
+        session = create_session()
+        with _lock:
+            if _shared is None:
+                _shared = session
+    return _shared
+
+
+def reuse_stats() -> Dict[str, Dict[str, Any]]:
+    """لكل مضيف: عدد الاتصالات المفتوحة فعلًا مقابل عدد الطلبات المرسلة عليها"""
+    if _adapter is None:
+        return {}
+    pools = _adapter.poolmanager.pools
+    stats = {}
+    for key in list(pools.keys()):
+        pool = pools.get(key)
+        if pool is None:
+            continue
+        host = f"{pool.host}:{pool.port}" if pool.port else pool.host
+        entry = stats.setdefault(host, {'connections': 0, 'requests': 0})
+        entry['connections'] += pool.num_connections
+        entry['requests'] += pool.num_requests
+    for entry in stats.values():
+        requests_count = entry['requests']
+        entry['reuse_ratio'] = round(1 - entry['connections'] / requests_count, 3) if requests_count else 0.0
+    return stats
@@ -1,10 +1,27 @@
 import time
 import requests
 import logging
-import json
 from datetime import datetime
-from typing import List, Dict, Any, Optional
+from functools import lru_cache
+from typing import List, Dict, Any, Optional, Iterator, Set
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+from batching import get_batch_sizer
+from customer_analytics import get_customer_analytics
+from daftra_paginator import DaftraPaginator, list_error
+from http_transport import create_session, reuse_stats
+from json_codec import decode_response
+from metrics import get_metrics
+from pipeline import Pipeline, Stage
+from product_index import get_product_index
+from rate_limiter import get_limiter, send
+from records import InvoiceRecord, ItemRecord, intern, timestamp
+from staff_cache import get_staff_cache
+from supabase_reader import iter_keyset
+from supabase_writer import SupabaseWriter
+from sync_utils import Checkpoint, Watermark, get_fingerprint_store, parse_daftra_time
 
 # إعداد المتغيرات مباشرة
 BASE_URL = os.getenv("DAFTRA_URL", "https://shadowpeace.daftra.com") + "/v2/api"
@@ -26,10 +43,16 @@ HEADERS_SUPABASE = {
 
 EXPECTED_TYPE = 0  # للمبيعات
 PAGE_LIMIT = 50
-BRANCH_IDS = [2, 1]
+BRANCH_IDS = [int(b) for b in os.getenv("BRANCH_IDS", "2,1").split(",") if b.strip()]
 BATCH_SIZE = 50
 MAX_RETRIES = 3
 RETRY_DELAY = 2
+# عدد طلبات تفاصيل الفواتير المتزامنة إلى دفترة
+DETAIL_CONCURRENCY = int(os.getenv("DETAIL_CONCURRENCY", "8"))
+# تخطي الفواتير المحفوظة مسبقًا وغير المعدلة منذ آخر تزامن ناجح (علامة INCREMENTAL_SYNC) بدون جلب تفاصيلها
+SKIP_EXISTING_INVOICES = os.getenv("SKIP_EXISTING_INVOICES", "false").lower() == "true"
+# عدد الفروع المعالجة في نفس الوقت (كلها تتشارك ميزانية طلبات دفترة)
+BRANCH_WORKERS = int(os.getenv("BRANCH_WORKERS", "4"))
 
 # إعداد نظام التسجيل
 logging.basicConfig(
@@ -59,32 +82,35 @@ class DataValidator:
         return all(field in item and item[field] is not None for field in required_fields)
     
     @staticmethod
-    def clean_invoice_data(invoice: Dict[str, Any]) -> Dict[str, Any]:
+    def clean_invoice_data(invoice: Dict[str, Any]) -> InvoiceRecord:
         """تنظيف وتحويل بيانات الفاتورة - أسماء الحقول الصحيحة"""
-        cleaned = {
-            'id': str(invoice.get('id', '')),
-            "invoice_id": str(invoice.get("id", "")),  # إضافة عمود invoice_id هنا
-            'invoice_no': str(invoice.get('no', '')),
-            'invoice_date': DataValidator.format_date(invoice.get('date')),
-            'customer_id': str(invoice.get('client_id', '')),
-            'summary_total': float(invoice.get('summary_total', 0)),
-            'branch': int(invoice.get('store_id', 0)),
-            'client_business_name': str(invoice.get('client_business_name', ''))[:255],
-            'client_city': str(invoice.get('client_city', ''))[:100],
-            'summary_paid': float(invoice.get('summary_paid', 0)),
-            'summary_unpaid': float(invoice.get('summary_unpaid', 0)),
+        # سجل بحقول ثابتة؛ النصوص المتكررة بين الفواتير (العميل، المدينة، الموظف، الوقت) كائن واحد مشترك
+        invoice_id = str(invoice.get('id', ''))
+        now = timestamp()
+        cleaned = InvoiceRecord(
+            id=invoice_id,
+            invoice_id=invoice_id,  # إضافة عمود invoice_id هنا
+            invoice_no=str(invoice.get('no', '')),
+            invoice_date=DataValidator.format_date(invoice.get('date')),
+            customer_id=intern(invoice.get('client_id', '')),
+            summary_total=float(invoice.get('summary_total', 0)),
+            branch=int(invoice.get('store_id', 0)),
+            client_business_name=intern(str(invoice.get('client_business_name', ''))[:255]),
+            client_city=intern(str(invoice.get('client_city', ''))[:100]),
+            summary_paid=float(invoice.get('summary_paid', 0)),
+            summary_unpaid=float(invoice.get('summary_unpaid', 0)),
 
             # ✅ إضافات فقط (بدون تعديل أي سطر قديم)
-            'staff_id': int(invoice.get('staff_id', 0)),
-            'staff_name': str(invoice.get('staff_name', ''))[:255],
+            staff_id=int(invoice.get('staff_id', 0)),
+            staff_name=intern(str(invoice.get('staff_name', ''))[:255]),
 
-            'created_at': datetime.now().isoformat(),
-            'updated_at': datetime.now().isoformat(),
-        }
+            created_at=now,
+            updated_at=now,
+        )
         return cleaned
     
     @staticmethod
-    def clean_item_data(item: Dict[str, Any], invoice_id: str, client_name: str, supabase_client=None) -> Dict[str, Any]:
+    def clean_item_data(item: Dict[str, Any], invoice_id: str, client_name: str, supabase_client=None) -> ItemRecord:
         """تنظيف وتحويل بيانات البند - مع تصحيح product_code"""
         
         product_id = str(item.get('product_id', ''))
@@ -104,20 +130,54 @@ class DataValidator:
             product_code = wrong_code
         subtotal_pre_tax_item = float(item.get('unit_price', 0)) * float(item.get('quantity', 0))
 
-        cleaned = {
-            'id': str(item.get('id', '')),
-            'invoice_id': str(invoice_id),
-            'quantity': float(item.get('quantity', 0)),
-            'unit_price': float(item.get('unit_price', 0)),
-            'subtotal': subtotal_pre_tax_item,
-            'product_id': product_id,
-            'product_code': product_code,  # الكود الصحيح الآن
-            'client_business_name': str(client_name)[:255],
-            'created_at': datetime.now().isoformat(),
-            'updated_at': datetime.now().isoformat()
-        }
+        now = timestamp()
+        cleaned = ItemRecord(
+            id=str(item.get('id', '')),
+            # بنود نفس الفاتورة تتشارك نفس نصوص الفاتورة والعميل
+            invoice_id=intern(invoice_id),
+            quantity=float(item.get('quantity', 0)),
+            unit_price=float(item.get('unit_price', 0)),
+            subtotal=subtotal_pre_tax_item,
+            product_id=intern(product_id),
+            product_code=intern(product_code),  # الكود الصحيح الآن
+            client_business_name=intern(str(client_name)[:255]),
+            created_at=now,
+            updated_at=now,
+        )
         return cleaned
     
+    @staticmethod
+    def is_invoice_unchanged(invoice: Dict[str, Any], stored: Dict[str, Any],
+                             synced_at: Optional[datetime]) -> bool:
+        """
+        الفاتورة لم تتغير إذا كان modified في دفترة لا يتجاوز آخر علامة تزامن ناجح للفرع
+        (فالتشغيل الناجح السابق حفظها بعد آخر تعديل)، وحقول القائمة تطابق المحفوظ.
+        الإجماليات وحدها لا تكفي: تعديل البنود أو التاريخ أو الموظف قد لا يغيرها.
+        غياب modified أو العلامة يعتبر تغيير.
+        """
+        modified = parse_daftra_time(invoice.get('modified'))
+        if synced_at is None or modified is None or modified > synced_at:
+            return False
+        if 'summary_total' not in invoice:
+            return False
+        
+        comparisons = [
+            ('no', 'invoice_no', str),
+            ('client_id', 'customer_id', str),
+            ('summary_total', 'summary_total', float),
+            ('summary_paid', 'summary_paid', float),
+            ('summary_unpaid', 'summary_unpaid', float),
+        ]
+        try:
+            for source_key, stored_key, cast in comparisons:
+                if source_key not in invoice:
+                    continue
+                if cast(invoice.get(source_key) or 0) != cast(stored.get(stored_key) or 0):
+                    return False
+        except (TypeError, ValueError):
+            return False
+        return True
+    
     @staticmethod
     def format_date(date_str: Any) -> Optional[str]:
         """تحويل التاريخ إلى صيغة ISO"""
@@ -126,191 +186,88 @@ class DataValidator:
         
         try:
             if isinstance(date_str, str):
-                # محاولة تحويل التاريخ من صيغ مختلفة
-                for fmt in ['%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%d/%m/%Y']:
-                    try:
-                        dt = datetime.strptime(date_str, fmt)
-                        return dt.isoformat()
-                    except ValueError:
-                        continue
+                return _format_date_str(date_str)
             return str(date_str)
         except Exception:
             return None
 
 
-class SupabaseClient:
-    """عميل محسن للتعامل مع Supabase"""
+@lru_cache(maxsize=4096)
+def _format_date_str(date_str: str) -> str:
+    """التواريخ تتكرر بين الفواتير: strptime مرة واحدة لكل قيمة، ونفس النص الناتج لكل الصفوف"""
+    # محاولة تحويل التاريخ من صيغ مختلفة
+    for fmt in ['%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%d/%m/%Y']:
+        try:
+            dt = datetime.strptime(date_str, fmt)
+            return dt.isoformat()
+        except ValueError:
+            continue
+    return date_str
+
+
+class SupabaseClient(SupabaseWriter):
+    """عميل محسن للتعامل مع Supabase (الكتابة في SupabaseWriter)"""
     
+    max_retries = MAX_RETRIES
+    retry_delay = RETRY_DELAY
+
     def __init__(self):
         self.base_url = SUPABASE_URL
         self.headers = HEADERS_SUPABASE
-        self.session = requests.Session()
-        self.session.headers.update(self.headers)
+        self.session = create_session(self.headers)
+        # فهرس أكواد المنتجات مشترك مع مرحلة التصحيح ويُحمّل مرة واحدة لكل تشغيل
+        self.product_index = get_product_index(self.session, self.base_url)
     
     def get_correct_product_code(self, product_id: str) -> str:
-        """جلب الكود الصحيح من جدول products بناءً على product_id"""
+        """جلب الكود الصحيح من فهرس المنتجات بناءً على product_id"""
         if not product_id:
             return ""
         
+        # العلاقة الصحيحة: invoice_items.product_id = products.product_id
+        return self.product_index.get_code(product_id)
+    
+    def fetch_existing_invoices(self, invoice_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """جلب الفواتير المحفوظة من قائمة أرقام بطلب واحد id=in.(...)"""
+        if not invoice_ids:
+            return {}
+        
+        ids = ",".join(str(invoice_id) for invoice_id in invoice_ids)
+        url = (f"{self.base_url}/invoices?id=in.({ids})"
+               f"&select=id,invoice_no,customer_id,summary_total,summary_paid,summary_unpaid")
         try:
-            # العلاقة الصحيحة: invoice_items.product_id = products.product_id
-            url = f"{self.base_url}/products?product_id=eq.{product_id}&select=product_code"
-            response = self.session.get(url, timeout=10)
-            
+            response = self.session.get(url, timeout=30)
             if response.status_code == 200:
-                products = response.json()
-                if products and len(products) > 0:
-                    correct_code = products[0].get('product_code', '')
-                    if correct_code:
-                        return correct_code.strip()
-                        
-        except Exception as e:
-            logger.error(f"خطأ في جلب كود المنتج {product_id}: {e}")
+                return {str(row['id']): row for row in decode_response(response)}
+            logger.error(f"فشل في التحقق من الفواتير الموجودة: {response.status_code}")
+        except requests.exceptions.RequestException as e:
+            logger.error(f"خطأ في التحقق من الفواتير الموجودة: {e}")
         
-        return ""
+        return {}
     
+    def iter_invoices(self) -> Iterator[Dict[str, Any]]:
+        """قراءة الفواتير (id, client_business_name) على صفحات مرتبة حسب id"""
+        return iter_keyset(self._get, self.base_url, 'invoices', 'id,client_business_name', key='id', count='exact')
+
+    def fetch_invoice_ids_with_items(self) -> Set[str]:
+        """أرقام الفواتير المميزة التي لها بنود، بالقفز على invoice_id بدل قراءة كل البنود"""
+        # gt على آخر invoice_id يتخطى باقي بنود نفس الفاتورة، وهذا المطلوب لأننا نريد القيم المميزة
+        rows = iter_keyset(self._get, self.base_url, 'invoice_items', 'invoice_id',
+                           key='invoice_id', filters='invoice_id=not.is.null')
+        return {str(row['invoice_id']) for row in rows}
+
+    def _get(self, url: str, headers: Optional[Dict[str, str]] = None):
+        return self.session.get(url, headers=headers, timeout=30)
+
     def fix_existing_product_codes(self) -> Dict[str, int]:
-        """تصحيح أكواد المنتجات للبيانات الموجودة في قاعدة البيانات"""
-        logger.info("بدء تصحيح أكواد المنتجات الموجودة...")
-        
-        stats = {'fixed_count': 0, 'total_checked': 0, 'errors': 0}
-        
-        try:
-            # جلب البنود على دفعات لتجنب تحميل كمية كبيرة من البيانات
-            limit = 1000
-            offset = 0
-            
-            while True:
-                # جلب دفعة من البنود
-                items_url = f"{self.base_url}/invoice_items?select=id,product_id,product_code&limit={limit}&offset={offset}"
-                response = self.session.get(items_url, timeout=30)
-                
-                if response.status_code != 200:
-                    logger.error(f"فشل في جلب البنود: {response.status_code}")
-                    break
-                
-                items = response.json()
-                
-                if not items:
-                    logger.info("انتهاء معالجة جميع البنود")
-                    break
-                
-                logger.info(f"معالجة دفعة من {len(items)} بند (إجمالي: {stats['total_checked']})")
-                
-                # معالجة كل بند في الدفعة
-                updates_batch = []
-                
-                for item in items:
-                    stats['total_checked'] += 1
-                    
-                    product_id = item.get('product_id')
-                    current_code = item.get('product_code', '')
-                    
-                    if product_id:
-                        # جلب الكود الصحيح
-                        correct_code = self.get_correct_product_code(product_id)
-                        
-                        # إذا كان الكود مختلف، حضّر للتحديث
-                        if correct_code and correct_code != current_code:
-                            updates_batch.append({
-                                'id': item['id'],
-                                'product_code': correct_code,
-                                'current_code': current_code
-                            })
-                            
-                            logger.info(f"سيتم تصحيح البند {item['id']}: '{current_code}' → '{correct_code}'")
-                
-                # تطبيق التحديثات على الدفعة
-                for update in updates_batch:
-                    try:
-                        update_url = f"{self.base_url}/invoice_items?id=eq.{update['id']}"
-                        update_data = {"product_code": update['product_code']}
-                        
-                        update_response = self.session.patch(
-                            update_url, 
-                            json=update_data, 
-                            timeout=30
-                        )
-                        
-                        if update_response.status_code == 204:
-                            stats['fixed_count'] += 1
-                            logger.info(f"تم تصحيح البند {update['id']}")
-                        else:
-                            stats['errors'] += 1
-                            logger.error(f"فشل تحديث البند {update['id']}: {update_response.status_code}")
-                            
-                    except Exception as e:
-                        stats['errors'] += 1
-                        logger.error(f"خطأ في تحديث البند {update['id']}: {e}")
-                
-                # انتظار قصير بين الدفعات
-                if updates_batch:
-                    time.sleep(1)
-                
-                offset += limit
-                
-                # تحديث التقدم
-                if stats['total_checked'] % 5000 == 0:
-                    logger.info(f"تقدم العملية: فحص {stats['total_checked']} بند، تصحيح {stats['fixed_count']} بند")
-        
-        except Exception as e:
-            logger.error(f"خطأ عام في تصحيح الأكواد: {e}")
-            stats['errors'] += 1
-        
-        # التقرير النهائي
-        logger.info("تقرير تصحيح أكواد المنتجات:")
-        logger.info(f"   - إجمالي البنود المفحوصة: {stats['total_checked']}")
-        logger.info(f"   - البنود المُصححة: {stats['fixed_count']}")
-        logger.info(f"   - الأخطاء: {stats['errors']}")
-        
-        if stats['fixed_count'] > 0:
-            logger.info(f"تم تصحيح {stats['fixed_count']} بند بنجاح!")
-        else:
-            logger.info("لا توجد أكواد تحتاج تصحيح")
-        
-        return stats
-    
-    def upsert_batch(self, table: str, data: List[Dict[str, Any]]) -> tuple[int, int]:
-        """إدراج أو تحديث دفعة من البيانات مع حل مشكلة التكرار"""
-        if not data:
-            return 0, 0
-        
-        # إضافة معاملة للتعامل مع البيانات المكررة
-        url = f"{self.base_url}/{table}?on_conflict=id"
-        
-        # إعداد headers خاصة للـ upsert
-        upsert_headers = {
-            **self.headers,
-            "Prefer": "resolution=merge-duplicates,return=minimal"
+        """تصحيح أكواد المنتجات للبيانات الموجودة - عبر مرحلة التصحيح الموحدة في products_service"""
+        from products_service import correct_invoice_item_codes
+        
+        result = correct_invoice_item_codes()
+        return {
+            'fixed_count': result['rows_changed'],
+            'total_checked': result['rows_scanned'],
+            'errors': result['rows_failed'],
         }
-        
-        for attempt in range(MAX_RETRIES):
-            try:
-                response = self.session.post(url, json=data, headers=upsert_headers, timeout=30)
-                
-                if response.status_code in [200, 201]:
-                    logger.info(f"تم حفظ/تحديث {len(data)} سجل في جدول {table}")
-                    return len(data), 0
-                elif response.status_code == 409:
-                    # في حالة التكرار، جرب مرة أخرى مع تحديث فقط
-                    logger.warning(f"بيانات مكررة في {table}، محاولة التحديث...")
-                    update_headers = {
-                        **self.headers,
-                        "Prefer": "resolution=ignore-duplicates,return=minimal"
-                    }
-                    response = self.session.post(url, json=data, headers=update_headers, timeout=30)
-                    if response.status_code in [200, 201]:
-                        logger.info(f"تم تحديث {len(data)} سجل في جدول {table}")
-                        return len(data), 0
-                else:
-                    logger.error(f"خطأ في حفظ {table}: {response.status_code} - {response.text}")
-                    
-            except requests.exceptions.RequestException as e:
-                logger.error(f"خطأ في الاتصال مع Supabase (محاولة {attempt + 1}): {e}")
-                if attempt < MAX_RETRIES - 1:
-                    time.sleep(RETRY_DELAY)
-                    
-        return 0, len(data)
 
 
 class DaftraClient:
@@ -319,8 +276,14 @@ class DaftraClient:
     def __init__(self):
         self.base_url = BASE_URL
         self.headers = HEADERS_DAFTRA
-        self.session = requests.Session()
-        self.session.headers.update(self.headers)
+        # مجمع الاتصالات المشترك (HTTP_POOL_MAXSIZE) يكفي لطلبات التفاصيل في كل الفروع المتوازية
+        self.session = create_session(self.headers)
+        # ميزانية طلبات واحدة لدفترة مهما كان عدد الفروع والعمال
+        self.limiter = get_limiter(self.base_url)
+
+    def _get(self, url: str, **kwargs) -> Optional[requests.Response]:
+        """GET عبر حد المعدل المشترك مع إعادة المحاولة على 429/5xx وأخطاء الاتصال"""
+        return send(self.session, "GET", url, limiter=self.limiter, **kwargs)
 
     # ✅ إضافة فقط: جلب الموظفين كخريطة id->name
     def fetch_staff_map(self) -> Dict[str, str]:
@@ -331,11 +294,11 @@ class DaftraClient:
         while True:
             url = os.getenv("DAFTRA_URL", "https://shadowpeace.daftra.com") + f"/api2/staff?limit={limit}&page={page}"
             try:
-                r = self.session.get(url, timeout=30)
-                if r.status_code != 200:
+                r = self._get(url, timeout=30)
+                if r is None or r.status_code != 200:
                     break
 
-                data = r.json().get("data", [])
+                data = decode_response(r).get("data", [])
                 if not data:
                     break
 
@@ -347,7 +310,6 @@ class DaftraClient:
                         staff_map[sid] = name
 
                 page += 1
-                time.sleep(0.3)
             except Exception as e:
                 logger.error(f"خطأ بجلب الموظفين: {e}")
                 break
@@ -355,116 +317,116 @@ class DaftraClient:
         logger.info(f"تم تحميل {len(staff_map)} موظف من دفترة")
         return staff_map
     
-    def fetch_invoices(self, branch_id: int, page: int = 1) -> Dict[str, Any]:
-        """جلب قائمة الفواتير من فرع معين"""
+    def fetch_invoices(self, branch_id: int, page: int = 1, since: Optional[Dict[str, Any]] = None,
+                       limit: int = PAGE_LIMIT) -> Dict[str, Any]:
+        """جلب قائمة الفواتير من فرع معين، مع فلاتر التزامن التزايدي إن وجدت"""
         url = f"{self.base_url}/entity/invoice/list/1"
         params = {
             'filter[type]': EXPECTED_TYPE,
             'filter[branch_id]': branch_id,
             'page': page,
-            'limit': PAGE_LIMIT
+            'limit': limit,
+            **(since or {})
         }
         
-        for attempt in range(MAX_RETRIES):
+        response = self._get(url, params=params, timeout=30)
+        if response is not None and response.status_code == 200:
             try:
-                response = self.session.get(url, params=params, timeout=30)
-                
-                if response.status_code == 200:
-                    return response.json()
-                else:
-                    logger.error(f"خطأ في جلب الفواتير: {response.status_code}")
-                    
-            except requests.exceptions.RequestException as e:
-                logger.error(f"خطأ في الاتصال مع دفترة (محاولة {attempt + 1}): {e}")
-                if attempt < MAX_RETRIES - 1:
-                    time.sleep(RETRY_DELAY)
-                    
+                return decode_response(response)
+            except ValueError as e:
+                logger.error(f"استجابة غير صالحة لقائمة الفواتير (صفحة {page}): {e}")
+                return {}
+        if response is not None:
+            logger.error(f"خطأ في جلب الفواتير: {response.status_code}")
+            return list_error(response.status_code)
         return {}
     
     def fetch_invoice_details(self, invoice_id: str) -> Dict[str, Any]:
         """جلب تفاصيل فاتورة واحدة مع البنود"""
         url = f"{self.base_url}/entity/invoice/{invoice_id}?include=InvoiceItem"
         
-        for attempt in range(MAX_RETRIES):
+        response = self._get(url, timeout=30)
+        if response is not None and response.status_code == 200:
             try:
-                response = self.session.get(url, timeout=30)
-                
-                if response.status_code == 200:
-                    return response.json()
-                else:
-                    logger.error(f"خطأ في جلب تفاصيل الفاتورة {invoice_id}: {response.status_code}")
-                    
-            except requests.exceptions.RequestException as e:
-                logger.error(f"خطأ في الاتصال مع دفترة (محاولة {attempt + 1}): {e}")
-                if attempt < MAX_RETRIES - 1:
-                    time.sleep(RETRY_DELAY)
-                    
+                return decode_response(response)
+            except ValueError as e:
+                # صفحة وسيط HTML أو جسم مقطوع: الفاتورة تُعد ناقصة بدل إيقاف الفرع كله
+                logger.error(f"استجابة غير صالحة لتفاصيل الفاتورة {invoice_id}: {e}")
+                return {}
+        if response is not None:
+            logger.error(f"خطأ في جلب تفاصيل الفاتورة {invoice_id}: {response.status_code}")
         return {}
 
+    
+    def fetch_invoice_details_many(self, invoice_ids: List[str],
+                                   concurrency: int = DETAIL_CONCURRENCY) -> List[Dict[str, Any]]:
+        """جلب تفاصيل عدة فواتير بالتوازي مع الحفاظ على ترتيب المدخلات"""
+        if concurrency <= 1 or len(invoice_ids) <= 1:
+            return [self.fetch_invoice_details(invoice_id) for invoice_id in invoice_ids]
+        
+        with ThreadPoolExecutor(max_workers=min(concurrency, len(invoice_ids))) as executor:
+            return list(executor.map(self.fetch_invoice_details, invoice_ids))
+
 
 def fetch_missing_items(daftra_client: DaftraClient, supabase_client: SupabaseClient) -> Dict[str, int]:
     """جلب البنود المفقودة للفواتير الموجودة بدون بنود"""
     logger.info("البحث عن الفواتير بدون بنود...")
     
-    stats = {'items_saved': 0, 'items_failed': 0}
+    stats = {'items_saved': 0, 'items_failed': 0, 'detection_seconds': 0.0, 'fetch_seconds': 0.0}
     
     try:
-        # جلب الفواتير اللي ماها بنود
-        invoices_url = f"{supabase_client.base_url}/invoices?select=id,client_business_name"
-        invoices_response = supabase_client.session.get(invoices_url)
-        
-        if invoices_response.status_code != 200:
-            return stats
-            
-        all_invoices = invoices_response.json()
-        missing_invoices = []
-        
-        for invoice in all_invoices:
-            invoice_id = invoice['id']
-            items_url = f"{supabase_client.base_url}/invoice_items?invoice_id=eq.{invoice_id}&select=id&limit=1"
-            items_response = supabase_client.session.get(items_url)
-            
-            if items_response.status_code == 200:
-                items = items_response.json()
-                if len(items) == 0:
-                    missing_invoices.append(invoice)
-        
-        logger.info(f"وُجد {len(missing_invoices)} فاتورة بدون بنود")
+        # فرق المجموعتين: كل الفواتير ناقص الفواتير اللي لها بنود
+        detection_start = time.time()
+        invoice_ids_with_items = supabase_client.fetch_invoice_ids_with_items()
+        missing_invoices = [
+            invoice for invoice in supabase_client.iter_invoices()
+            if str(invoice['id']) not in invoice_ids_with_items
+        ]
+        stats['detection_seconds'] = round(time.time() - detection_start, 2)
+        get_metrics().record_stage('missing_items.detection', stats['detection_seconds'])
+        
+        logger.info(f"وُجد {len(missing_invoices)} فاتورة بدون بنود (زمن الكشف {stats['detection_seconds']} ث)")
         
         if not missing_invoices:
             return stats
         
+        fetch_start = time.time()
         items_batch = []
         
-        for invoice in missing_invoices:
-            invoice_id = invoice['id']
-            client_name = invoice.get('client_business_name', '')
+        for start in range(0, len(missing_invoices), PAGE_LIMIT):
+            chunk = missing_invoices[start:start + PAGE_LIMIT]
+            details_list = daftra_client.fetch_invoice_details_many([str(invoice['id']) for invoice in chunk])
             
-            invoice_details = daftra_client.fetch_invoice_details(invoice_id)
-            
-            if not invoice_details:
-                continue
-            
-            items = invoice_details.get('invoice_item', [])
-            
-            for item in items:
-                if DataValidator.validate_item(item):
-                    # تمرير supabase_client للحصول على الكود الصحيح
-                    cleaned_item = DataValidator.clean_item_data(item, invoice_id, client_name, supabase_client)
-                    items_batch.append(cleaned_item)
-            
-            if len(items_batch) >= BATCH_SIZE:
-                saved, failed = supabase_client.upsert_batch('invoice_items', items_batch)
-                stats['items_saved'] += saved
-                stats['items_failed'] += failed
-                items_batch = []
+            for invoice, invoice_details in zip(chunk, details_list):
+                invoice_id = invoice['id']
+                client_name = invoice.get('client_business_name', '')
+                
+                if not invoice_details:
+                    continue
+                
+                items = invoice_details.get('invoice_item', [])
+                
+                for item in items:
+                    if DataValidator.validate_item(item):
+                        # تمرير supabase_client للحصول على الكود الصحيح
+                        cleaned_item = DataValidator.clean_item_data(item, invoice_id, client_name, supabase_client)
+                        items_batch.append(cleaned_item)
+                
+                if len(items_batch) >= get_batch_sizer('invoice_items').rows:
+                    saved, failed = supabase_client.upsert_batch('invoice_items', items_batch, force=True)
+                    stats['items_saved'] += saved
+                    stats['items_failed'] += failed
+                    items_batch = []
         
         if items_batch:
-            saved, failed = supabase_client.upsert_batch('invoice_items', items_batch)
+            saved, failed = supabase_client.upsert_batch('invoice_items', items_batch, force=True)
             stats['items_saved'] += saved
             stats['items_failed'] += failed
         
+        stats['fetch_seconds'] = round(time.time() - fetch_start, 2)
+        get_metrics().record_stage('missing_items.fetch', stats['fetch_seconds'])
         logger.info(f"تم جلب {stats['items_saved']} بند مفقود")
+        logger.info(f"زمن الكشف {stats['detection_seconds']} ث مقابل زمن جلب البنود {stats['fetch_seconds']} ث")
         
     except Exception as e:
         logger.error(f"خطأ في جلب البنود المفقودة: {e}")
@@ -472,12 +434,19 @@ def fetch_missing_items(daftra_client: DaftraClient, supabase_client: SupabaseCl
     return stats
 
 
-def process_branch_invoices(daftra_client: DaftraClient, supabase_client: SupabaseClient, branch_id: int) -> Dict[str, int]:
-    """معالجة فواتير فرع واحد"""
+def process_branch_invoices(daftra_client: DaftraClient, supabase_client: SupabaseClient, branch_id: int) -> Dict[str, Any]:
+    """
+    معالجة فواتير فرع واحد كخط معالجة من أربع مراحل متصلة بطوابير محدودة:
+    جلب الصفحات -> جلب التفاصيل -> التنظيف -> الكتابة على دفعات.
+    كل مرحلة تشتغل بالتوازي مع غيرها، فانتظار دفترة لا يوقف الكتابة في Supabase والعكس.
+    """
     logger.info(f"بدء معالجة الفرع {branch_id}")
 
-    # ✅ إضافة فقط: تحميل الموظفين مرة واحدة
-    staff_map = daftra_client.fetch_staff_map()
+    # ✅ الموظفين من ذاكرة مشتركة بين الفروع والتشغيلات (تُحدّث فقط عند موظف غير معروف)
+    staff = get_staff_cache(daftra_client.fetch_staff_map)
+
+    # تحديث فهرس المنتجات بالمنتجات الجديدة فقط قبل معالجة الفرع
+    supabase_client.product_index.refresh()
     
     stats = {
         'invoices_processed': 0,
@@ -485,47 +454,80 @@ def process_branch_invoices(daftra_client: DaftraClient, supabase_client: Supaba
         'invoices_saved': 0,
         'items_saved': 0,
         'invoices_failed': 0,
-        'items_failed': 0
+        'items_failed': 0,
+        'invoices_skipped': 0
     }
     
-    page = 1
-    invoices_batch = []
-    items_batch = []
+    # علامة آخر تزامن ناجح لهذا الفرع: نجلب المعدل بعدها فقط
+    watermark = Watermark('invoices', branch_id)
+    if watermark.is_incremental:
+        logger.info(f"تزامن تزايدي للفرع {branch_id} منذ {watermark.synced_at}")
+    # نقطة الاستئناف: لو انقطع تشغيل سابق نبدأ من آخر صفحة حُفظت بدل الصفحة 1
+    checkpoint = Checkpoint('invoices', branch_id, watermark)
+    # تكتب فيه أكثر من مرحلة؛ أي مشكلة تمنع تحريك العلامة
+    state = {'complete': True}
     
-    while True:
-        logger.info(f"جلب الصفحة {page} للفرع {branch_id}...")
-        
-        response_data = daftra_client.fetch_invoices(branch_id, page)
-        
-        if not response_data or 'data' not in response_data:
-            logger.warning(f"لا توجد بيانات في الصفحة {page} للفرع {branch_id}")
-            break
+    # ترقيم موحد: ينتهي عند page_count ويجلب الصفحة التالية أثناء معالجة الحالية
+    since = watermark.list_params()
+    paginator = DaftraPaginator(
+        'invoice/list',
+        lambda page, limit: daftra_client.fetch_invoices(branch_id, page, since=since, limit=limit),
+        start_page=checkpoint.resume_page, limit=checkpoint.limit,
+    )
+    
+    def fetch_pages():
+        """المرحلة 1: صفحات القائمة بعد الإيقاف المبكر وتخطي الفواتير غير المتغيرة"""
+        for page, invoices in paginator:
+            if invoices is None:
+                logger.warning(f"لا توجد بيانات في الصفحة {page} للفرع {branch_id}")
+                state['complete'] = False
+                return
             
-        invoices = response_data['data']
-        
-        if not invoices:
-            logger.info(f"انتهاء فواتير الفرع {branch_id} في الصفحة {page}")
-            break
+            logger.info(f"الفرع {branch_id} - صفحة {page}/{paginator.page_count or '?'}: {len(invoices)} فاتورة")
+            
+            page_records = [invoice.get("Invoice", invoice) for invoice in invoices]
+            if watermark.page_already_synced(page_records):
+                logger.info(f"الفرع {branch_id} - صفحة {page}: وصلنا لفواتير متزامنة مسبقًا، إيقاف مبكر")
+                return
+            
+            # تحقق واحد لكل صفحة: أي الفواتير موجودة مسبقًا في قاعدة البيانات
+            existing_invoices = {}
+            if SKIP_EXISTING_INVOICES:
+                existing_invoices = supabase_client.fetch_existing_invoices([str(inv["id"]) for inv in page_records])
+            
+            # الفواتير التي تحتاج جلب تفاصيل، بنفس ترتيب الصفحة
+            to_fetch = []
+            for inv in page_records:  # ✅ page_records = الفواتير بعد فك التغليف
+                invoice_id = str(inv["id"])
+                watermark.observe(inv)
+
+                stored = existing_invoices.get(invoice_id)
+                if stored and DataValidator.is_invoice_unchanged(inv, stored, watermark.synced_at):
+                    stats['invoices_skipped'] += 1
+                    continue
+                
+                to_fetch.append(inv)
+            
+            yield page, len(invoices), to_fetch
         
-        valid_invoices = 0
+        logger.info(f"انتهاء فواتير الفرع {branch_id} ({paginator.requests} طلب قائمة، limit={paginator.limit})")
+    
+    def fetch_details(item):
+        """المرحلة 2: تفاصيل الفواتير مع البنود بالتوازي، والنتائج ترجع بترتيب الصفحة"""
+        page, page_size, to_fetch = item
+        details_list = daftra_client.fetch_invoice_details_many([str(inv['id']) for inv in to_fetch])
+        return page, page_size, list(zip(to_fetch, details_list))
+    
+    def clean_page(item):
+        """المرحلة 3: دمج وتنظيف الفواتير والبنود"""
+        page, page_size, fetched = item
+        page_invoices = []
+        page_items = []
         
-        for invoice in invoices:
-            inv = invoice.get("Invoice", invoice)  # ✅ فك تغليف الفاتورة
-
-            invoice_id = inv["id"]
-
-            # تحقق هل الفاتورة موجودة مسبقًا في قاعدة البيانات
-            check_url = f"{SUPABASE_URL}/invoices?id=eq.{invoice_id}&select=id"
-            res_check = requests.get(check_url, headers=HEADERS_SUPABASE)
-            
-            if res_check.status_code == 200 and res_check.json():
-                logger.info(f"الفاتورة {invoice_id} موجودة مسبقًا وتم تجاهلها")
-                #continue
-
-            # جلب تفاصيل الفاتورة مع البنود
-            invoice_details = daftra_client.fetch_invoice_details(str(inv['id']))
+        for inv, invoice_details in fetched:
             if not invoice_details:
                 logger.warning(f"فشل في جلب تفاصيل الفاتورة {inv['id']}")
+                state['complete'] = False
                 continue
 
             details_invoice = invoice_details.get("Invoice", {})  # ✅ خذ تفاصيل Invoice فقط
@@ -534,70 +536,96 @@ def process_branch_invoices(daftra_client: DaftraClient, supabase_client: Supaba
             full_invoice = {**inv, **details_invoice}
 
             # ✅ إضافة فقط: ربط staff_id بالاسم ووضعه داخل الفاتورة
-            sid = str(full_invoice.get("staff_id", 0))
-            full_invoice["staff_name"] = staff_map.get(sid, "")
+            full_invoice["staff_name"] = staff.name(full_invoice.get("staff_id", 0))
             
             # تنظيف بيانات الفاتورة
             try:
                 cleaned_invoice = DataValidator.clean_invoice_data(full_invoice)
-                invoices_batch.append(cleaned_invoice)
-                valid_invoices += 1
                 
                 # معالجة بنود الفاتورة
                 items = invoice_details.get('invoice_item', [])
                 client_name = full_invoice.get('client_business_name', '')
                 
+                cleaned_items = []
                 for item in items:
                     if DataValidator.validate_item(item):
                         # تمرير supabase_client للحصول على الكود الصحيح
-                        cleaned_item = DataValidator.clean_item_data(item, inv['id'], client_name, supabase_client)
-                        items_batch.append(cleaned_item)
+                        cleaned_items.append(DataValidator.clean_item_data(item, inv['id'], client_name, supabase_client))
+                
+                page_invoices.append(cleaned_invoice)
+                page_items.extend(cleaned_items)
                         
             except Exception as e:
                 logger.error(f"خطأ في معالجة الفاتورة {inv.get('id', 'غير معروف')}: {e}")
+                state['complete'] = False
                 continue
         
-        logger.info(f"فرع {branch_id} - صفحة {page}: {valid_invoices} فاتورة صالحة من أصل {len(invoices)}")
-        stats['invoices_processed'] += valid_invoices
-        stats['items_processed'] += len(items_batch)
-        
-        # حفظ الفواتير أولاً عند الوصول للحد الأقصى
-        if len(invoices_batch) >= BATCH_SIZE:
-            # حفظ الفواتير أولاً
-            saved, failed = supabase_client.upsert_batch('invoices', invoices_batch)
+        logger.info(f"فرع {branch_id} - صفحة {page}: {len(page_invoices)} فاتورة صالحة من أصل {page_size}")
+        stats['invoices_processed'] += len(page_invoices)
+        stats['items_processed'] += len(page_items)
+        return page, page_invoices, page_items
+    
+    batches = {'invoices': [], 'items': [], 'page': 0}
+    analytics = get_customer_analytics()
+    
+    def flush():
+        """حفظ الفواتير أولاً ثم البنود المرتبطة بها"""
+        if batches['invoices']:
+            saved_invoices = []
+            saved, failed = supabase_client.upsert_batch('invoices', batches['invoices'], saved_rows=saved_invoices)
+            # مساهمة كل فاتورة محفوظة في إجماليات عميلها (تستبدل المساهمة السابقة لنفس الفاتورة)؛
+            # الفاشلة تذهب للـ dead letter ولا تُحسب حتى تُعاد
+            if analytics:
+                analytics.record(saved_invoices)
             stats['invoices_saved'] += saved
             stats['invoices_failed'] += failed
-            invoices_batch = []
+            batches['invoices'] = []
             
-            # انتظار قصير للتأكد من حفظ الفواتير
-            time.sleep(1)
-            
-            # ثم حفظ البنود المرتبطة
-            if items_batch:
-                saved, failed = supabase_client.upsert_batch('invoice_items', items_batch)
-                stats['items_saved'] += saved
-                stats['items_failed'] += failed
-                items_batch = []
+        if batches['items']:
+            saved, failed = supabase_client.upsert_batch('invoice_items', batches['items'])
+            stats['items_saved'] += saved
+            stats['items_failed'] += failed
+            batches['items'] = []
         
-        page += 1
+        # كل الصفحات حتى batches['page'] حُفظت؛ بعد أي فشل لا نحرك النقطة حتى لا نتخطى سجلات
+        if not state['complete'] or stats['invoices_failed'] or stats['items_failed']:
+            checkpoint.freeze()
+        checkpoint.save(batches['page'], paginator.limit)
     
-    # حفظ الدفعات المتبقية - الفواتير أولاً
-    if invoices_batch:
-        saved, failed = supabase_client.upsert_batch('invoices', invoices_batch)
-        stats['invoices_saved'] += saved
-        stats['invoices_failed'] += failed
-        
-        # انتظار قصير
-        time.sleep(1)
-        
-    # ثم حفظ البنود المتبقية
-    if items_batch:
-        saved, failed = supabase_client.upsert_batch('invoice_items', items_batch)
-        stats['items_saved'] += saved
-        stats['items_failed'] += failed
+    def write_page(item):
+        """المرحلة 4: تجميع الدفعات والحفظ عند الوصول للحد الأقصى"""
+        page, page_invoices, page_items = item
+        batches['page'] = page
+        batches['invoices'].extend(page_invoices)
+        batches['items'].extend(page_items)
+        # حجم الدفعات يتكيف مع زمن الكتابة؛ البنود لها حد مستقل حتى لا تكبر بلا سقف
+        if (len(batches['invoices']) >= get_batch_sizer('invoices').rows
+                or len(batches['items']) >= get_batch_sizer('invoice_items').rows):
+            flush()
+    
+    pipeline = Pipeline(f"invoices-{branch_id}", [
+        Stage('pages', fetch_pages),
+        Stage('details', fetch_details),
+        Stage('clean', clean_page),
+        Stage('write', write_page, finish=flush),
+    ])
+    stages = pipeline.run()
+    if pipeline.errors:
+        state['complete'] = False
+    metrics = get_metrics()
+    metrics.record_stage(f'invoices.branch_{branch_id}', pipeline.wall, ok=not pipeline.errors)
+    for name, stage_stats in stages.items():
+        metrics.record_stage(f'invoices.branch_{branch_id}.{name}', stage_stats['busy_seconds'])
+    
+    # لا نحرك العلامة إلا إذا حُفظ كل شيء، عشان ما نفقد فواتير فشلت
+    if state['complete'] and stats['invoices_failed'] == 0 and stats['items_failed'] == 0:
+        watermark.commit()
+        checkpoint.clear()
     
     logger.info(f"إحصائيات الفرع {branch_id}: {stats['invoices_processed']} فاتورة، {stats['items_processed']} بند")
-    return stats
+    logger.info(f"انشغال مراحل الفرع {branch_id} خلال {pipeline.wall:.1f} ثانية: " + ", ".join(
+        f"{name} {s['utilisation']:.0%}" for name, s in stages.items()))
+    return {**stats, 'stages': stages}
 
 
 def main():
@@ -607,16 +635,12 @@ def main():
     # التحقق من المتغيرات المطلوبة
     if not all([DAFTRA_API_KEY, SUPABASE_URL, SUPABASE_KEY]):
         logger.error("متغيرات البيئة مفقودة!")
-        return
+        return {'invoices_saved': 0, 'items_saved': 0}
     
     # إنشاء العملاء
     daftra_client = DaftraClient()
     supabase_client = SupabaseClient()
     
-    # تصحيح البيانات القديمة أولاً
-    logger.info("بدء تصحيح أكواد المنتجات للبيانات الموجودة...")
-    fix_stats = supabase_client.fix_existing_product_codes()
-    
     # إحصائيات إجمالية
     total_stats = {
         'invoices_processed': 0,
@@ -624,38 +648,73 @@ def main():
         'invoices_saved': 0,
         'items_saved': 0,
         'invoices_failed': 0,
-        'items_failed': 0
+        'items_failed': 0,
+        'invoices_skipped': 0
     }
     
-    # معالجة كل فرع (للبيانات الجديدة)
-    for branch_id in BRANCH_IDS:
-        try:
-            branch_stats = process_branch_invoices(daftra_client, supabase_client, branch_id)
-            
-            # تجميع الإحصائيات
-            for key in total_stats:
-                total_stats[key] += branch_stats[key]
+    # انشغال مراحل خط المعالجة لكل فرع
+    stage_report = {}
+    
+    # تحميل الفهرس والموظفين مرة واحدة قبل تشغيل الفروع بالتوازي
+    supabase_client.product_index.load()
+    get_staff_cache(daftra_client.fetch_staff_map).ensure_loaded()
+    
+    # معالجة الفروع بالتوازي (للبيانات الجديدة)، كل فرع سلسلة صفحات مستقلة
+    workers = max(1, min(BRANCH_WORKERS, len(BRANCH_IDS)))
+    logger.info(f"معالجة {len(BRANCH_IDS)} فرع بـ {workers} عامل")
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="branch") as executor:
+        futures = {
+            executor.submit(process_branch_invoices, daftra_client, supabase_client, branch_id): branch_id
+            for branch_id in BRANCH_IDS
+        }
+        for future in as_completed(futures):
+            branch_id = futures[future]
+            try:
+                branch_stats = future.result()
                 
-        except Exception as e:
-            logger.error(f"خطأ في معالجة الفرع {branch_id}: {e}")
+                # تجميع الإحصائيات
+                for key in total_stats:
+                    total_stats[key] += branch_stats[key]
+                stage_report[branch_id] = branch_stats['stages']
+                    
+            except Exception as e:
+                logger.error(f"خطأ في معالجة الفرع {branch_id}: {e}")
     
     # التقرير النهائي
     logger.info("إحصائيات المعالجة النهائية:")
-    logger.info(f"   - البيانات القديمة المُصححة: {fix_stats['fixed_count']}")
     logger.info(f"   - الفواتير المعالجة (جديدة): {total_stats['invoices_processed']}")
     logger.info(f"   - البنود المعالجة (جديدة): {total_stats['items_processed']}")
     logger.info(f"   - الفواتير المحفوظة: {total_stats['invoices_saved']}")
     logger.info(f"   - البنود المحفوظة: {total_stats['items_saved']}")
     logger.info(f"   - أخطاء الفواتير: {total_stats['invoices_failed']}")
     logger.info(f"   - أخطاء البنود: {total_stats['items_failed']}")
+    logger.info(f"   - الفواتير المتخطاة (بدون تغيير): {total_stats['invoices_skipped']}")
+    logger.info(f"   - فهرس المنتجات: {supabase_client.product_index.summary()}")
+    logger.info(f"   - ميزانية طلبات دفترة: {daftra_client.limiter.summary()}")
+    for host, host_stats in reuse_stats().items():
+        logger.info(f"   - اتصالات {host}: {host_stats['connections']} اتصال لـ {host_stats['requests']} طلب "
+                    f"(إعادة استخدام {host_stats['reuse_ratio']:.0%})")
+    staff_stats = get_staff_cache(daftra_client.fetch_staff_map).summary()
+    logger.info(f"   - ذاكرة الموظفين: نسبة الإصابة {staff_stats['hit_rate']:.0%}، "
+                f"تحديثات من دفترة {staff_stats['refreshes']}")
+    fingerprints = get_fingerprint_store()
+    if fingerprints:
+        for table, table_stats in fingerprints.summary().items():
+            logger.info(f"   - بدون تغيير في {table}: {table_stats['skipped']} من {table_stats['rows']} "
+                        f"({table_stats['skip_ratio']:.0%})، تم توفير {table_stats['bytes_saved']} بايت")
+    for branch_id, stages in stage_report.items():
+        bottleneck = max(stages, key=lambda name: stages[name]['utilisation'])
+        logger.info(f"   - مراحل الفرع {branch_id}: " + ", ".join(
+            f"{name} {s['utilisation']:.0%}" for name, s in stages.items()) + f" (الأبطأ: {bottleneck})")
     
-    if total_stats['invoices_processed'] == 0 and fix_stats['fixed_count'] == 0:
-        logger.warning("لا توجد فواتير للمعالجة ولا بيانات للتصحيح")
+    if total_stats['invoices_processed'] == 0:
+        logger.warning("لا توجد فواتير للمعالجة")
     
     logger.info("انتهاء العملية - التقرير النهائي:")
-    logger.info(f"   البيانات المُصححة: {fix_stats['fixed_count']} بند")
     logger.info(f"   الفواتير الجديدة: {total_stats['invoices_saved']} نجحت، {total_stats['invoices_failed']} فشلت")
     logger.info(f"   البنود الجديدة: {total_stats['items_saved']} نجح، {total_stats['items_failed']} فشل")
+    
+    return {**total_stats, 'stages': stage_report}
 
 
 # إضافة alias للتوافق مع main.py
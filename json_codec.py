@@ -0,0 +1,77 @@
+import os
+import gzip
+import json
+import logging
+import threading
+from typing import Any, Callable, Dict, Optional, Set, Tuple
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# orjson إذا كانت مثبتة (أسرع بعدة مرات في الترميز وفك الترميز)، وإلا json القياسية
+FAST_JSON = os.getenv("FAST_JSON", "true").lower() == "true"
+# ضغط أجسام الكتابة الكبيرة بـ gzip؛ يحتاج بوابة تقبل Content-Encoding: gzip في الطلب،
+# وإذا ردت 415 نرسل بدون ضغط لنفس المضيف بقية التشغيل
+HTTP_GZIP_REQUESTS = os.getenv("HTTP_GZIP_REQUESTS", "false").lower() == "true"
+HTTP_GZIP_MIN_BYTES = int(os.getenv("HTTP_GZIP_MIN_BYTES", "16384"))
+HTTP_GZIP_LEVEL = int(os.getenv("HTTP_GZIP_LEVEL", "5"))
+
+_fast = orjson is not None and FAST_JSON
+_gzip_rejected: Set[str] = set()
+_lock = threading.Lock()
+
+
+def codec_name() -> str:
+    return "orjson" if _fast else "json"
+
+
+def dumps(value: Any, default: Optional[Callable[[Any], Any]] = None) -> bytes:
+    """JSON مضغوط المسافات كـ bytes جاهزة للإرسال"""
+    if _fast:
+        return orjson.dumps(value, default=default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(value, default=default, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def loads(data: Any) -> Any:
+    if _fast:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def decode_response(response) -> Any:
+    """بديل response.json() لـ requests (الاستجابة المضغوطة تُفك تلقائيًا قبل content)"""
+    return loads(response.content)
+
+
+def compress_body(body: bytes, url: str = "") -> Tuple[bytes, Dict[str, str]]:
+    """ضغط الجسم إذا كان كبيرًا ومسموحًا؛ يرجع (الجسم، الترويسات الإضافية)"""
+    if not HTTP_GZIP_REQUESTS or len(body) < HTTP_GZIP_MIN_BYTES or urlsplit(url).netloc in _gzip_rejected:
+        return body, {}
+    return gzip.compress(body, compresslevel=HTTP_GZIP_LEVEL), {"Content-Encoding": "gzip"}
+
+
+def reject_gzip(url: str) -> None:
+    host = urlsplit(url).netloc
+    with _lock:
+        if host not in _gzip_rejected:
+            logger.warning(f"المضيف {host} لا يقبل أجسام gzip، الإرسال بدون ضغط")
+            _gzip_rejected.add(host)
+
+
+def send_body(session, method: str, url: str, body: Optional[bytes],
+              headers: Optional[Dict[str, str]] = None, **kwargs):
+    """إرسال جسم مرمز مسبقًا عبر Session من requests، مع الضغط والرجوع لبدونه عند 415"""
+    headers = headers or {}
+    if body is None:
+        return session.request(method, url, headers=headers, **kwargs)
+    data, extra = compress_body(body, url)
+    response = session.request(method, url, data=data, headers={**headers, **extra}, **kwargs)
+    if extra and response.status_code == 415:
+        reject_gzip(url)
+        response = session.request(method, url, data=body, headers=headers, **kwargs)
+    return response
@@ -1,23 +1,34 @@
 import os
 import sys
-from products_service import sync_products, fix_invoice_items_product_id_using_code
+from products_service import sync_products, correct_invoice_item_codes
 from invoice_supabase_sync import fetch_all as sync_invoices, fetch_missing_items
+from metrics import get_metrics
+
+# محرك مزامنة الفواتير: sync (requests) أو async (asyncio + aiohttp)
+SYNC_ENGINE = "async" if "--async" in sys.argv else os.getenv("SYNC_ENGINE", "sync").lower()
 
 def main():
+    # زمن كل مرحلة وطلباتها وصفوفها تُكتب في sync_metrics.json و sync_metrics.prom بنهاية التشغيل
+    metrics = get_metrics()
+    try:
+        run_stages(metrics)
+    finally:
+        metrics.export()
+
+def run_stages(metrics):
     print(f"🔄 مزامنة المنتجات... URL={os.getenv('DAFTRA_URL')}")
-    r1 = sync_products()
+    with metrics.stage("products"):
+        r1 = sync_products()
     print(f"✅ المنتجات: {r1['synced']} سجل")
 
-    # ✅ تصحيح البنود القديمة بعد جلب المنتجات مباشرة
-    try:
-        print("🔧 تصحيح البنود القديمة باستخدام product_code...")
-        fix_invoice_items_product_id_using_code()
-    except Exception as e:
-        print(f"❌ خطأ أثناء التصحيح (القديم): {e}")
-
-    print(f"🔄 مزامنة الفواتير... SUPABASE={os.getenv('SUPABASE_URL')}")
-    r2 = sync_invoices()
-    print(f"✅ الفواتير: {r2['invoices']} فاتورة، {r2['items']} بند")
+    print(f"🔄 مزامنة الفواتير ({SYNC_ENGINE})... SUPABASE={os.getenv('SUPABASE_URL')}")
+    with metrics.stage("invoices"):
+        if SYNC_ENGINE == "async":
+            from async_sync import main as sync_invoices_async
+            r2 = sync_invoices_async()
+        else:
+            r2 = sync_invoices()
+    print(f"✅ الفواتير: {r2['invoices_saved']} فاتورة، {r2['items_saved']} بند")
     
     # جلب البنود المفقودة
     print(f"🔍 البحث عن البنود المفقودة...")
@@ -26,30 +37,39 @@ def main():
         
         daftra_client = DaftraClient()
         supabase_client = SupabaseClient()
-        missing_stats = fetch_missing_items(daftra_client, supabase_client)
+        with metrics.stage("missing_items"):
+            missing_stats = fetch_missing_items(daftra_client, supabase_client)
         
         print(f"✅ البنود المفقودة: {missing_stats['items_saved']} تم جلبها")
     except Exception as e:
         print(f"❌ خطأ في البنود المفقودة: {e}")
     
-    # ✅ تصحيح البنود بعد جلب فواتير جديدة
+    # ✅ مرحلة تصحيح واحدة لكل البنود (القديمة والجديدة) بعد جلب الفواتير
     try:
-        print("🔧 تصحيح البنود الجديدة باستخدام product_code...")
-        fix_invoice_items_product_id_using_code()
+        print("🔧 تصحيح البنود باستخدام product_code...")
+        with metrics.stage("correction"):
+            fix_stats = correct_invoice_item_codes()
+        print(f"✅ التصحيح: {fix_stats['rows_changed']} من {fix_stats['rows_scanned']} بند خلال {fix_stats['seconds']} ث")
     except Exception as e:
-        print(f"❌ خطأ أثناء التصحيح (الجديد): {e}")
+        print(f"❌ خطأ أثناء التصحيح: {e}")
 
     # مزامنة العملاء
     try:
         print(f"🔄 مزامنة العملاء...")
         from customers_sync import main as sync_customers
-        r3 = sync_customers()
+        with metrics.stage("customers"):
+            r3 = sync_customers()
         print(f"✅ العملاء: {r3['customers_saved']} عميل")
     except Exception as e:
         print(f"❌ خطأ في العملاء: {e}")
         import traceback
         traceback.print_exc()
 
+    # إعادة استخدام الاتصالات عبر كل المراحل (مجمع http_transport المشترك)
+    from http_transport import reuse_stats
+    for host, stats in reuse_stats().items():
+        print(f"🔌 {host}: {stats['connections']} اتصال لـ {stats['requests']} طلب (إعادة استخدام {stats['reuse_ratio']:.0%})")
+
 if __name__ == '__main__':
     try:
         main()
@@ -0,0 +1,171 @@
+import os
+import re
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional, Tuple
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+# ملفات التصدير في نهاية كل تشغيل (نص فارغ = تعطيل)
+METRICS_JSON_FILE = os.getenv("METRICS_JSON_FILE", "sync_metrics.json")
+METRICS_PROM_FILE = os.getenv("METRICS_PROM_FILE", "sync_metrics.prom")
+METRICS_PREFIX = "daftra_sync"
+
+# حدود مدرج زمن الطلبات بالثواني
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def endpoint_of(url: str) -> Tuple[str, str]:
+    """(host, path) مع استبدال الأرقام بـ {id} حتى لا ينفجر عدد السلاسل"""
+    parts = urlsplit(url)
+    return parts.netloc, re.sub(r"/\d+(?=/|$)", "/{id}", parts.path) or "/"
+
+
+class Metrics:
+    """مقاييس تشغيل واحد: زمن كل مرحلة، الطلبات وزمنها لكل endpoint، والصفوف المكتوبة والمتخطاة"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.stages: Dict[str, Dict[str, Any]] = {}
+        self.requests: Dict[Tuple[str, str, str, str], int] = {}
+        self.latency: Dict[Tuple[str, str, str], Dict[str, Any]] = {}
+        self.rows: Dict[Tuple[str, str], int] = {}
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """قياس زمن مرحلة ونجاحها؛ تكرار نفس الاسم يجمع الأزمنة"""
+        started = time.perf_counter()
+        ok = True
+        try:
+            yield
+        except BaseException:
+            ok = False
+            raise
+        finally:
+            self.record_stage(name, time.perf_counter() - started, ok)
+
+    def record_stage(self, name: str, seconds: float, ok: bool = True) -> None:
+        """تسجيل زمن مرحلة مقاس مسبقًا"""
+        with self.lock:
+            entry = self.stages.setdefault(name, {'seconds': 0.0, 'runs': 0, 'failures': 0})
+            entry['seconds'] += seconds
+            entry['runs'] += 1
+            entry['failures'] += 0 if ok else 1
+
+    def observe_request(self, method: str, url: str, status: int, seconds: float) -> None:
+        host, path = endpoint_of(url)
+        with self.lock:
+            key = (host, method, path, str(status))
+            self.requests[key] = self.requests.get(key, 0) + 1
+            histogram = self.latency.setdefault((host, method, path), {
+                'buckets': [0] * len(LATENCY_BUCKETS), 'sum': 0.0, 'count': 0
+            })
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    histogram['buckets'][index] += 1
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+
+    def add_rows(self, table: str, written: int = 0, skipped: int = 0, failed: int = 0) -> None:
+        with self.lock:
+            for outcome, count in (('written', written), ('skipped', skipped), ('failed', failed)):
+                if count:
+                    self.rows[(table, outcome)] = self.rows.get((table, outcome), 0) + count
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                'started_at': self.started_at,
+                'finished_at': time.time(),
+                'stages': {name: {**entry, 'seconds': round(entry['seconds'], 3)} for name, entry in self.stages.items()},
+                'requests': [
+                    {'host': host, 'method': method, 'endpoint': path, 'status': status, 'count': count}
+                    for (host, method, path, status), count in sorted(self.requests.items())
+                ],
+                'latency': [
+                    {'host': host, 'method': method, 'endpoint': path, 'count': h['count'],
+                     'sum_seconds': round(h['sum'], 3), 'buckets': dict(zip(map(str, LATENCY_BUCKETS), h['buckets']))}
+                    for (host, method, path), h in sorted(self.latency.items())
+                ],
+                'rows': [
+                    {'table': table, 'outcome': outcome, 'count': count}
+                    for (table, outcome), count in sorted(self.rows.items())
+                ],
+            }
+
+    def to_prometheus(self) -> str:
+        """صيغة Prometheus النصية (node_exporter textfile collector)"""
+        data = self.to_dict()
+        p = METRICS_PREFIX
+        lines = []
+
+        def labels(**values) -> str:
+            escaped = (f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+                       for k, v in values.items())
+            return "{" + ",".join(escaped) + "}"
+
+        lines += [f"# HELP {p}_last_run_timestamp_seconds وقت انتهاء آخر تشغيل",
+                  f"# TYPE {p}_last_run_timestamp_seconds gauge",
+                  f"{p}_last_run_timestamp_seconds {data['finished_at']:.0f}"]
+
+        lines += [f"# HELP {p}_stage_duration_seconds زمن كل مرحلة في آخر تشغيل",
+                  f"# TYPE {p}_stage_duration_seconds gauge"]
+        lines += [f"{p}_stage_duration_seconds{labels(stage=name)} {s['seconds']}" for name, s in data['stages'].items()]
+        lines += [f"# HELP {p}_stage_failures عدد مرات فشل المرحلة في آخر تشغيل",
+                  f"# TYPE {p}_stage_failures gauge"]
+        lines += [f"{p}_stage_failures{labels(stage=name)} {s['failures']}" for name, s in data['stages'].items()]
+
+        lines += [f"# HELP {p}_http_requests_total عدد طلبات HTTP لكل endpoint وحالة",
+                  f"# TYPE {p}_http_requests_total counter"]
+        lines += [f"{p}_http_requests_total{labels(host=r['host'], method=r['method'], endpoint=r['endpoint'], status=r['status'])} {r['count']}"
+                  for r in data['requests']]
+
+        lines += [f"# HELP {p}_http_request_duration_seconds زمن طلبات HTTP لكل endpoint",
+                  f"# TYPE {p}_http_request_duration_seconds histogram"]
+        for h in data['latency']:
+            base = dict(host=h['host'], method=h['method'], endpoint=h['endpoint'])
+            for bound, count in h['buckets'].items():
+                lines.append(f"{p}_http_request_duration_seconds_bucket{labels(**base, le=bound)} {count}")
+            lines.append(f"{p}_http_request_duration_seconds_bucket{labels(**base, le='+Inf')} {h['count']}")
+            lines.append(f"{p}_http_request_duration_seconds_sum{labels(**base)} {h['sum_seconds']}")
+            lines.append(f"{p}_http_request_duration_seconds_count{labels(**base)} {h['count']}")
+
+        lines += [f"# HELP {p}_rows_total الصفوف المكتوبة والمتخطاة والفاشلة لكل جدول",
+                  f"# TYPE {p}_rows_total counter"]
+        lines += [f"{p}_rows_total{labels(table=r['table'], outcome=r['outcome'])} {r['count']}" for r in data['rows']]
+        return "\n".join(lines) + "\n"
+
+    def export(self, json_path: Optional[str] = METRICS_JSON_FILE,
+               prom_path: Optional[str] = METRICS_PROM_FILE) -> None:
+        """كتابة الملفين بشكل ذري (ملف مؤقت ثم استبدال) حتى لا يقرأ المجمّع ملفًا ناقصًا"""
+        outputs = []
+        if json_path:
+            outputs.append((json_path, json.dumps(self.to_dict(), ensure_ascii=False, indent=2)))
+        if prom_path:
+            outputs.append((prom_path, self.to_prometheus()))
+        for path, content in outputs:
+            try:
+                tmp_path = f"{path}.tmp"
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    f.write(content)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                logger.error(f"خطأ في كتابة المقاييس {path}: {e}")
+
+
+_metrics: Optional[Metrics] = None
+_metrics_lock = threading.Lock()
+
+
+def get_metrics() -> Metrics:
+    """مقاييس واحدة مشتركة لكل الوحدات في نفس العملية"""
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = Metrics()
+        return _metrics
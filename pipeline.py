@@ -0,0 +1,143 @@
+import os
+import time
+import queue
+import logging
+import threading
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# عدد العناصر (صفحات) المسموح انتظارها بين كل مرحلتين؛ يحد الذاكرة ويضغط على المرحلة الأسرع
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "4"))
+
+_DONE = object()
+
+
+class Stage:
+    """
+    مرحلة في خط المعالجة:
+    - الأولى: func() ترجع iterator بالعناصر
+    - الوسطى: func(item) ترجع العنصر التالي أو None لتجاهله
+    - الأخيرة: func(item) تستهلك العنصر، و finish() تُستدعى بعد آخر عنصر
+    """
+
+    def __init__(self, name: str, func: Callable, finish: Optional[Callable[[], None]] = None):
+        self.name = name
+        self.func = func
+        self.finish = finish
+        self.busy = 0.0
+        self.items = 0
+
+
+class Pipeline:
+    """تشغيل المراحل في threads متصلة بطوابير محدودة، مع قياس نسبة انشغال كل مرحلة"""
+
+    def __init__(self, name: str, stages: List[Stage], queue_size: int = PIPELINE_QUEUE_SIZE):
+        self.name = name
+        self.stages = stages
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in stages[1:]]
+        self.stop = threading.Event()
+        self.errors: List[BaseException] = []
+        self.wall = 0.0
+
+    def _put(self, q: queue.Queue, item: Any) -> bool:
+        while not self.stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q: queue.Queue) -> Any:
+        while not self.stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _items(self, index: int) -> Iterable[Any]:
+        """العناصر الداخلة للمرحلة index"""
+        stage = self.stages[index]
+        if index == 0:
+            iterator = iter(stage.func())
+            while not self.stop.is_set():
+                started = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    stage.busy += time.perf_counter() - started
+                yield item
+            return
+
+        while True:
+            item = self._get(self.queues[index - 1])
+            if item is _DONE:
+                return
+            yield item
+
+    def _run_stage(self, index: int) -> None:
+        stage = self.stages[index]
+        is_source = index == 0
+        is_sink = index == len(self.stages) - 1
+        failed = False
+        try:
+            for item in self._items(index):
+                if is_source:
+                    output = item
+                else:
+                    started = time.perf_counter()
+                    output = stage.func(item)
+                    stage.busy += time.perf_counter() - started
+                stage.items += 1
+                if not is_sink and output is not None:
+                    if not self._put(self.queues[index], output):
+                        break
+        except BaseException as e:
+            failed = True
+            logger.error(f"خطأ في مرحلة {stage.name} ({self.name}): {e}")
+            self.errors.append(e)
+            self.stop.set()
+        finally:
+            if not is_sink:
+                # نبلغ المرحلة التالية بالانتهاء وننتظر مكانًا في الطابور مهما طال؛
+                # عند التوقف بخطأ المراحل التالية تخرج من نفسها عبر self.stop
+                self._put(self.queues[index], _DONE)
+
+        # الكتابة النهائية لما تم تنظيفه فعلاً، إلا إذا فشلت مرحلة الكتابة نفسها
+        if is_sink and stage.finish and not failed:
+            started = time.perf_counter()
+            try:
+                stage.finish()
+            except BaseException as e:
+                logger.error(f"خطأ في إنهاء مرحلة {stage.name} ({self.name}): {e}")
+                self.errors.append(e)
+            stage.busy += time.perf_counter() - started
+
+    def run(self) -> Dict[str, Dict[str, float]]:
+        started = time.perf_counter()
+        threads = [
+            threading.Thread(target=self._run_stage, args=(index,), name=f"{self.name}-{stage.name}", daemon=True)
+            for index, stage in enumerate(self.stages)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.wall = time.perf_counter() - started
+        return self.utilisation()
+
+    def utilisation(self) -> Dict[str, Dict[str, float]]:
+        """نسبة وقت انشغال كل مرحلة من الزمن الكلي: الأعلى هو عنق الزجاجة"""
+        wall = self.wall or 1e-9
+        return {
+            stage.name: {
+                'items': stage.items,
+                'busy_seconds': round(stage.busy, 2),
+                'utilisation': round(stage.busy / wall, 3),
+            }
+            for stage in self.stages
+        }
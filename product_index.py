@@ -0,0 +1,241 @@
+import os
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+from json_codec import decode_response
+from supabase_reader import iter_keyset
+
+logger = logging.getLogger(__name__)
+
+PRODUCT_INDEX_PAGE_SIZE = int(os.getenv("PRODUCT_INDEX_PAGE_SIZE", "1000"))
+PRODUCT_INDEX_MAX_ENTRIES = int(os.getenv("PRODUCT_INDEX_MAX_ENTRIES", "200000"))
+# بعد فشل التحميل الكامل: طلبات لكل منتج فقط، ولا نعيد التحميل الكامل قبل هذه المدة
+PRODUCT_INDEX_RETRY_SECONDS = float(os.getenv("PRODUCT_INDEX_RETRY_SECONDS", "300"))
+
+
+class ProductCodeIndex:
+    """
+    فهرس product_id -> product_code في الذاكرة بدل طلب Supabase لكل بند،
+    ومعه (code أو name) -> المنتج لمرحلة التصحيح، بنفس حد الحجم والطرد.
+    """
+
+    def __init__(self, session, base_url: str,
+                 page_size: int = PRODUCT_INDEX_PAGE_SIZE,
+                 max_entries: int = PRODUCT_INDEX_MAX_ENTRIES):
+        self.session = session
+        self.base_url = base_url
+        self.page_size = page_size
+        self.max_entries = max_entries
+        # LRU: آخر عنصر هو الأحدث استخدامًا
+        self._codes: "OrderedDict[str, str]" = OrderedDict()
+        # code/name -> (product_id كما في الجدول، code)، والمفاتيح المسجلة لكل منتج لحذفها مع طرده
+        self._by_code: Dict[str, Tuple[Any, str]] = {}
+        self._aliases: Dict[str, Tuple[str, ...]] = {}
+        self._last_product_id: Optional[Any] = None
+        self.loaded = False
+        # وقت المحاولة التالية للتحميل الكامل بعد فشله (0 = متاح الآن)
+        self._retry_load_at = 0.0
+        # الفروع المتوازية تتشارك نفس الفهرس
+        self.lock = threading.RLock()
+        self.stats = {'hits': 0, 'misses': 0, 'remote_lookups': 0, 'evictions': 0, 'rows_loaded': 0,
+                      'load_failures': 0}
+
+    def _put(self, product_id: str, code: str, name: str = "", raw_id: Any = None) -> None:
+        self._codes[product_id] = code
+        self._codes.move_to_end(product_id)
+        self._drop_aliases(product_id)
+        if code or name:
+            product = (product_id if raw_id is None else raw_id, code)
+            if code:
+                self._by_code[code] = product
+            if name and name not in self._by_code:
+                self._by_code[name] = product
+            self._aliases[product_id] = (code, name)
+        while len(self._codes) > self.max_entries:
+            evicted, _ = self._codes.popitem(last=False)
+            self._drop_aliases(evicted)
+            self.stats['evictions'] += 1
+
+    def _drop_aliases(self, product_id: str) -> None:
+        for key in self._aliases.pop(product_id, ()):
+            product = self._by_code.get(key)
+            if product is not None and str(product[0]) == product_id:
+                del self._by_code[key]
+
+    def _load_since(self, last_product_id: Optional[Any]) -> int:
+        """تحميل المنتجات على صفحات مرتبة حسب product_id بعد آخر قيمة محملة"""
+        loaded = 0
+        rows = iter_keyset(self._get, self.base_url, 'products', 'product_id,product_code,name',
+                           key='product_id', page_size=self.page_size, filters='product_id=not.is.null',
+                           after=last_product_id, count='exact')
+        for row in rows:
+            pid = row.get('product_id')
+            if pid is None:
+                continue
+            self._put(str(pid), (row.get('product_code') or '').strip(), (row.get('name') or '').strip(), pid)
+            # نحفظ القيمة كما هي (رقم أو نص) عشان المقارنة gt تبقى بنفس نوع العمود
+            self._last_product_id = pid
+            loaded += 1
+
+        self.stats['rows_loaded'] += loaded
+        return loaded
+
+    def _get(self, url: str, headers: Optional[Dict[str, str]] = None):
+        return self.session.get(url, headers=headers, timeout=30)
+
+    def load(self) -> int:
+        """تحميل كامل للفهرس مرة واحدة في بداية التشغيل"""
+        with self.lock:
+            if not self._load_due():
+                return 0
+            return self._load_all()
+
+    def _load_due(self) -> bool:
+        """التحميل الكامل مطلوب: لم يتم بعد، ولسنا في مهلة ما بعد الفشل"""
+        return not self.loaded and time.monotonic() >= self._retry_load_at
+
+    def _load_all(self) -> int:
+        try:
+            count = self._load_since(None)
+        except Exception as e:
+            # بدون مهلة كان كل get_code يعيد قراءة الجدول كاملًا وهو ماسك القفل المشترك
+            self.stats['load_failures'] += 1
+            self._retry_load_at = time.monotonic() + PRODUCT_INDEX_RETRY_SECONDS
+            logger.error(f"خطأ في تحميل فهرس المنتجات: {e}؛ طلبات لكل منتج حتى المحاولة التالية "
+                         f"بعد {PRODUCT_INDEX_RETRY_SECONDS:.0f} ث")
+            return 0
+        self.loaded = True
+        logger.info(f"تم تحميل {count} منتج في فهرس الأكواد")
+        return count
+
+    def refresh(self) -> int:
+        """تحديث تزايدي: جلب المنتجات الجديدة فقط بعد آخر product_id محمل"""
+        with self.lock:
+            if not self.loaded:
+                return self._load_all() if self._load_due() else 0
+            return self._refresh_locked()
+
+    def _refresh_locked(self) -> int:
+        try:
+            count = self._load_since(self._last_product_id)
+        except Exception as e:
+            logger.error(f"خطأ في تحديث فهرس المنتجات: {e}")
+            return 0
+        if count:
+            logger.info(f"تم إضافة {count} منتج جديد لفهرس الأكواد")
+        return count
+
+    def _fetch_one(self, product_id: str) -> Optional[str]:
+        """
+        جلب منتج واحد عند عدم وجوده في الفهرس (منتج جديد أو تم طرده)؛ يُستدعى بدون القفل.
+        نص فارغ إذا أكد Supabase أن المنتج غير موجود، و None عند خطأ (لا يُخزن).
+        """
+        with self.lock:
+            self.stats['remote_lookups'] += 1
+        url = f"{self.base_url}/products?product_id=eq.{product_id}&select=product_code"
+        response = self.session.get(url, timeout=10)
+        if response.status_code != 200:
+            logger.error(f"خطأ في جلب كود المنتج {product_id}: {response.status_code}")
+            return None
+        products = decode_response(response)
+        if products:
+            return (products[0].get('product_code') or '').strip()
+        return ""
+
+    def prefetch(self, product_ids: Iterable[Any], chunk_size: int = 200) -> int:
+        """
+        جلب كل المنتجات غير الموجودة في الفهرس بطلب product_id=in.(...) لكل chunk_size،
+        حتى لا يحتاج get_code بعدها أي طلب (المحرك غير المتزامن يستدعيها في thread قبل التنظيف).
+        """
+        with self.lock:
+            if self._load_due():
+                self._load_all()
+            missing = sorted({str(pid) for pid in product_ids if pid} - self._codes.keys())
+        fetched = 0
+        for start in range(0, len(missing), chunk_size):
+            chunk = missing[start:start + chunk_size]
+            with self.lock:
+                self.stats['remote_lookups'] += 1
+            url = f"{self.base_url}/products?product_id=in.({','.join(chunk)})&select=product_id,product_code,name"
+            try:
+                response = self.session.get(url, timeout=30)
+                if response.status_code != 200:
+                    logger.error(f"خطأ في جلب أكواد {len(chunk)} منتج: {response.status_code}")
+                    continue
+                rows = {str(row['product_id']): row for row in decode_response(response)}
+            except Exception as e:
+                logger.error(f"خطأ في جلب أكواد {len(chunk)} منتج: {e}")
+                continue
+            with self.lock:
+                # غير الموجود يُخزن فارغًا مثل _fetch_one
+                for product_id in chunk:
+                    row = rows.get(product_id, {})
+                    self._put(product_id, (row.get('product_code') or '').strip(),
+                              (row.get('name') or '').strip(), row.get('product_id'))
+            fetched += len(chunk)
+        return fetched
+
+    def get_code(self, product_id: str) -> str:
+        """
+        إرجاع الكود الصحيح للمنتج، أو نص فارغ إذا لم يوجد.
+        القفل للفهرس فقط: طلب المنتج غير الموجود يتم خارجه حتى لا ينتظر باقي الفروع والمراحل خلفه.
+        """
+        if not product_id:
+            return ""
+        product_id = str(product_id)
+        with self.lock:
+            if self._load_due():
+                self._load_all()
+            code = self._codes.get(product_id)
+            if code is not None:
+                self.stats['hits'] += 1
+                self._codes.move_to_end(product_id)
+                return code
+            self.stats['misses'] += 1
+
+        try:
+            code = self._fetch_one(product_id)
+        except Exception as e:
+            logger.error(f"خطأ في جلب كود المنتج {product_id}: {e}")
+            return ""
+        if code is None:
+            # خطأ مؤقت (429/5xx): البند الحالي يأخذ كود دفترة الاحتياطي، والبنود التالية تحاول مجددًا
+            return ""
+
+        # نخزن النتيجة المؤكدة حتى لو فارغة عشان ما نكرر الطلب لنفس المنتج
+        with self.lock:
+            # التحميل أو prefetch قد يكون أضافه أثناء الطلب ومعه الاسم، فلا نستبدله
+            if product_id not in self._codes:
+                self._put(product_id, code)
+        return code
+
+    def find(self, code_or_name: str) -> Optional[Tuple[Any, str]]:
+        """(product_id, product_code) للمنتج بهذا الكود أو الاسم من المحمل في الفهرس، أو None"""
+        if not code_or_name:
+            return None
+        with self.lock:
+            if self._load_due():
+                self._load_all()
+            return self._by_code.get(code_or_name)
+
+    def __len__(self) -> int:
+        return len(self._codes)
+
+    def summary(self) -> Dict[str, int]:
+        return {**self.stats, 'size': len(self._codes)}
+
+
+_index: Optional[ProductCodeIndex] = None
+_index_lock = threading.Lock()
+
+
+def get_product_index(session, base_url: str) -> ProductCodeIndex:
+    """فهرس واحد مشترك في العملية: خط الفواتير والبنود المفقودة ومرحلة التصحيح تحمله مرة واحدة"""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = ProductCodeIndex(session, base_url)
+        return _index
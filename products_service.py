@@ -1,6 +1,17 @@
 import os
-import requests
 import time
+from urllib.parse import urlencode
+
+from daftra_paginator import DaftraPaginator, list_error
+from dead_letter import get_dead_letter_store
+from http_transport import create_session, shared_session
+from json_codec import decode_response, dumps, send_body
+from metrics import get_metrics
+from product_index import get_product_index
+from records import ItemRecord
+from rate_limiter import send
+from supabase_reader import iter_keyset
+from sync_utils import Checkpoint, Watermark, get_fingerprint_store
 
 DAFTRA_URL    = os.getenv("DAFTRA_URL")
 DAFTRA_APIKEY = os.getenv("DAFTRA_APIKEY")
@@ -18,20 +29,27 @@ HEADERS_SB     = {
 REQUEST_TIMEOUT = int(os.getenv("REQUEST_TIMEOUT", "30"))
 MAX_RETRIES     = int(os.getenv("MAX_RETRIES", "3"))
 RETRY_DELAY     = int(os.getenv("RETRY_DELAY", "2"))
+# عدد المنتجات في كل طلب upsert
+PRODUCTS_BATCH_SIZE = int(os.getenv("PRODUCTS_BATCH_SIZE", "500"))
+# عدد البنود المصححة في كل طلب upsert أثناء التصحيح
+CORRECTION_CHUNK_SIZE = int(os.getenv("CORRECTION_CHUNK_SIZE", "200"))
+# عدد البنود التي تُجمع منتجاتها الناقصة من الفهرس في طلبات مجمعة قبل التصحيح
+CORRECTION_LOOKUP_BLOCK = int(os.getenv("CORRECTION_LOOKUP_BLOCK", "1000"))
 
 
 # ====== Request helpers ======
 def fetch_with_retry(url, headers, retries=3, timeout=30):
-    for i in range(retries):
-        try:
-            r = requests.get(url, headers=headers, timeout=timeout)
-            print(f"> GET {url} → {r.status_code}")
-            if r.status_code == 200:
-                return r.json()
-        except Exception as e:
-            print("! fetch error:", e)
-        time.sleep((i + 1) * 5)
-    return None
+    # حد المعدل المشترك لدفترة يتكفل بالانتظار: Retry-After عند 429 وانتظار أسي عند 5xx،
+    # وأي حالة أخرى (مثل 404) ترجع فورًا بدون انتظار
+    r = send(shared_session(), "GET", url, retries=retries, headers=headers, timeout=timeout)
+    if r is None:
+        print(f"! fetch error: GET {url}")
+        return None
+    print(f"> GET {url} → {r.status_code}")
+    if r.status_code == 200:
+        return decode_response(r)
+    # كود الحالة يصل للترقيم حتى يفرق بين رفض limit وفشل مؤقت
+    return list_error(r.status_code)
 
 
 def supabase_request_with_retry(
@@ -48,9 +66,11 @@ def supabase_request_with_retry(
     - لو كل المحاولات فشلت يرفع Exception (ونحن بنمسكه في مكان الاستدعاء عشان ما يرجع Page 1)
     """
     last_err = None
+    # الجسم يُرمز مرة واحدة لكل المحاولات
+    body = dumps(json) if json is not None else None
     for i in range(retries):
         try:
-            r = requests.request(method, url, headers=headers, json=json, timeout=timeout)
+            r = send_body(shared_session(), method, url, body, headers, timeout=timeout)
             return r
         except Exception as e:
             last_err = e
@@ -72,181 +92,301 @@ def safe_text(value):
     return str(value) if value is not None else ""
 
 
+def _stream_rows(table, select, key):
+    """قراءة جدول كامل بالترقيم حسب المفتاح (keyset) مع إعادة المحاولة والتحقق من العدد الكلي"""
+    return iter_keyset(
+        lambda url, headers: supabase_request_with_retry("GET", url, headers={**HEADERS_SB, **headers}),
+        f"{SUPABASE_URL}/rest/v1", table, select, key=key, count="exact",
+    )
+
+
+def fetch_existing_product_ids():
+    """قراءة product_id الموجودة في Supabase مرة واحدة لحساب الجديد مقابل المحدث"""
+    return {str(row["product_id"]) for row in _stream_rows("products", "product_id", "product_id")}
+
+
+def build_product_payload(prod):
+    code = (
+        prod.get("code")
+        or prod.get("product_code")
+        or prod.get("supplier_code")
+        or ""
+    )
+
+    pid = prod.get("id")
+    payload = {
+        "product_id":        pid,
+        "daftra_product_id": str(pid),
+        "product_code":      safe_text(code),
+        "name":              safe_text(prod.get("name", "")),
+        "stock_balance":     safe_number(prod.get("stock_balance", 0)),
+        "buy_price":         safe_number(prod.get("buy_price", 0)),
+        "average_price":     safe_number(prod.get("average_price", 0)),
+        "minimum_price":     safe_number(prod.get("minimum_price", 0)),
+        "supplier_code":     safe_text(prod.get("supplier_code", ""))
+    }
+
+    return {k: v for k, v in payload.items() if v is not None and k != "id"}
+
+
+def upsert_products(payloads):
+    """رفع دفعة منتجات في طلب واحد. يرجع True إذا نجح"""
+    # نفس المنتج مرتين في نفس الطلب يكسر on_conflict، فنبقي آخر نسخة
+    unique = list({str(p["product_id"]): p for p in payloads}.values())
+    try:
+        resp = supabase_request_with_retry(
+            "POST",
+            f"{SUPABASE_URL}/rest/v1/products?on_conflict=product_id",
+            headers={**HEADERS_SB, "Prefer": "resolution=merge-duplicates,return=minimal"},
+            json=unique,
+        )
+    except Exception as e:
+        print(f"! upsert failed for {len(unique)} products | error:", e)
+        return False
+
+    if resp is None:
+        print(f"! upsert got no response for {len(unique)} products")
+        return False
+
+    if resp.status_code >= 300:
+        print(f"! upsert failed for {len(unique)} products → {resp.status_code} | {resp.text}")
+        return False
+
+    return True
+
+
 def sync_products():
     created_count = 0
     updated_count = 0
-    page = 1
-    limit = 50
+    unchanged_count = 0
+    failed_count = 0
+    started = time.time()
+
+    # علامة آخر تزامن ناجح: نجلب المنتجات المعدلة بعدها فقط
+    watermark = Watermark("products")
+    since = watermark.list_params()
+    if watermark.is_incremental:
+        print(f"> incremental products sync since {watermark.synced_at}")
+    complete = True
+
+    # استئناف تشغيل منقطع من آخر صفحة حُفظت بدل الصفحة 1
+    checkpoint = Checkpoint("products", watermark=watermark)
+    if checkpoint.resume_page > 1:
+        print(f"> resuming products sync from page {checkpoint.resume_page}")
+
+    # قراءة واحدة للمعرفات الموجودة بدل الاعتماد على كود الاستجابة لكل منتج
+    try:
+        existing_ids = fetch_existing_product_ids()
+    except Exception as e:
+        print("! could not read existing product ids, counting all as updated:", e)
+        existing_ids = None
+
+    pending = []
+
+    fingerprints = get_fingerprint_store()
+    dead_letters = get_dead_letter_store()
+
+    def flush():
+        nonlocal created_count, updated_count, unchanged_count, failed_count, pending, complete
+        if not pending:
+            return
+
+        # المنتجات التي لم يتغير محتواها منذ آخر رفع لا تُرسل
+        to_send, fingerprint_pending = pending, []
+        if fingerprints:
+            to_send, fingerprint_pending = fingerprints.filter_changed("products", pending, key="product_id")
+        unchanged_count += len(pending) - len(to_send)
+
+        if not to_send:
+            pending = []
+            return
+
+        if upsert_products(to_send):
+            if fingerprints:
+                fingerprints.commit(fingerprint_pending)
+            for payload in to_send:
+                pid = str(payload["product_id"])
+                if existing_ids is not None and pid not in existing_ids:
+                    created_count += 1
+                    existing_ids.add(pid)
+                else:
+                    updated_count += 1
+        else:
+            # ====== مهم: لو فشل Supabase لا نكسر اللوب ولا نرجع Page 1 ======
+            failed_count += len(to_send)
+            complete = False
+            if dead_letters:
+                dead_letters.add("products", to_send, "upsert failed")
+        pending = []
 
-    while True:
+    def fetch_page(page, limit):
         url = f"{DAFTRA_URL}/v2/api/entity/product/list/1?page={page}&limit={limit}"
-        data = fetch_with_retry(
+        if since:
+            url += "&" + urlencode(since)
+        return fetch_with_retry(
             url,
             HEADERS_DAFTRA,
             retries=MAX_RETRIES,
             timeout=REQUEST_TIMEOUT
         )
 
-        items = data.get("data", []) if data else []
-        print(f"> Page {page}: found {len(items)} items")
-        if not items:
+    # ينتهي عند page_count بدل صفحة فارغة، ويجلب الصفحة التالية أثناء رفع الحالية
+    paginator = DaftraPaginator("product/list", fetch_page,
+                                start_page=checkpoint.resume_page, limit=checkpoint.limit)
+    for page, items in paginator:
+        if items is None:
+            print(f"! Page {page}: no data, stopping")
+            complete = False
             break
+        print(f"> Page {page}/{paginator.page_count or '?'}: found {len(items)} items")
 
-        for raw in items:
-            prod = raw.get("Product") if isinstance(raw, dict) and "Product" in raw else raw
+        products = [raw.get("Product") if isinstance(raw, dict) and "Product" in raw else raw for raw in items]
+        if watermark.page_already_synced(products):
+            print(f"> Page {page}: reached already-synced products, stopping early")
+            break
 
+        for prod in products:
             pid = prod.get("id")
             if not pid:
                 print("! skipping item without id:", prod)
                 continue
 
-            code = (
-                prod.get("code")
-                or prod.get("product_code")
-                or prod.get("supplier_code")
-                or ""
-            )
-
-            payload = {
-                "product_id":        pid,
-                "daftra_product_id": str(pid),
-                "product_code":      safe_text(code),
-                "name":              safe_text(prod.get("name", "")),
-                "stock_balance":     safe_number(prod.get("stock_balance", 0)),
-                "buy_price":         safe_number(prod.get("buy_price", 0)),
-                "average_price":     safe_number(prod.get("average_price", 0)),
-                "minimum_price":     safe_number(prod.get("minimum_price", 0)),
-                "supplier_code":     safe_text(prod.get("supplier_code", ""))
-            }
-
-            payload = {k: v for k, v in payload.items() if v is not None and k != "id"}
+            watermark.observe(prod)
+            pending.append(build_product_payload(prod))
 
-            print(">> upsert product:", payload)
+        if len(pending) >= PRODUCTS_BATCH_SIZE:
+            flush()
+            # كل الصفحات حتى هذه حُفظت؛ بعد أي فشل لا نحرك النقطة
+            if not complete:
+                checkpoint.freeze()
+            checkpoint.save(page, paginator.limit)
 
-            # ====== مهم: لو فشل Supabase لا نكسر اللوب ولا نرجع Page 1 ======
-            try:
-                resp = supabase_request_with_retry(
-                    "POST",
-                    f"{SUPABASE_URL}/rest/v1/products?on_conflict=product_id",
-                    headers={**HEADERS_SB, "Prefer": "resolution=merge-duplicates"},
-                    json=payload,
-                )
-            except Exception as e:
-                print("! upsert failed, skipping product:", pid, "| error:", e)
-                continue  # يكمل على المنتج اللي بعده
-
-            # أمان إضافي لو رجّع None لأي سبب
-            if resp is None:
-                print("! upsert got no response, skipping product:", pid)
-                continue
+    flush()
+    print(f"> {paginator.requests} list requests (limit={paginator.limit})")
 
-            print(f"   → {resp.status_code} | {resp.text}")
-            if resp.status_code == 201:
-                created_count += 1
-            elif resp.status_code == 200:
-                updated_count += 1
-
-        page += 1
-        time.sleep(1)
+    if complete:
+        watermark.commit()
+        checkpoint.clear()
 
     total = created_count + updated_count
+    elapsed = max(time.time() - started, 1e-6)
+    get_metrics().add_rows("products", written=total, skipped=unchanged_count, failed=failed_count)
     print(f"\n✅ تم رفع {created_count} منتج جديد")
     print(f"🔁 تم تحديث {updated_count} منتج موجود")
-    print(f"📦 الإجمالي: {total} منتج\n")
+    if unchanged_count:
+        saved = fingerprints.summary().get("products", {}) if fingerprints else {}
+        print(f"⏭️ {unchanged_count} منتج بدون تغيير لم يُرسل "
+              f"({saved.get('skip_ratio', 0):.0%}، تم توفير {saved.get('bytes_saved', 0)} بايت)")
+    if failed_count:
+        print(f"❌ فشل رفع {failed_count} منتج")
+    print(f"📦 الإجمالي: {total} منتج خلال {elapsed:.1f} ث ({total / elapsed:.1f} منتج/ث)\n")
 
-    return {"synced": total}
+    return {"synced": total, "created": created_count, "updated": updated_count,
+            "unchanged": unchanged_count, "failed": failed_count, "products_per_second": round(total / elapsed, 1)}
 
 
-def fix_invoice_items_product_id_using_code():
-    print("🔧 تصحيح شامل للبنود (product_id + product_code) من المنتجات...")
+def product_index():
+    """نفس فهرس المنتجات الذي يستخدمه خط الفواتير (get_product_index)، فلا يُقرأ الجدول مرتين في التشغيل"""
+    return get_product_index(create_session(HEADERS_SB), f"{SUPABASE_URL.rstrip('/')}/rest/v1")
 
-    # 1. تحميل المنتجات
-    url_products = f"{SUPABASE_URL}/rest/v1/products?select=product_id,product_code,name"
-    try:
-        res = supabase_request_with_retry("GET", url_products, headers=HEADERS_SB)
-    except Exception as e:
-        print("❌ فشل في جلب المنتجات بسبب خطأ اتصال:", e)
-        return
 
-    if res is None or res.status_code != 200:
-        print("❌ فشل في جلب المنتجات")
-        return
-
-    code_map = {}
-    for p in res.json():
-        pid = p.get("product_id")
-        code = p.get("product_code", "").strip()
-        name = p.get("name", "").strip()
-
-        if pid:
-            if code:
-                code_map[code] = {"product_id": pid, "product_code": code}
-            if name and name not in code_map:
-                code_map[name] = {"product_id": pid, "product_code": code}
+def correct_invoice_item_codes():
+    """
+    مرحلة تصحيح واحدة للبنود: قراءة invoice_items مرة واحدة، حساب المتغير في الذاكرة،
+    ثم كتابة الصفوف المتغيرة كاملة (upsert on_conflict=id) كل CORRECTION_CHUNK_SIZE صف في طلب،
+    فعدد الطلبات يتبع عدد البنود المصححة وليس عدد المنتجات المختلفة.
+    الصف كامل (كل أعمدة المزامنة) فلا يصل لمسار الإدراج بأعمدة ناقصة.
+    """
+    print("🔧 تصحيح شامل للبنود (product_id + product_code) من المنتجات...")
+    started = time.time()
+    stats = {"rows_scanned": 0, "rows_changed": 0, "rows_failed": 0, "write_requests": 0, "seconds": 0.0}
 
-    print(f"📦 عدد المنتجات المحملة: {len(code_map)}")
+    # تحميل كامل إذا لم يحمله خط الفواتير، وإلا المنتجات الجديدة فقط
+    index = product_index()
+    index.refresh()
+    if not index.loaded:
+        print("❌ فشل في جلب المنتجات")
+        return stats
 
-    # 2. تحديث البنود
-    limit = 1000
-    offset = 0
-    total_updated = 0
+    print(f"📦 عدد المنتجات المحملة: {len(index)}")
 
-    while True:
-        url_items = f"{SUPABASE_URL}/rest/v1/invoice_items?select=id,product_id,product_code&limit={limit}&offset={offset}"
+    # الصفوف المصححة كاملة بانتظار الكتابة
+    pending = []
+    dead_letters = get_dead_letter_store()
 
+    def flush():
+        rows = pending[:]
+        pending.clear()
         try:
-            res = supabase_request_with_retry("GET", url_items, headers=HEADERS_SB)
+            res = supabase_request_with_retry(
+                "POST",
+                f"{SUPABASE_URL}/rest/v1/invoice_items?on_conflict=id",
+                headers={**HEADERS_SB, "Prefer": "resolution=merge-duplicates,return=minimal"},
+                json=rows,
+            )
         except Exception as e:
-            print("❌ فشل في جلب البنود بسبب خطأ اتصال:", e)
-            break
+            print(f"! correction upsert failed for {len(rows)} items | error:", e)
+            res = None
+        stats["write_requests"] += 1
+
+        if res is not None and res.status_code in [200, 201, 204]:
+            stats["rows_changed"] += len(rows)
+        else:
+            if res is not None:
+                print(f"! correction upsert failed for {len(rows)} items | status:", res.status_code)
+            stats["rows_failed"] += len(rows)
+            if dead_letters:
+                dead_letters.add("invoice_items", rows, "code correction failed")
+
+    def correct(rows):
+        # المنتجات غير الموجودة في الفهرس (مطرودة أو جديدة) بطلب مجمع بدل طلب لكل بند
+        index.prefetch(row.get("product_id") for row in rows)
+        for row in rows:
+            current_pid = row.get("product_id")
+            current_code = (row.get("product_code") or "").strip()
+
+            # الأولوية للمطابقة بالكود/الاسم، ثم الكود الصحيح حسب product_id
+            match = index.find(current_code)
+            pid_code = index.get_code(current_pid) if current_pid and not match else ""
+            if match:
+                new_pid, new_code = match
+            elif pid_code:
+                new_pid, new_code = current_pid, pid_code
+            else:
+                continue
 
-        if res is None or res.status_code != 200:
-            print("❌ فشل في جلب البنود")
-            break
+            if str(current_pid) == str(new_pid) and current_code == new_code:
+                continue
 
-        items = res.json()
-        if not items:
-            break
+            row["product_id"], row["product_code"] = new_pid, new_code
+            pending.append(row)
+            if len(pending) >= CORRECTION_CHUNK_SIZE:
+                flush()
 
-        for row in items:
-            item_id = row["id"]
-            current_pid = row.get("product_id")
-            current_code = row.get("product_code", "").strip()
+    try:
+        block = []
+        for row in _stream_rows("invoice_items", ",".join(ItemRecord.FIELDS), "id"):
+            stats["rows_scanned"] += 1
+            block.append(row)
+            if len(block) >= CORRECTION_LOOKUP_BLOCK:
+                correct(block)
+                block = []
+        correct(block)
+
+        if pending:
+            flush()
+    except Exception as e:
+        print("❌ فشل في جلب البنود:", e)
+
+    stats["seconds"] = round(time.time() - started, 2)
+    get_metrics().add_rows("invoice_items", written=stats["rows_changed"], failed=stats["rows_failed"])
+    print(f"\n✅ تم فحص {stats['rows_scanned']} بند، تصحيح {stats['rows_changed']} بند "
+          f"بـ {stats['write_requests']} طلب خلال {stats['seconds']} ث")
+    if stats["rows_failed"]:
+        print(f"❌ فشل تصحيح {stats['rows_failed']} بند")
+
+    return stats
 
-            match = code_map.get(current_code)
-            if not match:
-                continue
 
-            new_pid = match["product_id"]
-            new_code = match["product_code"]
-
-            if str(current_pid) != str(new_pid) or current_code != new_code:
-                patch_url = f"{SUPABASE_URL}/rest/v1/invoice_items?id=eq.{item_id}"
-                patch_payload = {
-                    "product_id": new_pid,
-                    "product_code": new_code
-                }
-
-                # ====== مهم: لو PATCH فشل ما نرجع من البداية ======
-                try:
-                    res_patch = supabase_request_with_retry(
-                        "PATCH",
-                        patch_url,
-                        headers=HEADERS_SB,
-                        json=patch_payload
-                    )
-                except Exception as e:
-                    print("! patch failed, skipping item:", item_id, "| error:", e)
-                    continue
-
-                if res_patch is None:
-                    print("! patch got no response, skipping item:", item_id)
-                    continue
-
-                if res_patch.status_code in [200, 204]:
-                    print(f"✅ بند {item_id} ← product_id = {new_pid} ، code = {new_code}")
-                    total_updated += 1
-
-        offset += limit
-
-    print(f"\n✅ تم تحديث {total_updated} بند بنجاح.")
+# الاسم القديم للتوافق
+fix_invoice_items_product_id_using_code = correct_invoice_item_codes
@@ -0,0 +1,206 @@
+import os
+import time
+import random
+import logging
+import threading
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, Optional
+from urllib.parse import urlparse
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# ميزانية الطلبات المشتركة لدفترة: كل الفروع والعمال والوحدات يسحبون من نفس الدلو
+DAFTRA_RATE_LIMIT = float(os.getenv("DAFTRA_RATE_LIMIT", "20"))  # المعدل الابتدائي طلب/ثانية، 0 = بدون حد
+DAFTRA_RATE_BURST = int(os.getenv("DAFTRA_RATE_BURST", "20"))
+# حدود التكيف: المعدل يرتفع تدريجيًا مع النجاح وينخفض مع 429 والأخطاء والبطء
+DAFTRA_RATE_MIN = float(os.getenv("DAFTRA_RATE_MIN", "1"))
+DAFTRA_RATE_MAX = float(os.getenv("DAFTRA_RATE_MAX", "50"))
+RATE_INCREASE_STEP = float(os.getenv("RATE_INCREASE_STEP", "0.1"))  # زيادة المعدل بعد كل نجاح
+RATE_LATENCY_TARGET = float(os.getenv("RATE_LATENCY_TARGET", "2"))  # ثواني؛ أبطأ من كذا نخفف الضغط
+# إعادة المحاولة: انتظار أسي مع عشوائية بدل 5/10/15 ثانية الثابتة
+HTTP_MAX_RETRIES = int(os.getenv("MAX_RETRIES", "3"))
+RETRY_BACKOFF_BASE = float(os.getenv("RETRY_BACKOFF_BASE", "0.5"))
+RETRY_BACKOFF_MAX = float(os.getenv("RETRY_BACKOFF_MAX", "30"))
+
+THROTTLE_STATUSES = {429, 503}
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """دلو توكنات: يسمح بدفعة حتى burst ثم بمعدل rate طلب في الثانية"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        # لا طلبات قبل هذا الوقت (Retry-After)
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'waits': 0, 'wait_seconds': 0.0}
+
+    def _refill(self, now: float) -> None:
+        if self.rate > 0:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        """حجز طلب واحد بدون انتظار؛ يرجع كم ثانية لازم ننتظر قبل الإرسال"""
+        with self.lock:
+            now = time.monotonic()
+            wait = max(0.0, self.blocked_until - now)
+            if self.rate > 0:
+                self._refill(now)
+                # نحجز التوكن فورًا (حتى لو صار الرصيد سالبًا) عشان الطلبات المنتظرة تصطف بالترتيب
+                self.tokens -= 1
+                if self.tokens < 0:
+                    wait = max(wait, -self.tokens / self.rate)
+            self.stats['requests'] += 1
+            if wait:
+                self.stats['waits'] += 1
+                self.stats['wait_seconds'] += wait
+            return wait
+
+    def acquire(self) -> float:
+        """حجز طلب واحد مع الانتظار إذا انتهت الميزانية. يرجع زمن الانتظار"""
+        wait = self.reserve()
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def summary(self) -> Dict[str, float]:
+        return {**self.stats, 'wait_seconds': round(self.stats['wait_seconds'], 2), 'rate': round(self.rate, 2)}
+
+
+class AdaptiveLimiter(TokenBucket):
+    """
+    دلو توكنات يعدل معدله حسب ردود الخادم (زيادة جمعية / تخفيض ضربي):
+    - نجاح بزمن مقبول: المعدل يزيد RATE_INCREASE_STEP حتى max_rate
+    - استجابة بطيئة: تخفيض بسيط
+    - 429/503: تخفيض للنصف وإيقاف كل الطلبات حتى Retry-After
+    المعدل 0 يعني بدون حد، ونكتفي باحترام Retry-After.
+    """
+
+    def __init__(self, rate: float, burst: int, min_rate: float = DAFTRA_RATE_MIN,
+                 max_rate: float = DAFTRA_RATE_MAX, latency_target: float = RATE_LATENCY_TARGET):
+        super().__init__(rate, burst)
+        self.adaptive = rate > 0
+        self.min_rate = min(min_rate, rate) if self.adaptive else 0.0
+        self.max_rate = max(max_rate, rate)
+        self.latency_target = latency_target
+        # الطلبات المتوازية ترجع 429 معًا؛ نخفض المعدل مرة واحدة لكل نافذة وليس لكل رد
+        self.decrease_cooldown = 1.0
+        self.last_decrease = 0.0
+        self.stats.update({'throttled': 0, 'errors': 0, 'slow': 0})
+
+    def _set_rate(self, rate: float) -> None:
+        if not self.adaptive:
+            return
+        self._refill(time.monotonic())
+        self.rate = min(self.max_rate, max(self.min_rate, rate))
+
+    def _decrease(self, factor: float) -> None:
+        now = time.monotonic()
+        if now - self.last_decrease < self.decrease_cooldown:
+            return
+        self.last_decrease = now
+        self._set_rate(self.rate * factor)
+
+    def on_success(self, latency: float) -> None:
+        with self.lock:
+            if latency > self.latency_target:
+                self.stats['slow'] += 1
+                self._decrease(0.9)
+            else:
+                self._set_rate(self.rate + RATE_INCREASE_STEP)
+
+    def on_throttle(self, retry_after: Optional[float]) -> float:
+        """تسجيل 429/503؛ يرجع مدة التوقف المطبقة على كل الطلبات"""
+        with self.lock:
+            self.stats['throttled'] += 1
+            self._decrease(0.5)
+            pause = retry_after if retry_after is not None else backoff_delay(min(self.stats['throttled'] - 1, 6))
+            self.blocked_until = max(self.blocked_until, time.monotonic() + pause)
+            return pause
+
+    def on_error(self) -> None:
+        with self.lock:
+            self.stats['errors'] += 1
+            self._decrease(0.8)
+
+
+def backoff_delay(attempt: int) -> float:
+    """انتظار أسي مع عشوائية كاملة حتى RETRY_BACKOFF_MAX"""
+    return random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * (2 ** attempt)))
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-After إما عدد ثواني أو تاريخ HTTP"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+_limiters: Dict[str, AdaptiveLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(url: str, rate: Optional[float] = None, burst: Optional[int] = None) -> AdaptiveLimiter:
+    """دلو واحد لكل host في العملية؛ أول من ينشئه يحدد المعدل"""
+    host = urlparse(url).netloc or url
+    with _limiters_lock:
+        limiter = _limiters.get(host)
+        if limiter is None:
+            limiter = AdaptiveLimiter(DAFTRA_RATE_LIMIT if rate is None else rate,
+                                      DAFTRA_RATE_BURST if burst is None else burst)
+            _limiters[host] = limiter
+        return limiter
+
+
+def send(session: Any, method: str, url: str, retries: int = HTTP_MAX_RETRIES,
+         limiter: Optional[AdaptiveLimiter] = None, **kwargs) -> Optional[requests.Response]:
+    """
+    إرسال طلب عبر حد المعدل المشترك للمضيف مع إعادة المحاولة:
+    - 429/5xx: إعادة المحاولة بعد Retry-After أو انتظار أسي
+    - أي حالة أخرى (200، 404، 400...) ترجع فورًا بدون انتظار
+    - أخطاء الاتصال: إعادة المحاولة، و None بعد فشل كل المحاولات
+    session: requests.Session (عادة من http_transport حتى تُعاد الاتصالات).
+    """
+    limiter = limiter or get_limiter(url)
+    response = None
+    for attempt in range(retries):
+        limiter.acquire()
+        started = time.monotonic()
+        try:
+            response = session.request(method, url, **kwargs)
+        except requests.exceptions.RequestException as e:
+            limiter.on_error()
+            logger.error(f"خطأ اتصال {method} {url} (محاولة {attempt + 1}): {e}")
+            response = None
+            if attempt < retries - 1:
+                time.sleep(backoff_delay(attempt))
+            continue
+
+        if response.status_code in THROTTLE_STATUSES:
+            pause = limiter.on_throttle(parse_retry_after(response.headers.get("Retry-After")))
+            logger.warning(f"{response.status_code} من {urlparse(url).netloc}، إيقاف {pause:.1f} ثانية "
+                           f"وتخفيض المعدل إلى {limiter.rate:.1f} طلب/ثانية")
+            continue
+        if response.status_code in RETRY_STATUSES:
+            limiter.on_error()
+            if attempt < retries - 1:
+                time.sleep(backoff_delay(attempt))
+            continue
+
+        limiter.on_success(time.monotonic() - started)
+        return response
+    return response
@@ -0,0 +1,163 @@
+import sys
+import time
+from dataclasses import dataclass, fields
+from datetime import datetime
+from operator import attrgetter
+from typing import Any, Callable, ClassVar, Dict, Iterable, Iterator, List, Mapping, Optional, Tuple
+
+from json_codec import dumps
+
+
+class Record:
+    """
+    صف نظيف بحقول ثابتة في __slots__ بدل dict: بدون جدول hash لكل صف، فآلاف الصفوف
+    في دفعات الكتابة تأخذ جزءًا من الذاكرة. يدعم الوصول مثل dict (get / [] / items / update)
+    حتى تعمل معه البصمات وإجماليات العملاء والـ dead letter بدون تغيير.
+
+    الأنواع dataclass(slots=True) بمقارنة حسب الحقول؛ السجل قابل للتعديل مثل dict
+    فهو غير قابل للـ hash (__hash__ = None) مثله، والمفاتيح المؤقتة تستخدم id(row).
+    """
+
+    __slots__ = ()
+    FIELDS: ClassVar[Tuple[str, ...]] = ()
+    _values: ClassVar[Callable[[Any], Tuple[Any, ...]]]
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return getattr(self, key, default) if key in self.FIELDS else default
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self.FIELDS
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.FIELDS)
+
+    def __len__(self) -> int:
+        return len(self.FIELDS)
+
+    def keys(self) -> Tuple[str, ...]:
+        return self.FIELDS
+
+    def items(self) -> Iterator[Tuple[str, Any]]:
+        return zip(self.FIELDS, self._values(self))
+
+    def update(self, values: Mapping[str, Any]) -> None:
+        for key, value in values.items():
+            self[key] = value
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(zip(self.FIELDS, self._values(self)))
+
+
+def _record(cls: type) -> type:
+    """dataclass(slots=True) + أسماء الحقول وقارئ كل القيم دفعة واحدة (attrgetter)"""
+    cls = dataclass(slots=True)(cls)
+    cls.FIELDS = tuple(field.name for field in fields(cls))
+    cls._values = staticmethod(attrgetter(*cls.FIELDS))
+    cls.__hash__ = None
+    return cls
+
+
+@_record
+class InvoiceRecord(Record):
+    id: Optional[str] = None
+    invoice_id: Optional[str] = None
+    invoice_no: Optional[str] = None
+    invoice_date: Optional[str] = None
+    customer_id: Optional[str] = None
+    summary_total: Optional[float] = None
+    branch: Optional[int] = None
+    client_business_name: Optional[str] = None
+    client_city: Optional[str] = None
+    summary_paid: Optional[float] = None
+    summary_unpaid: Optional[float] = None
+    staff_id: Optional[int] = None
+    staff_name: Optional[str] = None
+    created_at: Optional[str] = None
+    updated_at: Optional[str] = None
+
+
+@_record
+class ItemRecord(Record):
+    id: Optional[str] = None
+    invoice_id: Optional[str] = None
+    quantity: Optional[float] = None
+    unit_price: Optional[float] = None
+    subtotal: Optional[float] = None
+    product_id: Optional[str] = None
+    product_code: Optional[str] = None
+    client_business_name: Optional[str] = None
+    created_at: Optional[str] = None
+    updated_at: Optional[str] = None
+
+
+@_record
+class CustomerRecord(Record):
+    id: Optional[str] = None
+    customer_code: Optional[str] = None
+    name: Optional[str] = None
+    phone: Optional[str] = None
+    email: Optional[str] = None
+    gender: Optional[str] = None
+    birth_date: Optional[str] = None
+    city: Optional[str] = None
+    region: Optional[str] = None
+    address: Optional[str] = None
+    total_spent: Optional[float] = None
+    total_invoices: Optional[int] = None
+    max_order_value: Optional[float] = None
+    average_order_value: Optional[float] = None
+    payment_total: Optional[float] = None
+    last_order_date: Optional[str] = None
+    order_frequency_days: Optional[int] = None
+    is_active: Optional[bool] = None
+    created_at: Optional[str] = None
+    updated_at: Optional[str] = None
+
+
+def intern(value: Any) -> str:
+    """نص مشترك للقيم المتكررة (اسم العميل، المدينة، الموظف، الكود) بدل نسخة لكل صف"""
+    return sys.intern(value if type(value) is str else str(value))
+
+
+_stamp = (0, "")
+
+
+def timestamp() -> str:
+    """وقت الآن بصيغة ISO، نفس الكائن لكل الصفوف المنظفة في نفس الثانية"""
+    global _stamp
+    second = int(time.time())
+    if _stamp[0] != second:
+        _stamp = (second, datetime.fromtimestamp(second).isoformat())
+    return _stamp[1]
+
+
+def to_jsonable(value: Any) -> Any:
+    """default لـ json.dumps: السجلات كـ dict وأي نوع آخر كنص"""
+    if isinstance(value, Record):
+        return value.to_dict()
+    return str(value)
+
+
+def encode_row(row: Any) -> bytes:
+    """صف واحد كـ JSON؛ أجسام الدفعات تُبنى من هذه القطع بدون إعادة ترميز"""
+    return dumps(row.to_dict() if isinstance(row, Record) else row, default=to_jsonable)
+
+
+def join_rows(parts: List[bytes]) -> bytes:
+    return b"[" + b",".join(parts) + b"]"
+
+
+def encode_rows(rows: Iterable[Any]) -> bytes:
+    """جسم upsert مباشرة من السجلات؛ كل صف يتحول لـ dict مؤقت أثناء ترميز دفعته فقط"""
+    body = [row.to_dict() if isinstance(row, Record) else row for row in rows]
+    return dumps(body, default=to_jsonable)
@@ -0,0 +1,141 @@
+import os
+import json
+import time
+import logging
+import threading
+from typing import Callable, Dict, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+STAFF_CACHE_FILE = os.getenv("STAFF_CACHE_FILE", "staff_cache.json")
+STAFF_CACHE_TTL_HOURS = float(os.getenv("STAFF_CACHE_TTL_HOURS", "24"))
+
+
+class StaffCache:
+    """
+    خريطة الموظفين id -> name تُحمّل مرة واحدة لكل عملية وتُحفظ على القرص مع TTL.
+    لا نعيد تحميل /api2/staff إلا إذا ظهر staff_id غير موجود في الخريطة.
+    """
+
+    def __init__(self, fetch: Callable[[], Dict[str, str]], path: str = STAFF_CACHE_FILE,
+                 ttl_hours: float = STAFF_CACHE_TTL_HOURS):
+        self.fetch = fetch
+        self.path = path
+        self.ttl_seconds = ttl_hours * 3600
+        self.lock = threading.Lock()
+        self.staff: Optional[Dict[str, str]] = None
+        self.refreshed = False
+        self.stats = {'hits': 0, 'misses': 0, 'refreshes': 0}
+
+    def _load_disk(self) -> Optional[Dict[str, str]]:
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if time.time() - cached.get('fetched_at', 0) > self.ttl_seconds:
+            return None
+        return cached.get('staff') or None
+
+    def _save_disk(self) -> None:
+        try:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'fetched_at': time.time(), 'staff': self.staff}, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.error(f"خطأ في حفظ ذاكرة الموظفين: {e}")
+
+    def _refresh_locked(self) -> None:
+        self._apply_locked(self.fetch())
+
+    def _apply_locked(self, staff: Dict[str, str]) -> None:
+        self.stats['refreshes'] += 1
+        self.refreshed = True
+        if staff:
+            self.staff = staff
+            self._save_disk()
+        elif self.staff is None:
+            self.staff = {}
+
+    def _ensure_loaded_locked(self) -> None:
+        if self.staff is not None:
+            return
+        self.staff = self._load_disk()
+        if self.staff is not None:
+            logger.info(f"تم تحميل {len(self.staff)} موظف من الذاكرة المحلية")
+        else:
+            self._refresh_locked()
+
+    def ensure_loaded(self) -> None:
+        with self.lock:
+            self._ensure_loaded_locked()
+
+    def load_cached(self) -> bool:
+        """تحميل من القرص فقط بدون طلب لدفترة؛ True إذا أصبحت الخريطة جاهزة"""
+        with self.lock:
+            if self.staff is None:
+                self.staff = self._load_disk()
+            return self.staff is not None
+
+    def needs_refresh(self, staff_ids: Iterable[str]) -> bool:
+        """نفس شرط refresh_for بدون الجلب، لمن يجلب الخريطة بنفسه (المحرك غير المتزامن)"""
+        with self.lock:
+            if self.staff is None:
+                return True
+            if self.refreshed:
+                return False
+            return any(sid and sid != "0" and sid not in self.staff for sid in staff_ids)
+
+    def update(self, staff: Dict[str, str]) -> None:
+        """اعتماد خريطة جلبها المستدعي (مثل refresh_for لكن بدون self.fetch)"""
+        with self.lock:
+            self._apply_locked(staff)
+
+    def knows(self, staff_id: str) -> bool:
+        with self.lock:
+            self._ensure_loaded_locked()
+            return not staff_id or staff_id == "0" or staff_id in self.staff
+
+    def refresh_for(self, staff_ids: Iterable[str]) -> None:
+        """تحديث الخريطة مرة واحدة فقط في العملية إذا ظهر موظف غير معروف"""
+        with self.lock:
+            self._ensure_loaded_locked()
+            unknown = [sid for sid in staff_ids if sid and sid != "0" and sid not in self.staff]
+            if unknown and not self.refreshed:
+                logger.info(f"موظفون غير معروفين {unknown[:5]}، تحديث قائمة الموظفين من دفترة")
+                self._refresh_locked()
+
+    def name(self, staff_id) -> str:
+        sid = str(staff_id or "")
+        if not sid or sid == "0":
+            return ""
+        known = self.knows(sid)
+        if not known:
+            self.refresh_for([sid])
+        with self.lock:
+            self.stats['hits' if known else 'misses'] += 1
+            return self.staff.get(sid, "")
+
+    def hit_rate(self) -> float:
+        lookups = self.stats['hits'] + self.stats['misses']
+        return self.stats['hits'] / lookups if lookups else 0.0
+
+    def summary(self) -> Dict[str, float]:
+        return {**self.stats, 'size': len(self.staff or {}), 'hit_rate': round(self.hit_rate(), 3)}
+
+
+_cache: Optional[StaffCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_staff_cache(fetch: Callable[[], Dict[str, str]]) -> StaffCache:
+    """ذاكرة واحدة مشتركة لكل الفروع في نفس العملية"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = StaffCache(fetch)
+        else:
+            # آخر عميل دفترة هو اللي يستخدم في التحديث (مهم للمحرك غير المتزامن)
+            _cache.fetch = fetch
+        return _cache
@@ -0,0 +1,98 @@
+import os
+import logging
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+from urllib.parse import quote
+
+from json_codec import decode_response
+
+logger = logging.getLogger(__name__)
+
+KEYSET_PAGE_SIZE = int(os.getenv("KEYSET_PAGE_SIZE", "1000"))
+
+
+def parse_content_range(value: Optional[str]) -> Tuple[Optional[int], Optional[int]]:
+    """
+    Content-Range من PostgREST: "0-999/5000" أو "0-999/*" أو "*/0".
+    يرجع (عدد الصفوف في الاستجابة، العدد الكلي) وأي جزء غير معروف None.
+    """
+    if not value or "/" not in value:
+        return None, None
+    span, _, total = value.strip().rpartition("/")
+    returned = None
+    if "-" in span:
+        first, _, last = span.partition("-")
+        try:
+            returned = int(last) - int(first) + 1
+        except ValueError:
+            returned = None
+    elif span == "*":
+        returned = 0
+    try:
+        return returned, int(total)
+    except ValueError:
+        return returned, None
+
+
+def iter_keyset(get: Callable[..., Any], base_url: str, table: str, select: str,
+                key: str = "id", page_size: int = KEYSET_PAGE_SIZE,
+                filters: str = "", after: Any = None, count: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+    """
+    قراءة جدول PostgREST على صفحات بـ key=gt.<آخر قيمة>&order=key بدل offset.
+    كل صفحة تكلف نفس الوقت مهما كان عمق القراءة، والتعديلات أثناء القراءة لا تسبب تكرار أو تخطي.
+    الذاكرة ثابتة: صفحة واحدة فقط في كل لحظة.
+
+    get: دالة تستقبل (url, headers) وترجع Response (session.get أو دالة إعادة المحاولة).
+    بالقفز على key غير فريد (مثل invoice_id) نحصل على القيم المميزة فقط.
+
+    الصفحة الأقصر من المطلوب لا تعني النهاية دائمًا: db-max-rows في PostgREST يقص النتيجة بصمت.
+    - count="exact": الصفحة الأولى تطلب العدد الكلي (Content-Range: 0-999/N)، فنتوقف عند N
+      ونكتشف القص مباشرة ونصغّر الصفحة لحد الخادم (للمفاتيح الفريدة فقط).
+    - بدون count: الصفحة القصيرة تُتبع بطلب تأكيد واحد، والقراءة تنتهي فقط عند صفحة فارغة.
+    """
+    columns = select.split(",")
+    if key not in columns:
+        select = f"{select},{key}"
+
+    last = after
+    total = None
+    yielded = 0
+    while True:
+        url = f"{base_url}/{table}?select={select}&order={key}.asc&limit={page_size}"
+        if filters:
+            url += f"&{filters}"
+        if last is not None:
+            url += f"&{key}=gt.{quote(str(last), safe='')}"
+
+        headers = {"Range-Unit": "items", "Range": f"0-{page_size - 1}"}
+        if count and yielded == 0:
+            headers["Prefer"] = f"count={count}"
+
+        response = get(url, headers)
+        if response is None or response.status_code not in (200, 206):
+            status = getattr(response, "status_code", None)
+            raise RuntimeError(f"فشل في قراءة {table}: {status}")
+
+        rows = decode_response(response)
+        returned, page_total = parse_content_range(response.headers.get("Content-Range"))
+        if returned is not None and returned != len(rows):
+            raise RuntimeError(f"استجابة ناقصة من {table}: {len(rows)} صف بدل {returned} حسب Content-Range")
+        if count and yielded == 0:
+            total = page_total
+
+        yield from rows
+        yielded += len(rows)
+        if not rows:
+            break
+        last = rows[-1][key]
+
+        if total is not None:
+            if yielded >= total:
+                break
+            if len(rows) < page_size:
+                # الخادم قص الصفحة: نعتمد حده كحجم صفحة بدل التوقف
+                logger.warning(f"قراءة {table}: الخادم أرجع {len(rows)} من {page_size} صف، "
+                               f"تصغير الصفحة لحد الخادم ({yielded}/{total})")
+                page_size = len(rows)
+
+    if total is not None and yielded < total:
+        logger.warning(f"قراءة {table} انتهت بـ {yielded} صف من أصل {total} (حذف أثناء القراءة؟)")
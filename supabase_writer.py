@@ -0,0 +1,122 @@
+import time
+import logging
+from typing import Any, Dict, List, Optional
+
+import requests
+
+from batching import TRANSIENT_STATUSES, write_batches
+from dead_letter import get_dead_letter_store
+from json_codec import send_body
+from metrics import get_metrics
+from sync_utils import get_fingerprint_store
+
+logger = logging.getLogger(__name__)
+
+
+class SupabaseWriter:
+    """
+    الكتابة المشتركة لعملاء Supabase (الفواتير والعملاء): تخطي غير المتغير بالبصمات،
+    دفعات متكيفة مع تقسيم المرفوض، وحفظ الفاشل في dead letters.
+    العميل يوفر session و headers و base_url، ويمكنه تغيير max_retries و retry_delay.
+    """
+
+    max_retries = 3
+    retry_delay = 2
+
+    def _post_upsert(self, url: str, table: str, chunk: List[Dict[str, Any]], body: bytes,
+                     unconfirmed: List[Dict[str, Any]], errors: Dict[int, str]) -> int:
+        """إرسال دفعة واحدة وإرجاع كود الحالة النهائي (0 إذا فشل الاتصال)؛ سبب الفشل يُسجل لكل صف في errors"""
+        upsert_headers = {
+            **self.headers,
+            "Prefer": "resolution=merge-duplicates,return=minimal"
+        }
+
+        status = 0
+        for attempt in range(self.max_retries):
+            try:
+                response = send_body(self.session, "POST", url, body, upsert_headers, timeout=30)
+                status = response.status_code
+
+                if status in [200, 201]:
+                    return status
+                elif status == 409:
+                    # في حالة التكرار، جرب مرة أخرى مع تحديث فقط
+                    logger.warning(f"بيانات مكررة في {table}، محاولة التحديث...")
+                    update_headers = {
+                        **self.headers,
+                        "Prefer": "resolution=ignore-duplicates,return=minimal"
+                    }
+                    response = send_body(self.session, "POST", url, body, update_headers, timeout=30)
+                    status = response.status_code
+                    if status in [200, 201]:
+                        # ignore-duplicates لا يحدث الصفوف الموجودة، فلا نحفظ بصماتها
+                        unconfirmed.extend(chunk)
+                        return status
+                else:
+                    logger.error(f"خطأ في حفظ {table} ({len(chunk)} صف): {status} - {response.text[:500]}")
+                    errors.update(dict.fromkeys(map(id, chunk), f"{status}: {response.text[:500]}"))
+                    # خطأ في البيانات نفسها: إعادة نفس الدفعة لن تنجح
+                    if 400 <= status < 500 and status not in TRANSIENT_STATUSES:
+                        return status
+
+            except requests.exceptions.RequestException as e:
+                logger.error(f"خطأ في الاتصال مع Supabase (محاولة {attempt + 1}): {e}")
+                status = 0
+                errors.update(dict.fromkeys(map(id, chunk), f"connection: {e}"))
+            if attempt < self.max_retries - 1:
+                time.sleep(self.retry_delay)
+        return status
+
+    def upsert_batch(self, table: str, data: List[Dict[str, Any]], force: bool = False,
+                     saved_rows: Optional[List[Dict[str, Any]]] = None) -> tuple[int, int]:
+        """
+        إدراج أو تحديث دفعة من البيانات مع حل مشكلة التكرار.
+        تُقسم على دفعات متكيفة الحجم (batching)، والدفعة المرفوضة تُقسم لعزل الصفوف السيئة فقط.
+        saved_rows: إن مُرر تُضاف له الصفوف الموجودة فعلاً في Supabase بعد الاستدعاء (المحفوظة وغير المتغيرة)
+        """
+        if not data:
+            return 0, 0
+
+        # إرسال الصفوف الجديدة أو المتغيرة فقط؛ غير المتغير يعتبر محفوظ
+        fingerprints = get_fingerprint_store()
+        total = len(data)
+        pending = []
+        if fingerprints:
+            changed, pending = fingerprints.filter_changed(table, data, force=force)
+            if saved_rows is not None and len(changed) < total:
+                changed_ids = {id(row) for row in changed}
+                saved_rows.extend(row for row in data if id(row) not in changed_ids)
+            data = changed
+            if not data:
+                get_metrics().add_rows(table, skipped=total)
+                return total, 0
+
+        # إضافة معاملة للتعامل مع البيانات المكررة
+        url = f"{self.base_url}/{table}?on_conflict=id"
+        unconfirmed, errors = [], {}
+        statuses = write_batches(
+            table, data, lambda chunk, body: self._post_upsert(url, table, chunk, body, unconfirmed, errors))
+        saved = [200 <= status < 300 for status in statuses]
+
+        written = sum(saved)
+        failed = len(data) - written
+        if saved_rows is not None:
+            saved_rows.extend(row for row, ok in zip(data, saved) if ok)
+        dead_letters = get_dead_letter_store()
+        if failed and dead_letters:
+            # الصفوف الفاشلة تُحفظ محليًا مع السبب لإعادة إرسالها عبر dead_letter.py replay
+            by_error = {}
+            for row, ok, status in zip(data, saved, statuses):
+                if not ok:
+                    # صفوف لم تُرسل بعد خطأ صلاحيات/مسار في دفعة سابقة ليس لها سبب خاص بها
+                    error = errors.get(id(row)) or f"{status}: not sent after an earlier batch failed"
+                    by_error.setdefault(error, []).append(row)
+            for error, rows in by_error.items():
+                dead_letters.add(table, rows, error)
+        if written:
+            logger.info(f"تم حفظ/تحديث {written} سجل في جدول {table}")
+        if fingerprints:
+            skip = {id(row) for row in unconfirmed}
+            fingerprints.commit([fp for row, fp, ok in zip(data, pending, saved) if ok and id(row) not in skip])
+        get_metrics().add_rows(table, written=written, skipped=total - len(data), failed=failed)
+        return total - failed, failed
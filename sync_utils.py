@@ -1,8 +1,512 @@
-from datetime import datetime
+import os
+import json
+import hashlib
+import sqlite3
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
 
-def get_last_sync_time():
-    # خله يرجع تاريخ قديم مؤقتًا عشان يجلب كل الفواتير من جديد
-    return datetime(2024, 1, 1)
+from http_transport import create_session
+from json_codec import decode_response, dumps
+from records import to_jsonable
 
-def update_sync_time(new_time: str):
-    print(f"🔁 تم تحديث وقت التزامن إلى: {new_time}")
+logger = logging.getLogger(__name__)
+
+# مكان حفظ حالة التزامن: ملف sqlite محلي أو جدول في Supabase
+SYNC_STATE_BACKEND = os.getenv("SYNC_STATE_BACKEND", "local").lower()
+SYNC_STATE_DB = os.getenv("SYNC_STATE_DB", "sync_state.db")
+SYNC_STATE_TABLE = os.getenv("SYNC_STATE_TABLE", "sync_state")
+SYNC_CHECKPOINT_TABLE = os.getenv("SYNC_CHECKPOINT_TABLE", "sync_checkpoints")
+INCREMENTAL_SYNC = os.getenv("INCREMENTAL_SYNC", "true").lower() == "true"
+# هامش أمان عند الرجوع لوقت التشغيل بدل حقل modified من دفترة
+SYNC_OVERLAP_MINUTES = int(os.getenv("SYNC_OVERLAP_MINUTES", "180"))
+
+# أسماء فلاتر قوائم دفترة للجلب التزايدي
+DAFTRA_MODIFIED_FILTER = os.getenv("DAFTRA_MODIFIED_FILTER", "filter[modified][gte]")
+DAFTRA_SORT_PARAM = os.getenv("DAFTRA_SORT_PARAM", "sort[id]")
+DAFTRA_SORT_VALUE = os.getenv("DAFTRA_SORT_VALUE", "desc")
+
+# نقاط استئناف: آخر صفحة حُفظت بنجاح لكل كيان وفرع، حتى لا يبدأ التشغيل المنقطع من الصفحة 1
+SYNC_CHECKPOINTS = os.getenv("SYNC_CHECKPOINTS", "true").lower() == "true"
+CHECKPOINT_MAX_AGE_HOURS = float(os.getenv("CHECKPOINT_MAX_AGE_HOURS", "24"))
+
+# عدم إعادة إرسال الصفوف التي لم يتغير محتواها منذ آخر upsert ناجح
+CHANGE_DETECTION = os.getenv("CHANGE_DETECTION", "true").lower() == "true"
+FINGERPRINT_IGNORED_FIELDS = ("created_at", "updated_at")
+
+DAFTRA_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+DEFAULT_SYNC_TIME = datetime(2024, 1, 1)
+
+
+def _branch_key(branch_id: Any) -> str:
+    return "" if branch_id is None else str(branch_id)
+
+
+class LocalStateBackend:
+    """حفظ علامات التزامن في ملف sqlite محلي"""
+
+    def __init__(self, path: str = SYNC_STATE_DB):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS watermarks ("
+            " entity TEXT NOT NULL, branch TEXT NOT NULL,"
+            " synced_at TEXT, max_id INTEGER, updated_at TEXT,"
+            " PRIMARY KEY (entity, branch))"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS checkpoints ("
+            " entity TEXT NOT NULL, branch TEXT NOT NULL, state TEXT NOT NULL, updated_at TEXT,"
+            " PRIMARY KEY (entity, branch))"
+        )
+        self.conn.commit()
+
+    def get(self, entity: str, branch: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT synced_at, max_id FROM watermarks WHERE entity = ? AND branch = ?",
+                (entity, branch)
+            ).fetchone()
+        if not row:
+            return None
+        return {'synced_at': row[0], 'max_id': row[1]}
+
+    def put(self, entity: str, branch: str, synced_at: str, max_id: Optional[int]) -> None:
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO watermarks (entity, branch, synced_at, max_id, updated_at) VALUES (?, ?, ?, ?, ?)"
+                " ON CONFLICT (entity, branch) DO UPDATE SET"
+                " synced_at = excluded.synced_at, max_id = excluded.max_id, updated_at = excluded.updated_at",
+                (entity, branch, synced_at, max_id, datetime.now().isoformat())
+            )
+            self.conn.commit()
+
+    def get_checkpoint(self, entity: str, branch: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT state FROM checkpoints WHERE entity = ? AND branch = ?", (entity, branch)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put_checkpoint(self, entity: str, branch: str, state: Dict[str, Any]) -> None:
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO checkpoints (entity, branch, state, updated_at) VALUES (?, ?, ?, ?)"
+                " ON CONFLICT (entity, branch) DO UPDATE SET"
+                " state = excluded.state, updated_at = excluded.updated_at",
+                (entity, branch, json.dumps(state), datetime.now().isoformat())
+            )
+            self.conn.commit()
+
+    def clear_checkpoint(self, entity: str, branch: str) -> None:
+        with self.lock:
+            self.conn.execute("DELETE FROM checkpoints WHERE entity = ? AND branch = ?", (entity, branch))
+            self.conn.commit()
+
+
+class SupabaseStateBackend:
+    """حفظ علامات التزامن في جدول Supabase (entity, branch, synced_at, max_id)"""
+
+    def __init__(self, table: str = SYNC_STATE_TABLE, checkpoint_table: str = SYNC_CHECKPOINT_TABLE):
+        from config import SUPABASE_URL, HEADERS_SUPABASE, REQUEST_TIMEOUT
+        self.url = f"{SUPABASE_URL}/{table}"
+        # جدول (entity, branch, state jsonb, updated_at)
+        self.checkpoint_url = f"{SUPABASE_URL}/{checkpoint_table}"
+        self.timeout = REQUEST_TIMEOUT
+        self.session = create_session(HEADERS_SUPABASE)
+
+    def get(self, entity: str, branch: str) -> Optional[Dict[str, Any]]:
+        response = self.session.get(
+            f"{self.url}?entity=eq.{entity}&branch=eq.{branch}&select=synced_at,max_id",
+            timeout=self.timeout
+        )
+        if response.status_code != 200:
+            logger.error(f"فشل في قراءة علامة التزامن {entity}/{branch}: {response.status_code}")
+            return None
+        rows = decode_response(response)
+        return rows[0] if rows else None
+
+    def put(self, entity: str, branch: str, synced_at: str, max_id: Optional[int]) -> None:
+        response = self.session.post(
+            f"{self.url}?on_conflict=entity,branch",
+            json={
+                'entity': entity,
+                'branch': branch,
+                'synced_at': synced_at,
+                'max_id': max_id,
+                'updated_at': datetime.now().isoformat(),
+            },
+            headers={"Prefer": "resolution=merge-duplicates,return=minimal"},
+            timeout=self.timeout
+        )
+        if response.status_code not in [200, 201, 204]:
+            logger.error(f"فشل في حفظ علامة التزامن {entity}/{branch}: {response.status_code} - {response.text}")
+
+    def get_checkpoint(self, entity: str, branch: str) -> Optional[Dict[str, Any]]:
+        response = self.session.get(
+            f"{self.checkpoint_url}?entity=eq.{entity}&branch=eq.{branch}&select=state",
+            timeout=self.timeout
+        )
+        if response.status_code != 200:
+            logger.error(f"فشل في قراءة نقطة الاستئناف {entity}/{branch}: {response.status_code}")
+            return None
+        rows = decode_response(response)
+        return rows[0]['state'] if rows else None
+
+    def put_checkpoint(self, entity: str, branch: str, state: Dict[str, Any]) -> None:
+        response = self.session.post(
+            f"{self.checkpoint_url}?on_conflict=entity,branch",
+            json={'entity': entity, 'branch': branch, 'state': state, 'updated_at': datetime.now().isoformat()},
+            headers={"Prefer": "resolution=merge-duplicates,return=minimal"},
+            timeout=self.timeout
+        )
+        if response.status_code not in [200, 201, 204]:
+            raise RuntimeError(f"{response.status_code} - {response.text}")
+
+    def clear_checkpoint(self, entity: str, branch: str) -> None:
+        response = self.session.delete(
+            f"{self.checkpoint_url}?entity=eq.{entity}&branch=eq.{branch}", timeout=self.timeout
+        )
+        if response.status_code not in [200, 204]:
+            logger.error(f"فشل في حذف نقطة الاستئناف {entity}/{branch}: {response.status_code}")
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_state_backend():
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            if SYNC_STATE_BACKEND == "supabase":
+                _backend = SupabaseStateBackend()
+            else:
+                _backend = LocalStateBackend()
+        return _backend
+
+
+def parse_daftra_time(value: Any) -> Optional[datetime]:
+    if not value or not isinstance(value, str):
+        return None
+    for fmt in [DAFTRA_TIME_FORMAT, '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d']:
+        try:
+            return datetime.strptime(value[:19], fmt)
+        except ValueError:
+            continue
+    return None
+
+
+class Watermark:
+    """علامة آخر تزامن ناجح لكيان وفرع، مع تتبع أعلى id و modified أثناء التشغيل"""
+
+    def __init__(self, entity: str, branch_id: Any = None):
+        self.entity = entity
+        self.branch = _branch_key(branch_id)
+        self.started_at = datetime.now()
+        self.synced_at: Optional[datetime] = None
+        self.max_id: Optional[int] = None
+        self.seen_max_id: Optional[int] = None
+        self.seen_modified: Optional[datetime] = None
+
+        if not INCREMENTAL_SYNC:
+            return
+        try:
+            stored = get_state_backend().get(entity, self.branch)
+        except Exception as e:
+            logger.error(f"خطأ في قراءة علامة التزامن {entity}/{self.branch}: {e}")
+            stored = None
+        if stored:
+            self.synced_at = parse_daftra_time(stored.get('synced_at'))
+            self.max_id = stored.get('max_id')
+
+    @property
+    def is_incremental(self) -> bool:
+        return self.synced_at is not None
+
+    def list_params(self) -> Dict[str, Any]:
+        """فلاتر دفترة: السجلات المعدلة منذ آخر تزامن، مرتبة تنازليًا حسب id"""
+        if not self.is_incremental:
+            return {}
+        return {
+            DAFTRA_MODIFIED_FILTER: self.synced_at.strftime(DAFTRA_TIME_FORMAT),
+            DAFTRA_SORT_PARAM: DAFTRA_SORT_VALUE,
+        }
+
+    def observe(self, record: Dict[str, Any]) -> None:
+        """تسجيل سجل تمت معالجته لحساب العلامة الجديدة"""
+        try:
+            record_id = int(record.get('id'))
+        except (TypeError, ValueError):
+            record_id = None
+        if record_id is not None and (self.seen_max_id is None or record_id > self.seen_max_id):
+            self.seen_max_id = record_id
+
+        modified = parse_daftra_time(record.get('modified'))
+        if modified and (self.seen_modified is None or modified > self.seen_modified):
+            self.seen_modified = modified
+
+    def page_already_synced(self, records: List[Dict[str, Any]]) -> bool:
+        """
+        True إذا كانت الصفحة كلها سجلات قديمة لم تتغير، فنوقف الترقيم مبكرًا.
+        لا نوقف إلا إذا كانت الصفحة فعلًا مرتبة تنازليًا وكل سجل فيها له modified قديم.
+        """
+        if not self.is_incremental or self.max_id is None or not records:
+            return False
+
+        previous_id = None
+        for record in records:
+            try:
+                record_id = int(record.get('id'))
+            except (TypeError, ValueError):
+                return False
+            if previous_id is not None and record_id > previous_id:
+                return False
+            previous_id = record_id
+
+            modified = parse_daftra_time(record.get('modified'))
+            if record_id > self.max_id or modified is None or modified > self.synced_at:
+                return False
+        return True
+
+    def commit(self) -> None:
+        """حفظ العلامة بعد نجاح التشغيل فقط"""
+        if not INCREMENTAL_SYNC:
+            return
+
+        if self.seen_modified is not None:
+            # وقت خادم دفترة نفسه، فلا مشكلة فروق التوقيت
+            synced_at = self.seen_modified
+            if self.synced_at and self.synced_at > synced_at:
+                synced_at = self.synced_at
+        elif self.synced_at is not None and self.seen_max_id is None:
+            # لا توجد سجلات جديدة: نبقي العلامة كما هي
+            synced_at = self.synced_at
+        else:
+            synced_at = self.started_at - timedelta(minutes=SYNC_OVERLAP_MINUTES)
+
+        max_id = self.max_id
+        if self.seen_max_id is not None and (max_id is None or self.seen_max_id > max_id):
+            max_id = self.seen_max_id
+
+        update_sync_time(synced_at.strftime(DAFTRA_TIME_FORMAT), self.entity, self.branch, max_id)
+
+
+class Checkpoint:
+    """
+    نقطة استئناف لكيان وفرع: آخر صفحة حُفظت كل سجلاتها بنجاح.
+    تُكتب فقط بعد نجاح upsert الدفعة، وتُحذف عند اكتمال التشغيل بدون أخطاء.
+    التشغيل التالي بعد انقطاع يبدأ من نفس الصفحة (إعادة صفحة واحدة كهامش أمان
+    لو تغير ترتيب الصفحات بحذف سجلات) بدل الصفحة 1.
+    """
+
+    def __init__(self, entity: str, branch_id: Any = None, watermark: Optional[Watermark] = None):
+        self.entity = entity
+        self.branch = _branch_key(branch_id)
+        self.watermark = watermark
+        self.state: Optional[Dict[str, Any]] = None
+        # أي فشل في التشغيل يوقف تقدم النقطة حتى لا نتجاوز سجلات لم تُحفظ
+        self.frozen = False
+        if SYNC_CHECKPOINTS:
+            self._load()
+
+    def _synced_at(self) -> Optional[str]:
+        if self.watermark is None or self.watermark.synced_at is None:
+            return None
+        return self.watermark.synced_at.strftime(DAFTRA_TIME_FORMAT)
+
+    def _load(self) -> None:
+        try:
+            state = get_state_backend().get_checkpoint(self.entity, self.branch)
+        except Exception as e:
+            logger.error(f"خطأ في قراءة نقطة الاستئناف {self.entity}/{self.branch}: {e}")
+            return
+        if not state:
+            return
+
+        saved_at = parse_daftra_time(state.get('saved_at'))
+        if saved_at is None or datetime.now() - saved_at > timedelta(hours=CHECKPOINT_MAX_AGE_HOURS):
+            logger.info(f"نقطة استئناف {self.entity}/{self.branch or '-'} قديمة، تجاهلها")
+            return
+        # الترقيم يعتمد على نفس فلتر modified؛ لو تغيرت العلامة فالصفحات لم تعد نفسها
+        if state.get('synced_at') != self._synced_at():
+            logger.info(f"نقطة استئناف {self.entity}/{self.branch or '-'} لفلتر مختلف، تجاهلها")
+            return
+
+        self.state = state
+        if self.watermark is not None:
+            self.watermark.started_at = parse_daftra_time(state.get('started_at')) or self.watermark.started_at
+            for record in state.get('seen', []):
+                self.watermark.observe(record)
+
+    @property
+    def resume_page(self) -> int:
+        if not self.state:
+            return 1
+        page = int(self.state.get('page', 0))
+        if page >= 1:
+            logger.info(f"⏯️ استئناف {self.entity}/{self.branch or '-'} من الصفحة {page} بدل الصفحة 1")
+        return max(page, 1)
+
+    @property
+    def limit(self) -> Optional[int]:
+        """حجم الصفحة الذي حُفظت به النقطة؛ الاستئناف يستخدمه حتى تبقى أرقام الصفحات بنفس المعنى"""
+        return self.state.get('limit') if self.state else None
+
+    def freeze(self) -> None:
+        self.frozen = True
+
+    def save(self, page: int, limit: Optional[int] = None) -> None:
+        """حفظ آخر صفحة اكتمل حفظها؛ يُستدعى بعد نجاح upsert فقط"""
+        if not SYNC_CHECKPOINTS or self.frozen or page < 1:
+            return
+        seen = []
+        if self.watermark is not None:
+            seen.append({
+                'id': self.watermark.seen_max_id,
+                'modified': self.watermark.seen_modified.strftime(DAFTRA_TIME_FORMAT)
+                if self.watermark.seen_modified else None,
+            })
+        state = {
+            'page': page,
+            'limit': limit,
+            'synced_at': self._synced_at(),
+            'started_at': (self.watermark.started_at if self.watermark else datetime.now()).strftime(DAFTRA_TIME_FORMAT),
+            'saved_at': datetime.now().strftime(DAFTRA_TIME_FORMAT),
+            'seen': seen,
+        }
+        try:
+            get_state_backend().put_checkpoint(self.entity, self.branch, state)
+            self.state = state
+        except Exception as e:
+            logger.error(f"خطأ في حفظ نقطة الاستئناف {self.entity}/{self.branch}: {e}")
+
+    def clear(self) -> None:
+        """حذف النقطة بعد اكتمال التشغيل بنجاح"""
+        if not SYNC_CHECKPOINTS or self.state is None:
+            return
+        try:
+            get_state_backend().clear_checkpoint(self.entity, self.branch)
+            self.state = None
+        except Exception as e:
+            logger.error(f"خطأ في حذف نقطة الاستئناف {self.entity}/{self.branch}: {e}")
+
+
+def get_last_sync_time(entity: str = "invoices", branch_id: Any = None) -> datetime:
+    """وقت آخر تزامن ناجح للكيان والفرع، أو تاريخ قديم إذا لم يوجد"""
+    watermark = Watermark(entity, branch_id)
+    return watermark.synced_at or DEFAULT_SYNC_TIME
+
+
+def update_sync_time(new_time: str, entity: str = "invoices", branch_id: Any = None,
+                     max_id: Optional[int] = None) -> None:
+    branch = _branch_key(branch_id)
+    try:
+        get_state_backend().put(entity, branch, new_time, max_id)
+        logger.info(f"🔁 تم تحديث وقت التزامن {entity}/{branch or '-'} إلى: {new_time} (max_id={max_id})")
+    except Exception as e:
+        logger.error(f"خطأ في حفظ علامة التزامن {entity}/{branch}: {e}")
+
+
+def record_fingerprint(record: Dict[str, Any]) -> int:
+    """بصمة ثابتة (8 بايت) لمحتوى السجل بدون حقول الوقت"""
+    content = {k: v for k, v in record.items() if k not in FINGERPRINT_IGNORED_FIELDS}
+    # json القياسية دائمًا وليس json_codec: البصمات المخزنة يجب أن تبقى ثابتة مهما تغير المرمز
+    encoded = json.dumps(content, sort_keys=True, default=str, ensure_ascii=False).encode()
+    return int.from_bytes(hashlib.blake2b(encoded, digest_size=8).digest(), "big", signed=True)
+
+
+class FingerprintStore:
+    """بصمات آخر نسخة مرفوعة لكل (جدول، id) في sqlite محلي"""
+
+    CHUNK = 500
+
+    def __init__(self, path: str = SYNC_STATE_DB):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS fingerprints ("
+            " tbl TEXT NOT NULL, id TEXT NOT NULL, hash INTEGER NOT NULL,"
+            " PRIMARY KEY (tbl, id)) WITHOUT ROWID"
+        )
+        self.conn.commit()
+        self.stats: Dict[str, Dict[str, int]] = {}
+
+    def _count(self, table: str, rows: int, skipped: int = 0, bytes_saved: int = 0) -> None:
+        # الفروع المتوازية ومراحل خط المعالجة تتشارك نفس المخزن
+        with self.lock:
+            stats = self.stats.setdefault(table, {'rows': 0, 'skipped': 0, 'bytes_saved': 0})
+            stats['rows'] += rows
+            stats['skipped'] += skipped
+            stats['bytes_saved'] += bytes_saved
+
+    def _stored(self, table: str, ids: List[str]) -> Dict[str, int]:
+        stored = {}
+        with self.lock:
+            for start in range(0, len(ids), self.CHUNK):
+                chunk = ids[start:start + self.CHUNK]
+                placeholders = ",".join("?" * len(chunk))
+                stored.update(self.conn.execute(
+                    f"SELECT id, hash FROM fingerprints WHERE tbl = ? AND id IN ({placeholders})",
+                    [table, *chunk]
+                ).fetchall())
+        return stored
+
+    def filter_changed(self, table: str, rows: List[Dict[str, Any]], key: str = "id", force: bool = False):
+        """
+        إرجاع (الصفوف الجديدة أو المتغيرة، البصمات المعلقة).
+        البصمات المعلقة لا تُحفظ إلا بعد نجاح الـ upsert عبر commit.
+        force: إرسال كل الصفوف (مثلاً عند إعادة بنود محذوفة) مع تحديث بصماتها.
+        """
+        fingerprints = [(str(row.get(key)), record_fingerprint(row)) for row in rows]
+        if force:
+            self._count(table, len(rows))
+            return list(rows), [(table, row_id, fingerprint) for row_id, fingerprint in fingerprints]
+        stored = self._stored(table, [row_id for row_id, _ in fingerprints])
+
+        changed, pending = [], []
+        bytes_saved = 0
+        for row, (row_id, fingerprint) in zip(rows, fingerprints):
+            if stored.get(row_id) == fingerprint:
+                bytes_saved += len(dumps(row, default=to_jsonable))
+                continue
+            changed.append(row)
+            pending.append((table, row_id, fingerprint))
+        self._count(table, len(rows), len(rows) - len(changed), bytes_saved)
+        return changed, pending
+
+    def commit(self, pending: List[tuple]) -> None:
+        if not pending:
+            return
+        with self.lock:
+            self.conn.executemany(
+                "INSERT INTO fingerprints (tbl, id, hash) VALUES (?, ?, ?)"
+                " ON CONFLICT (tbl, id) DO UPDATE SET hash = excluded.hash",
+                pending
+            )
+            self.conn.commit()
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        result = {}
+        with self.lock:
+            tables = {table: dict(stats) for table, stats in self.stats.items()}
+        for table, stats in tables.items():
+            ratio = stats['skipped'] / stats['rows'] if stats['rows'] else 0.0
+            result[table] = {**stats, 'skip_ratio': round(ratio, 3)}
+        return result
+
+
+_fingerprints = None
+
+
+def get_fingerprint_store() -> Optional[FingerprintStore]:
+    """المخزن المشترك، أو None إذا كان كشف التغيير معطلاً"""
+    global _fingerprints
+    if not CHANGE_DETECTION:
+        return None
+    with _backend_lock:
+        if _fingerprints is None:
+            _fingerprints = FingerprintStore()
+        return _fingerprints